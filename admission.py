@@ -0,0 +1,130 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import logging
+import threading
+
+from windows import getTime
+import settings
+
+Apply = 'apply'                                                         # the value is calculated like any other value.
+Drop = 'drop'                                                           # the value is ignored.
+Correct = 'correct'                                                     # the value is only given to the functions that don't depend on the order of the values (see Statistician.correct).
+
+
+class _Recent(object):
+    """
+    the values that were admitted most recently for 1 asset.
+    """
+    __slots__ = ('valueAt', 'timestamp', 'value', 'keys')
+
+    def __init__(self):
+        self.valueAt = None                                             # the timestamp of the last value, as received.
+        self.timestamp = None                                           # the timestamp of the last value, nr of seconds since the epoch.
+        self.value = None
+        self.keys = []                                                  # (timestamp, value) of the recent values, oldest first. A short list is smaller than a set.
+
+    def add(self, timestamp, value, size):
+        self.keys.append((timestamp, value))
+        if len(self.keys) > size:
+            del self.keys[0]
+
+    def contains(self, timestamp, value):
+        """
+        :return: True if the value was received at the same moment: the type is also compared, 1 and True are not the same value.
+        """
+        for key in self.keys:
+            if key[0] == timestamp and type(key[1]) is type(value) and key[1] == value:
+                return True
+        return False
+
+
+class Admission(object):
+    """
+    the first stage of the event path: decides, per value, if the statistics have to be calculated. The last
+    values of every asset (timestamp and value) are kept, so that:
+    - exact duplicates (redelivered messages, retries of a gateway) are dropped, without running the functions, also
+      when they are older than the last value.
+    - values that are older than the last one (late values) are handled according to the policy: Apply, Drop or Correct.
+    Values without a timestamp are always applied.
+    """
+
+    def __init__(self, enabled, latePolicy, size=4):
+        """
+        create the object
+        :param enabled: when false, every value is applied.
+        :param latePolicy: what to do with late values: Apply, Drop or Correct
+        :param size: the nr of values per asset that are remembered to recognize duplicates.
+        """
+        if latePolicy not in (Apply, Drop, Correct):
+            raise ValueError("unknown late value policy: {}".format(latePolicy))
+        self.enabled = enabled
+        self.latePolicy = latePolicy
+        self.size = size
+        self._recent = {}                                               # asset id -> _Recent
+        self._lock = threading.Lock()
+        self.admittedCount = 0
+        self.duplicateCount = 0
+        self.lateCount = 0
+        self.droppedCount = 0                                           # late values that were dropped.
+        self.correctedCount = 0                                         # late values that were given to the correction path.
+
+    def check(self, assetId, value, valueAt):
+        """
+        decides what to do with a value of an asset.
+        :param assetId: the id of the asset
+        :param value: the value
+        :param valueAt: the timestamp of the value (iso formatted string), can be None.
+        :return: Apply, Drop or Correct
+        """
+        if not self.enabled or valueAt is None:
+            return Apply
+        with self._lock:
+            recent = self._recent.get(assetId)
+            if recent and recent.valueAt == valueAt and type(recent.value) is type(value) and recent.value == value:
+                self.duplicateCount += 1                                # no need to parse the timestamp.
+                return Drop
+        try:
+            timestamp = getTime(valueAt)
+        except (ValueError, OverflowError):
+            logging.warning("invalid timestamp for {}: {}".format(assetId, valueAt))
+            return Apply
+        with self._lock:
+            recent = self._recent.get(assetId)
+            if recent is None:
+                recent = self._recent[assetId] = _Recent()
+            elif recent.contains(timestamp, value):
+                self.duplicateCount += 1                                # also a redelivered value that is older than the last one.
+                return Drop
+            if recent.timestamp is not None and timestamp < recent.timestamp:
+                self.lateCount += 1
+                if self.latePolicy == Drop:
+                    self.droppedCount += 1
+                    return Drop
+                if self.latePolicy == Correct:
+                    self.correctedCount += 1
+                else:
+                    self.admittedCount += 1
+                recent.add(timestamp, value, self.size)
+                return self.latePolicy
+            recent.valueAt = valueAt
+            recent.timestamp = timestamp
+            recent.value = value
+            recent.add(timestamp, value, self.size)
+            self.admittedCount += 1
+            return Apply
+
+    def metrics(self):
+        """
+        :return: a dict with the nr of values that were admitted, duplicates and late values.
+        """
+        with self._lock:
+            return {'assets': len(self._recent), 'admitted': self.admittedCount, 'duplicates': self.duplicateCount,
+                    'late': self.lateCount, 'dropped': self.droppedCount, 'corrected': self.correctedCount}
+
+
+admission = Admission(settings.AdmissionEnabled, settings.LatePolicy, settings.AdmissionHistory)
@@ -0,0 +1,438 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import math
+import itertools
+import threading
+from array import array
+
+try:
+    import numpy                                                        # optional: used to speed up the batch calculations.
+except ImportError:
+    numpy = None
+
+_locks = [threading.Lock() for i in range(256)]                         # shared by the histograms and sketches: a lock is only held for 1 object at a time.
+_nextLock = itertools.count()
+
+
+def _getLock():
+    return _locks[next(_nextLock) % len(_locks)]
+
+
+class Moments(object):
+    """
+    streaming count, mean and variance (Welford). Every update is O(1) and numerically stable. 2 objects can be
+    merged (Chan et al.), so partial results of batches, shards or worker processes can be combined.
+    """
+    __slots__ = ('count', 'mean', 'm2')                                 # kept per group, pane and slot: no instance dict.
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        """
+        create the object
+        :param count: the nr of values
+        :param mean: the mean of the values
+        :param m2: the sum of the squared differences from the mean
+        """
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, value):
+        """
+        adds a value.
+        :param value: the new value
+        :return: None
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / float(self.count)
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """
+        adds all the values of another Moments object to this one.
+        :param other: a Moments object
+        :return: None
+        """
+        if not other.count:
+            return
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / float(count)
+        self.m2 += other.m2 + delta * delta * self.count * other.count / float(count)
+        self.count = count
+
+    def remove(self, other):
+        """
+        removes the values of another Moments object that were merged into (or added to) this one, the inverse of
+        merge. Used to drop the oldest part of a sliding window.
+        :param other: a Moments object with a subset of the values.
+        :return: None
+        """
+        count = self.count - other.count
+        if count <= 0:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        mean = (self.mean * self.count - other.mean * other.count) / float(count)
+        delta = other.mean - mean
+        self.m2 = max(0.0, self.m2 - other.m2 - delta * delta * count * other.count / float(self.count))  # rounding can't make it negative.
+        self.mean = mean
+        self.count = count
+
+    @property
+    def variance(self):
+        """
+        :return: the population variance (the std was always calculated over the values of the period, not a sample)
+        """
+        return self.m2 / self.count if self.count else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    def toState(self):
+        """
+        :return: a json serializable representation, to store in the state store.
+        """
+        return [self.count, self.mean, self.m2]
+
+    @staticmethod
+    def fromState(value):
+        """
+        create an object from the value that was returned by toState.
+        :param value: a list [count, mean, m2] or None
+        :return: a Moments object
+        """
+        if not value:
+            return Moments()
+        return Moments(value[0], value[1], value[2])
+
+
+class Histogram(object):
+    """
+    a distribution with buckets of a fixed size. The buckets are stored in an array, relative to an origin, with
+    spare room at both ends, so that finding the bucket of a value is O(1) and growing in either direction is
+    amortized O(1). Can hold counts (typecode 'l') or sums, like time per bucket (typecode 'd').
+    """
+    __slots__ = ('bucketSize', 'origin', 'typecode', 'low', 'high', '_data', '_offset', '_first', '_last', '_lock')
+
+    def __init__(self, bucketSize, origin, typecode='l', low=None, high=None):
+        """
+        create the object
+        :param bucketSize: the size of each bucket
+        :param origin: the start of a bucket. All the bucket boundaries are at origin + n * bucketSize.
+        :param typecode: 'l' for counts, 'd' for sums
+        :param low: values below this are ignored, None for no limit.
+        :param high: values above this are ignored, None for no limit.
+        """
+        self.bucketSize = bucketSize
+        self.origin = origin
+        self.typecode = typecode
+        self.low = low
+        self.high = high
+        self._data = array(typecode)
+        self._offset = 0                                                # the bucket nr of the first item in _data
+        self._first = None                                              # first and last bucket nr that are in use.
+        self._last = None
+        self._lock = _getLock()                                         # views can be taken from the publisher thread.
+        if low is not None:                                             # the list always starts at the bucket of low, pre-size a fixed range.
+            self._reserve(self.getBucket(low), self.getBucket(high if high is not None else low))
+
+    def getBucket(self, value):
+        """
+        :return: the bucket nr of the value, relative to the origin.
+        """
+        return int(math.floor((value - self.origin) / float(self.bucketSize)))
+
+    def _reserve(self, first, last):
+        """
+        makes certain that buckets first..last exist, allocating at least as much room as there already is,
+        in the direction of the growth.
+        """
+        if self._first is None:
+            self._data = array(self.typecode, [0]) * (last - first + 1)
+            self._offset = first
+            self._first, self._last = first, last
+            return
+        size = len(self._data)
+        if first < self._offset:
+            extra = max(self._offset - first, size)
+            self._data = array(self.typecode, [0]) * extra + self._data
+            self._offset -= extra
+            size += extra
+        if last >= self._offset + size:
+            extra = max(last - self._offset - size + 1, size)
+            self._data.extend(array(self.typecode, [0]) * extra)
+        self._first = min(self._first, first)
+        self._last = max(self._last, last)
+
+    def add(self, value, weight=1):
+        """
+        adds a value to the distribution
+        :param value: the value, determines the bucket
+        :param weight: the amount to add to the bucket (1 for counts, a duration for time sums)
+        :return: True if the value was in range.
+        """
+        if (self.low is not None and value < self.low) or (self.high is not None and value > self.high):
+            return False
+        bucket = self.getBucket(value)
+        with self._lock:
+            if self._first is None or bucket < self._first or bucket > self._last:
+                self._reserve(bucket, bucket)
+            self._data[bucket - self._offset] += weight
+        return True
+
+    def addMany(self, values):
+        """
+        adds a list of values (each with weight 1), vectorized with numpy when available.
+        :param values: a list of numbers
+        :return: the nr of values that were in range.
+        """
+        if not numpy or not values:
+            return len([x for x in values if self.add(x)])
+        data = numpy.asarray(values, dtype=float)
+        mask = numpy.ones(len(data), dtype=bool)
+        if self.low is not None:
+            mask &= data >= self.low
+        if self.high is not None:
+            mask &= data <= self.high
+        buckets = numpy.floor((data[mask] - self.origin) / float(self.bucketSize)).astype(int)
+        if not len(buckets):
+            return 0
+        first, last = int(buckets.min()), int(buckets.max())
+        counts = numpy.bincount(buckets - first)
+        with self._lock:
+            self._reserve(first, last)
+            for i in numpy.nonzero(counts)[0].tolist():
+                self._data[first + i - self._offset] += int(counts[i])
+        return len(buckets)
+
+    def merge(self, other):
+        """
+        adds all the buckets of another histogram with the same bucket size and a compatible origin.
+        :param other: a Histogram object
+        :return: None
+        """
+        if other._first is None:
+            return
+        shift = (other.origin - self.origin) / float(self.bucketSize)
+        if shift != int(shift):
+            raise ValueError("can't merge histograms with unaligned buckets")
+        shift = int(shift)
+        with self._lock:
+            self._reserve(other._first + shift, other._last + shift)
+            for bucket in range(other._first, other._last + 1):
+                self._data[bucket + shift - self._offset] += other._data[bucket - other._offset]
+
+    def toList(self):
+        """
+        :return: the values of the buckets that are in use, starting with the lowest bucket.
+        """
+        with self._lock:
+            if self._first is None:
+                return []
+            return self._data[self._first - self._offset: self._last - self._offset + 1].tolist()
+
+    def percentages(self):
+        """
+        :return: the values of the buckets, expressed as percentage of the total.
+        """
+        values = self.toList()
+        total = sum(values)
+        if not total:
+            return []
+        return [x * 100.0 / total for x in values]
+
+    @property
+    def start(self):
+        """
+        :return: the lower boundary of the first bucket that is in use.
+        """
+        return self.origin + self._first * self.bucketSize if self._first is not None else None
+
+    def toState(self):
+        """
+        :return: a json serializable representation, to store in the state store.
+        """
+        return {'size': self.bucketSize, 'origin': self.origin, 'type': self.typecode, 'low': self.low,
+                'high': self.high, 'first': self._first, 'buckets': self.toList()}
+
+    @staticmethod
+    def fromState(value):
+        """
+        create an object from the value that was returned by toState.
+        :param value: a dict
+        :return: a Histogram object
+        """
+        result = Histogram(value['size'], value['origin'], value['type'], value['low'], value['high'])
+        if value['buckets']:
+            result._reserve(value['first'], value['first'] + len(value['buckets']) - 1)
+            for i, x in enumerate(value['buckets']):
+                result._data[value['first'] + i - result._offset] = x
+        return result
+
+
+class QuantileSketch(object):
+    """
+    streaming quantiles with a relative error guarantee (DDSketch). The values are counted in buckets with
+    logarithmic boundaries: bucket k holds the values in (gamma^(k-1), gamma^k], with
+    gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy).
+
+    error bound: every quantile that is returned, is within relativeAccuracy of the exact value
+    (|estimate - exact| <= relativeAccuracy * |exact|), as long as the bucket that contains it wasn't collapsed.
+    Memory is bounded: each sign has at most maxBuckets buckets. When there would be more, the buckets of the values
+    closest to 0 are merged, so only the accuracy of those values is lost. With the defaults (1%, 2048 buckets),
+    a range of values with a ratio of about 10^17 between the largest and smallest (non zero) magnitude can be
+    covered before that happens. The estimates are clamped to the exact min and max.
+    Sketches with the same accuracy can be merged without any extra loss of accuracy.
+    """
+    __slots__ = ('relativeAccuracy', 'maxBuckets', '_gamma', '_logGamma', '_positive', '_negative', '_floors', 'zeroCount',
+                 'count', 'min', 'max', '_lock')
+
+    minValue = 1e-9                                                     # values closer to 0 than this, are counted as 0.
+
+    def __init__(self, relativeAccuracy=0.01, maxBuckets=2048):
+        """
+        create the object
+        :param relativeAccuracy: the relative error of the quantiles, between 0 and 1
+        :param maxBuckets: the max nr of buckets for the positive and for the negative values.
+        """
+        if not 0 < relativeAccuracy < 1:
+            raise ValueError("relative accuracy should be between 0 and 1")
+        self.relativeAccuracy = relativeAccuracy
+        self.maxBuckets = maxBuckets
+        self._gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self._logGamma = math.log(self._gamma)
+        self._positive = {}                                             # bucket nr -> count
+        self._negative = {}                                             # bucket nr of the absolute value -> count
+        self._floors = None                                             # the lowest bucket nr that remains after a collapse, per sign. Only created at the first collapse.
+        self.zeroCount = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._lock = _getLock()                                         # quantiles can be calculated from the publisher thread.
+
+    def _getKey(self, value):
+        return int(math.ceil(math.log(value) / self._logGamma))
+
+    def _getValue(self, key):
+        return 2 * self._gamma ** key / (self._gamma + 1)
+
+    def _addToStore(self, sign, key, count):
+        store = self._positive if sign == 'positive' else self._negative
+        floor = self._floors[sign] if self._floors else None
+        if floor is not None and key < floor:
+            key = floor
+        store[key] = store.get(key, 0) + count
+        if len(store) > self.maxBuckets:                                # collapse the buckets closest to 0
+            keys = sorted(store.keys())
+            floor = keys[len(keys) - self.maxBuckets]
+            for lowKey in keys[:len(keys) - self.maxBuckets]:
+                store[floor] += store.pop(lowKey)
+            if not self._floors:
+                self._floors = {'positive': None, 'negative': None}
+            self._floors[sign] = floor
+
+    def add(self, value, count=1):
+        """
+        adds a value to the sketch
+        :param value: the value
+        :param count: the nr of times that the value should be added
+        :return: None
+        """
+        with self._lock:
+            if value > self.minValue:
+                self._addToStore('positive', self._getKey(value), count)
+            elif value < -self.minValue:
+                self._addToStore('negative', self._getKey(-value), count)
+            else:
+                self.zeroCount += count
+            self.count += count
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def merge(self, other):
+        """
+        adds all the values of another sketch with the same accuracy.
+        :param other: a QuantileSketch object
+        :return: None
+        """
+        if other.relativeAccuracy != self.relativeAccuracy:
+            raise ValueError("can't merge sketches with a different accuracy")
+        if not other.count:
+            return
+        with self._lock:
+            for key, count in other._positive.items():
+                self._addToStore('positive', key, count)
+            for key, count in other._negative.items():
+                self._addToStore('negative', key, count)
+            self.zeroCount += other.zeroCount
+            self.count += other.count
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def quantile(self, q):
+        """
+        get the estimate of a quantile.
+        :param q: the quantile, between 0 and 1 (0.5 = median)
+        :return: the estimated value or None if the sketch is empty.
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * (self.count - 1)
+            total = 0
+            result = None
+            for key in sorted(self._negative.keys(), reverse=True):     # the most negative values first
+                total += self._negative[key]
+                if total > rank:
+                    result = -self._getValue(key)
+                    break
+            if result is None:
+                total += self.zeroCount
+                if total > rank:
+                    result = 0
+            if result is None:
+                for key in sorted(self._positive.keys()):
+                    total += self._positive[key]
+                    if total > rank:
+                        result = self._getValue(key)
+                        break
+            if result is None:
+                result = self.max
+            return min(max(result, self.min), self.max)
+
+    def toState(self):
+        """
+        :return: a json serializable representation, to store in the state store.
+        """
+        return {'accuracy': self.relativeAccuracy, 'maxBuckets': self.maxBuckets, 'zero': self.zeroCount,
+                'count': self.count, 'min': self.min, 'max': self.max,
+                'positive': sorted(self._positive.items()), 'negative': sorted(self._negative.items()),
+                'floors': self._floors or {'positive': None, 'negative': None}}
+
+    @staticmethod
+    def fromState(value):
+        """
+        create an object from the value that was returned by toState.
+        :param value: a dict
+        :return: a QuantileSketch object
+        """
+        result = QuantileSketch(value['accuracy'], value['maxBuckets'])
+        result._positive = dict((key, count) for key, count in value['positive'])
+        result._negative = dict((key, count) for key, count in value['negative'])
+        result._floors = dict(value['floors']) if any(x is not None for x in value['floors'].values()) else None
+        result.zeroCount = value['zero']
+        result.count = value['count']
+        result.min = value['min']
+        result.max = value['max']
+        return result
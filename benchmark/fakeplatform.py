@@ -0,0 +1,294 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+# an in-process stand-in for the AllThingsTalk platform, used by the benchmarks. It provides the parts of the
+# att_event_engine and att_trusted_event_server packages that are used by the service (assets, timers, logins, event
+# registration) and keeps the values in memory. Every call that would go to the cloud is counted and can be given a
+# latency. Call install() before any module of the service is imported.
+
+import sys
+import time
+import types
+import random
+import threading
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+class Platform(object):
+    """
+    the assets and values of the fake platform, the counters of the calls that were made and the latency of a call.
+    """
+
+    def __init__(self):
+        self.latency = 0                                                # nr of seconds that every call takes.
+        self.jitter = 0                                                 # max nr of seconds that is randomly added to the latency.
+        self.calls = {}                                                 # kind of call -> nr of calls
+        self.assets = {}                                                # asset id -> definition
+        self.values = {}                                                # (device id, asset name) -> value
+        self.created = set()                                            # (device id, asset name) of the assets that were created.
+        self.strict = False                                             # when true, a value can only be sent to an asset that was created, like on the real platform.
+        self.monitored = []                                             # (function, asset or timer) tuples that were registered for events.
+        self.timers = {}                                                # timer id -> nr of seconds
+        self.trigger = None                                             # the asset that raised the current event.
+        self._lock = threading.Lock()
+
+    def call(self, kind):
+        """
+        counts the call and waits for the latency.
+        :param kind: the kind of call, like 'get', 'send' or 'create'
+        :return: None
+        """
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+        delay = self.latency + (random.random() * self.jitter if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def resetCalls(self):
+        """
+        starts counting from 0 again.
+        :return: a dict with the counts so far.
+        """
+        with self._lock:
+            result = self.calls
+            self.calls = {}
+        return result
+
+    def addAsset(self, id, device, name, profile):
+        """
+        creates an asset that can be monitored.
+        :return: None
+        """
+        self.assets[id] = {'id': id, 'deviceId': device, 'name': name, 'profile': profile}
+
+    def getAsset(self, id=None, device=None, name=None):
+        self.call('get asset')
+        if id:
+            return self.assets.get(id)
+        return {'id': "{}_{}".format(device, name), 'deviceId': device, 'name': name, 'profile': {'type': 'object'}}
+
+    def create(self, device, name):
+        self.call('create')
+        with self._lock:
+            self.created.add((device, name))
+
+    def getAssetNames(self, device):
+        self.call('get device')
+        with self._lock:
+            return set(name for id, name in self.created if id == device) | set(x['name'] for x in self.assets.values() if x['deviceId'] == device)
+
+    def getValue(self, device, name):
+        self.call('get value')
+        return self.values.get((device, name))
+
+    def setValue(self, device, name, value):
+        self.call('send')
+        if self.strict and (device, name) not in self.created:
+            raise Exception("Asset not found")
+        name = name.encode('utf-8').decode('utf-8')                     # a copy, so that the memory of the names that the platform keeps isn't counted as memory of the service.
+        with self._lock:
+            self.values[(device, name)] = value
+
+
+platform = Platform()
+
+
+def _deviceId(device):
+    return device if isinstance(device, basestring) else device.id
+
+
+class Device(object):
+    def __init__(self, id=None, name=None, gateway=None, style=None, connection=None):
+        self.id = id
+        self.name = name or id
+        self.connection = connection
+
+    @property
+    def assets(self):
+        return dict((name, None) for name in platform.getAssetNames(self.id))
+
+
+class Gateway(object):
+    def __init__(self, id, connection=None):
+        self.id = id
+        self.connection = connection
+
+
+class Asset(object):
+    """
+    same constructor and properties as the assets of att_event_engine. The definition is fetched once per object, like
+    the real implementation.
+    """
+
+    def __init__(self, id=None, gateway=None, device=None, name=None, definition=None, connection=None):
+        if not id and not (device and name) and not definition:
+            raise LookupError("either id or device and name have to be specified")
+        self.connection = connection
+        self._id = id or (definition and definition['id'])
+        self._device = device
+        self._name = name
+        self._definition = definition
+        self._state = None                                              # (value, timestamp) when the value arrived with an event.
+
+    def _getDefinition(self):
+        if not self._definition:
+            self._definition = platform.getAsset(self._id, self._device and _deviceId(self._device), self._name)
+            if not self._definition:
+                raise LookupError("unknown asset: {}".format(self._id))
+        return self._definition
+
+    @property
+    def id(self):
+        if not self._id:
+            self._id = self._getDefinition()['id']
+        return self._id
+
+    @property
+    def name(self):
+        return self._name or self._getDefinition()['name']
+
+    @property
+    def device(self):
+        if not self._device:
+            return Device(self._getDefinition()['deviceId'])
+        return Device(self._device) if isinstance(self._device, basestring) else self._device
+
+    @property
+    def profile(self):
+        return self._getDefinition()['profile']
+
+    @property
+    def value(self):
+        if self._state:
+            return self._state[0]
+        return platform.getValue(self.device.id, self.name)
+
+    @value.setter
+    def value(self, value):
+        self._setValue(value)
+
+    @property
+    def value_at(self):
+        return self._state[1] if self._state else None
+
+    def _setValue(self, value):
+        raise Exception("write value only supported on actuators")
+
+    @staticmethod
+    def current():
+        return platform.trigger
+
+
+class Sensor(Asset):
+    pass
+
+
+class Actuator(Asset):
+    def _setValue(self, value):
+        platform.setValue(self.device.id, self.name, value)
+
+
+class Virtual(Actuator):
+    @staticmethod
+    def create(connection, device, name, label, description="", profile="string", style="Undefined"):
+        platform.create(_deviceId(device), name)
+
+
+class Parameter(object):
+    def __init__(self, name, title, description, datatype, gateway=None, device=None):
+        self.name = name
+
+
+def event(assetId, value, valueAt):
+    """
+    builds the asset that is returned by Asset.current() while the event is processed.
+    :return: a Sensor object that already has the value, like the assets that are built from an event topic.
+    """
+    result = Sensor(assetId)
+    result._definition = platform.assets.get(assetId)
+    result._state = (value, valueAt)
+    return result
+
+
+class Timer(object):
+    TimerEndPoint = "127.0.0.1:9"
+
+    def __init__(self, context, name, connection=None):
+        self.context = context
+        self.name = name
+
+    @property
+    def id(self):
+        return "{}_{}".format(self.context.id if hasattr(self.context, 'id') else self.context, self.name)
+
+    def set(self, delay):
+        platform.call('timer')
+        platform.timers[self.id] = delay
+        return True
+
+    @staticmethod
+    def current():
+        return None
+
+
+class HttpClient(object):
+    def connect_api(self, username, pwd, api=None):
+        platform.call('login')
+        self._access_token = "token"
+        self._expires_in = time.time() + 3600
+        self._curHttpServer = api or "localhost"
+
+
+class IotApplication(object):
+    def __init__(self, username, pwd, api, broker, name=None):
+        pass
+
+    def run(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def When(topics):
+    def decorator(function):
+        return function
+    return decorator
+
+
+def appendToMonitorList(function, obj):
+    platform.monitored.append((function, obj))
+
+
+def _module(name, **members):
+    result = types.ModuleType(name)
+    result.__dict__.update(members)
+    sys.modules[name] = result
+    return result
+
+
+def install():
+    """
+    registers the fake att_event_engine and att_trusted_event_server packages, so that the modules of the service use
+    the fake platform.
+    :return: the platform object
+    """
+    engine = _module('att_event_engine', __path__=[])
+    engine.resources = _module('att_event_engine.resources', Asset=Asset, Sensor=Sensor, Actuator=Actuator, Virtual=Virtual,
+                               Device=Device, Gateway=Gateway, Parameter=Parameter)
+    engine.timer = _module('att_event_engine.timer', Timer=Timer)
+    engine.when = _module('att_event_engine.when', When=When)
+    engine.att = _module('att_event_engine.att', HttpClient=HttpClient)
+    server = _module('att_trusted_event_server', __path__=[])
+    server.client = _module('att_trusted_event_server.client', Client=HttpClient)
+    server.when_server = _module('att_trusted_event_server.when_server', appendToMonitorList=appendToMonitorList)
+    server.iotApplication = _module('att_trusted_event_server.iotApplication', IotApplication=IotApplication)
+    return platform
@@ -0,0 +1,371 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+# replays a stream of values over a set of definitions against the fake platform (see fakeplatform.py) and reports
+# the throughput, the latency per event, the nr of platform calls per event and the memory per definition.
+# Start from the root of the repository, for instance:
+#   python benchmark/replay.py --definitions 1000 --events 100000 --latency 20
+#   python benchmark/replay.py --dir definitions --stream recorded.jsonl --json > baseline.json
+#   python benchmark/replay.py --definitions 1000 --events 100000 --baseline baseline.json
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import datetime
+import tempfile
+import threading
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakeplatform
+
+platform = fakeplatform.install()
+import settings
+
+Template = {                                                            # the definition used for synthetic assets, when no template file is given.
+    "name": "benchmark",
+    "username": "benchmark",
+    "pwd": "benchmark",
+    "groups": [
+        {
+            "name": "everyday",
+            "reset": "0:0:0:1:0:0",
+            "calculate": [{"function": "count"}, {"function": "min"}, {"function": "max"}, {"function": "avg"},
+                          {"function": "std"}, {"function": "dist", "bucketsize": 2}]
+        },
+        {
+            "name": "always",
+            "calculate": [{"function": "count"}, {"function": "percentile"}]
+        }
+    ]
+}
+
+NumberProfile = {"type": "number"}
+
+
+def synthetic(assetIds, count, interval, seed):
+    """
+    generates a stream of values: the assets are picked at random, every asset has it's own random walk.
+    :param assetIds: the assets that produce values.
+    :param count: the nr of values
+    :param interval: nr of seconds between 2 values of the stream.
+    :param seed: for the random generator, so that runs can be compared.
+    :return: a list of (asset id, value, timestamp) tuples.
+    """
+    generator = random.Random(seed)
+    current = dict((assetId, generator.uniform(0, 100)) for assetId in assetIds)
+    start = datetime.datetime.utcnow() - datetime.timedelta(seconds=count * interval)
+    result = []
+    for i in range(count):
+        assetId = generator.choice(assetIds)
+        current[assetId] += generator.gauss(0, 1)
+        at = start + datetime.timedelta(seconds=i * interval)
+        result.append((assetId, round(current[assetId], 2), at.strftime("%Y-%m-%dT%H:%M:%S.%fZ")))
+    return result
+
+
+def recorded(path):
+    """
+    reads a recorded stream: a file with 1 json object per line, with the fields 'asset', 'value' and 'timestamp'.
+    :return: a list of (asset id, value, timestamp) tuples.
+    """
+    result = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                result.append((item['asset'], item['value'], item['timestamp']))
+    return result
+
+
+def buildDefinitions(template, assetIds):
+    result = []
+    for assetId in assetIds:
+        definition = json.loads(json.dumps(template))
+        definition['asset'] = assetId
+        result.append(definition)
+    return result
+
+
+def loadDefinitions(path):
+    result = []
+    for name in sorted(os.listdir(path)):
+        if os.path.isfile(os.path.join(path, name)):
+            with open(os.path.join(path, name)) as f:
+                result.append(json.load(f))
+    return result
+
+
+def percentile(values, pct):
+    """
+    :param values: a sorted list
+    :param pct: the percentile (0-100)
+    :return: the value at the percentile (nearest rank).
+    """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+class MemoryProbe(object):
+    """
+    measures the memory that is allocated while the definitions are loaded (and the values are replayed). Uses
+    tracemalloc when available (python 3), otherwise the growth of the max resident size of the process, which is less
+    precise. With tracemalloc, the memory of the fake platform (the values that were sent to it) is left out.
+    """
+
+    def __init__(self):
+        try:
+            import tracemalloc
+            self._tracemalloc = tracemalloc
+        except ImportError:
+            self._tracemalloc = None
+        self._start = 0
+
+    def _used(self):
+        gc.collect()
+        if not self._tracemalloc:
+            return self._maxRss()
+        snapshot = self._tracemalloc.take_snapshot().filter_traces([self._tracemalloc.Filter(False, '*fakeplatform.py')])
+        return sum(stat.size for stat in snapshot.statistics('filename'))
+
+    def start(self):
+        gc.collect()
+        if self._tracemalloc:
+            self._tracemalloc.start()
+        self._start = self._used()
+
+    def measure(self):
+        """
+        :return: the nr of bytes that were allocated since start() and are still in use, the measuring continues.
+        """
+        return self._used() - self._start
+
+    def stop(self):
+        """
+        :return: the nr of bytes that were allocated since start() and are still in use.
+        """
+        result = self.measure()
+        if self._tracemalloc:
+            self._tracemalloc.stop()
+        return result
+
+    @staticmethod
+    def _maxRss():
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(args):
+    """
+    loads the definitions, replays the stream and collects the results.
+    :return: a dict with the results.
+    """
+    workDir = tempfile.mkdtemp(prefix="statistician-benchmark-")
+    settings.StateStore = os.path.join(workDir, "statistician.db")
+    settings.DefinitionsDir = workDir
+    settings.WatchDefinitions = False
+    settings.UseRemoteTimers = False
+    settings.Shards = 1
+    settings.IngestWorkers = args.ingest
+    if args.publish_interval is not None:
+        settings.PublishInterval = args.publish_interval
+    import rules                                                        # imported after the settings are changed: the modules create their singletons with them.
+    import service
+    from publisher import flusher
+    from ingest import ingest
+    from registry import definitions as registry
+    from statistician import resetAll
+
+    try:
+        if args.dir:
+            definitions = loadDefinitions(args.dir)
+        else:
+            template = Template
+            if args.template:
+                with open(args.template) as f:
+                    template = json.load(f)
+            if args.stream:
+                assetIds = sorted(set(assetId for assetId, value, at in recorded(args.stream)))
+            else:
+                assetIds = ["asset{:06d}".format(i) for i in range(args.definitions)]
+            definitions = buildDefinitions(template, assetIds)
+        for definition in definitions:
+            platform.addAsset(definition['asset'], "device-" + definition['asset'], definition['asset'], NumberProfile)
+        assetIds = [definition['asset'] for definition in definitions]
+        stream = recorded(args.stream) if args.stream else synthetic(assetIds, args.events, args.interval, args.seed)
+
+        platform.latency = args.latency / 1000.0
+        platform.jitter = args.jitter / 1000.0
+
+        probe = MemoryProbe()
+        probe.start()
+        start = time.time()
+        for definition in definitions:
+            if not service.registerEventsForDef(definition):
+                raise Exception("failed to register definition for {}".format(definition['asset']))
+            for group in registry.getStats(definition['asset']).groups:
+                group.state                                             # loads the state, so it's memory is included.
+        loadTime = time.time() - start
+        memory = probe.measure() if args.memory else probe.stop()
+        setupCalls = platform.resetCalls()
+
+        latencies = []
+        if args.ingest:
+            arrivals = {}                                               # asset id -> arrival times of the values that are waiting.
+            lock = threading.Lock()
+
+            def process(assetId, value, valueAt):
+                rules.calculateValue(assetId, value, valueAt)
+                arrived = arrivals[assetId].popleft()
+                with lock:
+                    latencies.append(time.time() - arrived)
+            ingest.start(process, rules.calculateValues)                # the replay has no batches.
+            for assetId in assetIds:
+                arrivals[assetId] = deque()
+        start = time.time()
+        for i, (assetId, value, at) in enumerate(stream):
+            if args.rate:
+                delay = start + i / args.rate - time.time()          # open loop: the values arrive at a fixed rate, also when the service can't keep up.
+                if delay > 0:
+                    time.sleep(delay)
+            platform.trigger = fakeplatform.event(assetId, value, at)
+            if args.ingest:
+                arrivals[assetId].append(time.time())
+                rules.calculateStatistics()
+            else:
+                begin = time.time()
+                rules.calculateStatistics()
+                latencies.append(time.time() - begin)
+        if args.ingest:
+            ingest.drain(3600)
+        replayTime = time.time() - start
+        start = time.time()
+        flusher.flushAll()                                              # the values that the publishers still hold back, are also calls per event.
+        flushTime = time.time() - start
+        replayCalls = platform.resetCalls()
+        memoryAfterEvents = probe.stop() if args.memory else None      # the state of the groups has grown with their values.
+
+        resetTime = None
+        if args.resets:
+            groups = [group for assetId in assetIds for group in registry.getStats(assetId).groups if group.resetEvery]
+            start = time.time()
+            done, publishers = resetAll(groups)
+            for publisher in publishers:
+                publisher.flush()
+            resetTime = time.time() - start
+        resetCalls = platform.resetCalls()
+        flusher.stop()
+
+        latencies.sort()
+        events = len(stream)
+        groups = sum(len(definition['groups']) for definition in definitions)
+        result = {
+            'definitions': len(definitions),
+            'groups': groups,
+            'events': events,
+            'latency': args.latency,
+            'rate': args.rate,
+            'ingestWorkers': args.ingest,
+            'publishInterval': settings.PublishInterval,
+            'loadTime': loadTime,
+            'memoryPerDefinition': memory / float(len(definitions)) if definitions else 0,
+            'memoryPerGroup': (memoryAfterEvents if args.memory else memory) / float(groups) if groups else 0,
+            'setupCalls': setupCalls,
+            'replayTime': replayTime,
+            'flushTime': flushTime,
+            'eventsPerSec': events / replayTime if replayTime else 0,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'maxLatency': latencies[-1] if latencies else 0,
+            'replayCalls': replayCalls,
+            'callsPerEvent': sum(replayCalls.values()) / float(events) if events else 0,
+            'memoryAfterEvents': args.memory,
+        }
+        if resetTime is not None:
+            result['resetTime'] = resetTime
+            result['resetCalls'] = resetCalls
+        return result
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def report(result):
+    print("definitions:        {definitions} ({groups} groups)".format(**result))
+    print("load time:          {:.2f} s".format(result['loadTime']))
+    print("memory/definition:  {:.0f} bytes".format(result['memoryPerDefinition']))
+    print("memory/group:       {:.0f} bytes{}".format(result['memoryPerGroup'], " (after the events)" if result.get('memoryAfterEvents') else ""))
+    print("setup calls:        {}".format(json.dumps(result['setupCalls'], sort_keys=True)))
+    print("events:             {events} in {replayTime:.2f} s".format(**result))
+    print("events/sec:         {:.0f}".format(result['eventsPerSec']))
+    print("latency p50/p99:    {:.3f} / {:.3f} ms (max {:.3f} ms)".format(result['p50'] * 1000, result['p99'] * 1000, result['maxLatency'] * 1000))
+    print("calls/event:        {:.3f} {}".format(result['callsPerEvent'], json.dumps(result['replayCalls'], sort_keys=True)))
+    print("final flush:        {:.2f} s".format(result['flushTime']))
+    if 'resetTime' in result:
+        print("reset all groups:   {:.2f} s {}".format(result['resetTime'], json.dumps(result['resetCalls'], sort_keys=True)))
+
+
+def compare(result, baseline, tolerance):
+    """
+    compares the result with a previous run.
+    :param tolerance: the fraction by which a value can be worse than the baseline.
+    :return: a list of regressions (strings), empty if there are none.
+    """
+    regressions = []
+    if result['eventsPerSec'] < baseline['eventsPerSec'] * (1 - tolerance):
+        regressions.append("events/sec dropped from {:.0f} to {:.0f}".format(baseline['eventsPerSec'], result['eventsPerSec']))
+    for name in ('p99', 'callsPerEvent', 'memoryPerDefinition', 'memoryPerGroup'):
+        if name in baseline and result[name] > baseline[name] * (1 + tolerance):
+            regressions.append("{} rose from {} to {}".format(name, baseline[name], result[name]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replays values over statistics definitions against a fake platform")
+    parser.add_argument('--definitions', type=int, default=100, help="nr of synthetic definitions")
+    parser.add_argument('--template', help="definition file used for the synthetic definitions")
+    parser.add_argument('--dir', help="directory with definition files to use instead of synthetic definitions")
+    parser.add_argument('--events', type=int, default=10000, help="nr of synthetic values")
+    parser.add_argument('--stream', help="recorded stream: 1 json object per line with 'asset', 'value' and 'timestamp'")
+    parser.add_argument('--interval', type=float, default=1, help="nr of seconds between 2 synthetic values")
+    parser.add_argument('--seed', type=int, default=1, help="seed for the synthetic values")
+    parser.add_argument('--rate', type=float, default=0, help="nr of values per second that are replayed, 0 = as fast as possible")
+    parser.add_argument('--latency', type=float, default=0, help="ms per platform call")
+    parser.add_argument('--jitter', type=float, default=0, help="max ms randomly added to every platform call")
+    parser.add_argument('--ingest', type=int, default=0, help="nr of ingest worker threads, 0 = calculate in the replay thread")
+    parser.add_argument('--publish-interval', type=float, help="overrides settings.PublishInterval")
+    parser.add_argument('--memory', action='store_true', help="also measure the memory after the events (slower: every allocation is traced)")
+    parser.add_argument('--resets', action='store_true', help="also time a reset of all the groups that have a period")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    parser.add_argument('--baseline', help="json results of a previous run, the exit code is 1 when this run is worse")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="fraction by which a result can be worse than the baseline")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        report(result)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            sys.stderr.write("regression: {}\n".format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import time
+import logging
+import threading
+
+from att_event_engine.att import HttpClient
+from att_trusted_event_server.client import Client
+
+import settings
+from metrics import metrics
+
+
+class _Entry(object):
+    """
+    a single authenticated connection in the pool.
+    """
+    def __init__(self, pwd):
+        self.pwd = pwd
+        self.connection = None
+        self.connectedAt = 0                                            # time of the last login, so we know when to refresh the token.
+        self.lastUsed = 0
+        self.lock = threading.Lock()                                    # so that only 1 login is done per tenant, even if multiple threads ask for it.
+
+
+class ConnectionPool(object):
+    """
+    keeps a long-lived, authenticated connection per tenant (username + api host), so that events and definitions
+    for the same user don't each have to log in again.
+    """
+
+    def __init__(self, factory, tokenLifetime=None, idleTimeout=None):
+        """
+        create the object
+        :param factory: callable that creates a new, unconnected client object (HttpClient or Client)
+        :param tokenLifetime: nr of seconds after which a new login is done, so that the token is refreshed before it expires.
+        :param idleTimeout: nr of seconds that a connection can remain unused before it is removed from the pool.
+        """
+        self._factory = factory
+        self._tokenLifetime = tokenLifetime if tokenLifetime is not None else settings.TokenLifetime
+        self._idleTimeout = idleTimeout if idleTimeout is not None else settings.ConnectionIdleTimeout
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._lastEviction = time.time()
+
+    def get(self, username, pwd, api=None):
+        """
+        get an authenticated connection for the user. If there is no connection yet, or the token is about to
+        expire, a new login is done.
+        :param username: the username of the tenant
+        :param pwd: the password of the tenant
+        :param api: the api host to connect to, if none, the default host of the client is used.
+        :return: a connected client object.
+        """
+        now = time.time()
+        key = (username, api or settings.Api)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or entry.pwd != pwd:                           # password changed: don't reuse the old login
+                entry = _Entry(pwd)
+                self._entries[key] = entry
+            entry.lastUsed = now
+        with entry.lock:
+            if not entry.connection or now - entry.connectedAt >= self._tokenLifetime:
+                connection = self._factory()
+                with metrics.timed('platform', call='login', tenant=username):
+                    if api:
+                        connection.connect_api(username, pwd, api)
+                    else:
+                        connection.connect_api(username, pwd)
+                entry.connection = connection
+                entry.connectedAt = now
+            result = entry.connection
+        if now - self._lastEviction > self._idleTimeout:
+            self.evictIdle()
+        return result
+
+    def evictIdle(self):
+        """
+        removes all the connections that haven't been used for longer then the idle timeout.
+        :return: None
+        """
+        now = time.time()
+        with self._lock:
+            self._lastEviction = now
+            for key in [key for key, entry in self._entries.items() if now - entry.lastUsed > self._idleTimeout]:
+                logging.info("closing idle connection for: {}".format(key[0]))
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+events = ConnectionPool(HttpClient)                     # used to process the incomming events
+provisioning = ConnectionPool(Client)                   # used to register definitions and create the assets.
@@ -0,0 +1,207 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import time
+import logging
+import threading
+from collections import deque
+
+import settings
+
+Block = 'block'                                                         # the caller waits until there is room in the queue.
+DropOldest = 'drop oldest'                                              # the oldest waiting value (of the same asset, if possible) is dropped.
+
+_Batch = object()                                                       # in the place of the timestamp of an item: the item is a list of values (see putBatch).
+
+
+def _size(item):
+    """
+    :return: the nr of values in a queued item.
+    """
+    return len(item[0]) if item[1] is _Batch else 1
+
+
+class IngestQueue(object):
+    """
+    decouples the arrival of the events from the calculation of the statistics. Every asset has it's own queue, the
+    queues are processed by a pool of worker threads. An asset is only handled by 1 worker at a time, so it's values
+    are processed in the order in which they arrived, while different assets are processed at the same time. A slow
+    platform call for 1 asset doesn't hold up the others.
+    The total nr of waiting values is limited, what happens when the limit is reached depends on the policy.
+    """
+
+    def __init__(self, workers, maxLength, policy, drainLimit):
+        """
+        create the object
+        :param workers: the nr of worker threads.
+        :param maxLength: max nr of values that can wait, for all the assets together.
+        :param policy: what to do when the queue is full: Block or DropOldest
+        :param drainLimit: max nr of values of the same asset that a worker processes before it moves on to the next asset.
+        """
+        if policy not in (Block, DropOldest):
+            raise ValueError("unknown ingest overflow policy: {}".format(policy))
+        self._workers = workers
+        self._maxLength = maxLength
+        self._policy = policy
+        self._drainLimit = drainLimit
+        self._queues = {}                                               # asset id -> deque of (value, timestamp, time of arrival) or (list of values, _Batch, time of arrival)
+        self._ready = deque()                                           # the assets that have values and are not being processed.
+        self._scheduled = set()                                         # the assets that are in _ready or being processed.
+        self._length = 0
+        self._lock = threading.Lock()
+        self._notEmpty = threading.Condition(self._lock)
+        self._notFull = threading.Condition(self._lock)
+        self._process = None
+        self._processBatch = None
+        self.running = False
+        self.processedCount = 0
+        self.errorCount = 0
+        self.droppedCount = 0
+        self.blockedCount = 0
+        self.lastLag = 0                                                # nr of seconds between the arrival of the last value and the end of it's processing.
+        self.maxLag = 0
+        self.totalLag = 0
+
+    def start(self, process, processBatch):
+        """
+        starts the worker threads.
+        :param process: callable(assetId, value, timestamp) that calculates the statistics for a value.
+        :param processBatch: callable(assetId, values) that calculates the statistics for a list of (value, timestamp) tuples.
+        :return: None
+        """
+        self._process = process
+        self._processBatch = processBatch
+        self.running = True
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._run, name="ingest-{}".format(i))
+            thread.daemon = True
+            thread.start()
+
+    def put(self, assetId, value, valueAt):
+        """
+        queue a value of an asset.
+        :param assetId: the id of the asset
+        :param value: the value
+        :param valueAt: the timestamp of the value
+        :return: None
+        """
+        self._put(assetId, (value, valueAt, time.time()))
+
+    def putBatch(self, assetId, values):
+        """
+        queue a list of values of an asset, they are processed in 1 go, after the values of the asset that are already
+        waiting. The batch counts as len(values) values for the max length of the queue and is dropped as a whole.
+        :param assetId: the id of the asset
+        :param values: a list of (value, timestamp) tuples.
+        :return: None
+        """
+        self._put(assetId, (values, _Batch, time.time()))
+
+    def _put(self, assetId, item):
+        with self._lock:
+            while self._length >= self._maxLength:
+                if self._policy == Block:
+                    self.blockedCount += 1
+                    self._notFull.wait()
+                    continue
+                queue = self._queues.get(assetId)
+                if not queue:
+                    queue = next(x for x in self._queues.values() if x)  # the asset has nothing waiting: drop from another one.
+                size = _size(queue.popleft())
+                self._length -= size
+                self.droppedCount += size
+            self._queues.setdefault(assetId, deque()).append(item)
+            self._length += _size(item)
+            if assetId not in self._scheduled:
+                self._scheduled.add(assetId)
+                self._ready.append(assetId)
+                self._notEmpty.notify()
+
+    def _next(self):
+        """
+        waits until an asset has values.
+        :return: (asset id, list of items)
+        """
+        with self._lock:
+            while not self._ready:
+                self._notEmpty.wait()
+            assetId = self._ready.popleft()
+            queue = self._queues[assetId]
+            items = [queue.popleft() for i in range(min(self._drainLimit, len(queue)))]
+            self._length -= sum(_size(x) for x in items)
+            self._notFull.notify_all()
+            return assetId, items
+
+    def _done(self, assetId, processed, errors, lags):
+        with self._lock:
+            self.processedCount += processed
+            self.errorCount += errors
+            if lags:
+                self.lastLag = lags[-1]
+                self.maxLag = max(self.maxLag, max(lags))
+                self.totalLag += sum(lags)
+            if self._queues.get(assetId):
+                self._ready.append(assetId)                             # more values arrived, the asset goes to the back of the line.
+                self._notEmpty.notify()
+            else:
+                self._queues.pop(assetId, None)
+                self._scheduled.discard(assetId)
+
+    def _run(self):
+        while True:
+            assetId, items = self._next()
+            processed = errors = 0
+            lags = []
+            try:
+                for value, valueAt, arrived in items:
+                    try:
+                        if valueAt is _Batch:
+                            self._processBatch(assetId, value)
+                            processed += len(value)
+                        else:
+                            self._process(assetId, value, valueAt)
+                            processed += 1
+                    except:
+                        errors += 1
+                        logging.exception("failed to calculate statistics for {}".format(assetId))
+                    lags.append(time.time() - arrived)
+            finally:
+                self._done(assetId, processed, errors, lags)
+
+    def drain(self, timeout):
+        """
+        waits until all the values have been processed, used when the service stops.
+        :param timeout: max nr of seconds to wait.
+        :return: True if all the values were processed.
+        """
+        deadline = time.time() + timeout
+        while self._scheduled and time.time() < deadline:
+            time.sleep(0.05)
+        return not self._scheduled
+
+    @property
+    def depth(self):
+        """
+        :return: the nr of values that are waiting.
+        """
+        return self._length
+
+    def metrics(self):
+        """
+        :return: a dict with the queue depth, the nr of values that were processed or dropped and the lag.
+        """
+        with self._lock:
+            assets = len(self._queues)
+            maxDepth = max([len(x) for x in self._queues.values()] or [0])
+        count = self.processedCount + self.errorCount
+        return {'depth': self._length, 'assets': assets, 'maxAssetDepth': maxDepth, 'processed': self.processedCount,
+                'errors': self.errorCount, 'dropped': self.droppedCount,
+                'blocked': self.blockedCount, 'lastLag': self.lastLag, 'maxLag': self.maxLag,
+                'avgLag': self.totalLag / count if count else 0}
+
+
+ingest = IngestQueue(settings.IngestWorkers, settings.IngestMaxLength, settings.IngestPolicy, settings.IngestDrainLimit)
@@ -16,54 +16,15 @@ import uuid
 
 #import att_event_engine.iotApplication as iotApp
 import att_trusted_event_server.iotApplication as iotApp
-from att_trusted_event_server.client import Client
 import settings
 
 app = Flask(__name__)
 iot = iotApp.IotApplication(settings.UserName, settings.Pwd, settings.Api, settings.Broker, "statistician")
 
 import rules
-
-def registerEventsForDef(definition):
-    """
-    load the statistsc object for the definition, create the assets required for the statistics and register for
-    topic events.
-    :param definition:
-    :return:
-    """
-    try:
-        connection = Client()
-        connection.connect_api(definition['username'], definition['pwd'])
-        obj = rules.AssetStats(definition, connection)
-        map(lambda x: x.createAssets(connection), obj.groups)  # make certain that all the assets have been created.
-        obj.register()
-        return obj
-    except:
-        logging.exception("failed to load definition: {}".format(definition))
-
-def loadAll():
-    """
-    loads al the known statistics defs from disc and registers them to monitor for incomming events
-    :return:
-    """
-    files = [f for f in os.listdir('definitions') if os.path.isfile(os.path.join('definitions', f))]
-    for file in files:
-        try:
-            registerEventsForDef(rules.loadDefinition(file))
-        except:
-            logging.exception("failed to load def: {}".format(file))
-
-
-
-def storeDef(name, value):
-    """
-    stores the definition on disk
-    :param name: the name to use
-    :param value: the value (string)
-    :return:None
-    """
-    with open(os.path.join('definitions', name), 'w') as f:
-        f.write(value)
+import service
+from metrics import metrics
+from profiler import profiler
 
 
 @app.route('/definition', methods=['POST'])
@@ -74,24 +35,27 @@ def addEvent():
     """
     try:
         data = json.loads(request.data)
-        obj = registerEventsForDef(data)
-        storeDef(obj.asset.id, request.data)
+        obj = service.registerEventsForDef(data)
+        service.storeDef(obj.asset.id + ".json", request.data)
         return 'ok', status.HTTP_200_OK
     except  Exception as e:
         logging.exception("failed to store definition")
         return str(e), status.HTTP_405_METHOD_NOT_ALLOWED
 
 
-@app.route('/definition', methods=['PUT'])
+@app.route('/definition/<id>', methods=['PUT'])
 def updateEvent(id):
     """
-    called when a statistics definition needs to be added to the list
+    called when the statistics definition of an asset has changed. Only the groups that changed are rebuilt, the
+    others keep their values.
     :return: ok or error
     """
     try:
         data = json.loads(request.data)
-        obj = registerEventsForDef(data)
-        storeDef(obj.asset.id, request.data)
+        if data.get('asset') != id:
+            return 'the definition is for asset {}, not {}'.format(data.get('asset'), id), status.HTTP_400_BAD_REQUEST
+        obj = service.registerEventsForDef(data)
+        service.storeDef(obj.asset.id + ".json", request.data)
         return 'ok', status.HTTP_200_OK
     except  Exception as e:
         logging.exception("failed to store definition")
@@ -99,18 +63,65 @@ def updateEvent(id):
 
 
 
-def wait_for_timer_service():
+@app.route('/values/<id>', methods=['POST'])
+def addValues(id):
+    """
+    called when a list of values needs to be processed for an asset, for instance when a gateway has reconnected and
+    replays it's buffered readings. The body is a json list of objects with a 'value' and 'timestamp' field.
+    :return: ok or error
+    """
+    try:
+        data = json.loads(request.data)
+        if not rules.calculateBatch(id, [(x['value'], x['timestamp']) for x in data]):
+            return 'no definition for asset {}'.format(id), status.HTTP_404_NOT_FOUND
+        return 'ok', status.HTTP_200_OK
+    except  Exception as e:
+        logging.exception("failed to process values")
+        return str(e), status.HTTP_405_METHOD_NOT_ALLOWED
+
+
+
+@app.route('/status', methods=['GET'])
+def getStatus():
+    """
+    reports the state of the engine: the progress of the startup, the timers that are waiting to be set or that
+    failed, the publishers and the provisioning of the assets.
+    :return: a json dict
+    """
+    return Response(json.dumps(service.getStatus()), mimetype='application/json')
+
+
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    """
+    the latency histograms, call and error counts of the events, functions, resets and platform calls, together with
+    the numbers of the status report, in the prometheus text format.
+    :return: text
+    """
+    return Response(metrics.render(service.getStatus()), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/profile', methods=['GET'])
+def getProfile():
     """
-    waits indefinetely until the timer service is available
-    :return:
+    samples the stacks of the running threads and returns the hottest ones. Parameters: seconds (default 10) and
+    top (nr of stacks, default 20). Only available when settings.ProfilerEnabled is set.
+    :return: text
     """
+    if not settings.ProfilerEnabled:
+        return 'profiler not enabled', status.HTTP_404_NOT_FOUND
+    report = profiler.report(float(request.args.get('seconds', 10)), int(request.args.get('top', 20)))
+    if report is None:
+        return 'a profile is already running', status.HTTP_409_CONFLICT
+    return Response(report, mimetype='text/plain')
+
 
 try:
-    wait_for_timer_service();
-    loadAll()
+    service.start()
     iot.run()
     if __name__ == '__main__':
-        app.run(host='0.0.0.0', debug=True, threaded=True, port=settings.HTTPPort, use_reloader=False)  # blocking
+        app.run(host='0.0.0.0', debug=settings.HTTPDebug, threaded=True, port=settings.HTTPPort, use_reloader=False)  # blocking
 except:
     logging.exception("failed to start statistician engine")
+service.stop()
 iot.stop()
\ No newline at end of file
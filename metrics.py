@@ -0,0 +1,212 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import re
+import time
+import bisect
+import numbers
+import threading
+
+import settings
+
+
+class _Series(object):
+    """
+    the latency histogram, nr of calls and nr of errors of 1 metric with 1 set of labels. Every series has it's own
+    lock, so threads that record different metrics don't wait for each other.
+    """
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._lock = threading.Lock()
+        self.buckets = [0] * (len(bounds) + 1)                          # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        """
+        records a measurement, use this in loops that would otherwise look up the series for every call.
+        :param seconds: the duration of the call.
+        :param error: True if the call failed.
+        :return: None
+        """
+        index = bisect.bisect_left(self._bounds, seconds)
+        with self._lock:
+            self.buckets[index] += 1
+            self.sum += seconds
+            self.count += 1
+            if error:
+                self.errors += 1
+
+    def snapshot(self):
+        """
+        :return: a consistent copy of the values: (buckets, sum, count, errors)
+        """
+        with self._lock:
+            return list(self.buckets), self.sum, self.count, self.errors
+
+
+class _Timed(object):
+    """
+    context manager that records the duration of the block, and an error if it raised an exception.
+    """
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+        self._start = 0
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self._metrics.observe(self._name, time.time() - self._start, excType is not None, **self._labels)
+        return False
+
+
+class _NotTimed(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+_notTimed = _NotTimed()
+
+
+def _snakeCase(name):
+    return re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', name).lower()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, _escape(value)) for key, value in labels) + '}'
+
+
+def _isNumber(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, complex)
+
+
+class Metrics(object):
+    """
+    collects the latency histograms, call counts and error counts of the hot paths of the service (events, the
+    statistical functions, resets, provisioning and the platform calls), per set of labels (function, tenant,...).
+    The result is rendered in the prometheus text format. When disabled, timed() returns a shared object that does
+    nothing, and the instrumented loops check 'enabled' first, so the cost is a single attribute lookup.
+    """
+
+    def __init__(self, enabled, buckets, prefix='statistician'):
+        """
+        create the object
+        :param enabled: when false, nothing is recorded.
+        :param buckets: the upper bounds (in seconds) of the buckets of the latency histograms, sorted.
+        :param prefix: the start of the name of every metric.
+        """
+        self.enabled = enabled
+        self._buckets = list(buckets)
+        self._prefix = prefix
+        self._series = {}                                               # (name, sorted tuple of labels) -> _Series
+        self._lock = threading.Lock()                                   # only for adding series, the measurements use the lock of their series.
+
+    def timed(self, name, **labels):
+        """
+        measures the duration of a block: with metrics.timed('function', function='avg', tenant=username): ...
+        :param name: the name of the metric.
+        :param labels: the labels of the measurement.
+        :return: a context manager.
+        """
+        if not self.enabled:
+            return _notTimed
+        return _Timed(self, name, labels)
+
+    def getSeries(self, name, **labels):
+        """
+        :param name: the name of the metric.
+        :param labels: the labels of the measurement, None values are recorded as an empty string.
+        :return: the object that records the measurements of the metric with these labels.
+        """
+        key = (name, tuple(sorted((label, value if value is not None else '') for label, value in labels.items())))
+        series = self._series.get(key)
+        if not series:
+            with self._lock:
+                series = self._series.setdefault(key, _Series(self._buckets))
+        return series
+
+    def observe(self, name, seconds, error=False, **labels):
+        """
+        records a measurement.
+        :param name: the name of the metric.
+        :param seconds: the duration of the call.
+        :param error: True if the call failed.
+        :param labels: the labels of the measurement.
+        :return: None
+        """
+        if self.enabled:
+            self.getSeries(name, **labels).observe(seconds, error)
+
+    def render(self, status=None):
+        """
+        :param status: optional dict with the status report of the service (see service.getStatus), it's numbers are
+        added as gauges.
+        :return: the metrics in the prometheus text format.
+        """
+        with self._lock:
+            items = sorted(self._series.items(), key=lambda item: item[0])
+        series = [(key,) + x.snapshot() for key, x in items]
+        lines = []
+        lastName = None
+        for (name, labels), buckets, seconds, count, errors in series:
+            metric = "{}_{}_seconds".format(self._prefix, name)
+            if name != lastName:
+                lines.append("# TYPE {} histogram".format(metric))
+            cumulative = 0
+            for bound, inBucket in zip(self._buckets + ['+Inf'], buckets):
+                cumulative += inBucket
+                lines.append("{}_bucket{} {}".format(metric, _formatLabels(labels + (("le", bound),)), cumulative))
+            lines.append("{}_sum{} {}".format(metric, _formatLabels(labels), seconds))
+            lines.append("{}_count{} {}".format(metric, _formatLabels(labels), count))
+            lastName = name
+        lastName = None
+        for (name, labels), buckets, seconds, count, errors in series:
+            metric = "{}_{}_errors_total".format(self._prefix, name)
+            if name != lastName:
+                lines.append("# TYPE {} counter".format(metric))
+            lines.append("{}{} {}".format(metric, _formatLabels(labels), errors))
+            lastName = name
+        if status:
+            lines.extend(self._renderStatus(status))
+        return "\n".join(lines) + "\n"
+
+    def _renderStatus(self, status):
+        """
+        the numbers in the sections of the status report, as gauges. Sections that are a list of dicts (like the
+        shards) get a label with the position in the list.
+        """
+        gauges = {}                                                     # metric name -> list of (labels, value)
+        for section, values in sorted(status.items()):
+            items = [((), values)] if isinstance(values, dict) else [((('index', i),), x) for i, x in enumerate(values or []) if isinstance(x, dict)]
+            for labels, item in items:
+                for key, value in sorted(item.items()):
+                    if _isNumber(value):
+                        name = "{}_{}_{}".format(self._prefix, _snakeCase(section), _snakeCase(key))
+                        gauges.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(gauges):
+            lines.append("# TYPE {} gauge".format(name))
+            for labels, value in gauges[name]:
+                lines.append("{}{} {}".format(name, _formatLabels(labels), float(value)))
+        return lines
+
+
+metrics = Metrics(settings.Metrics, settings.MetricsBuckets)
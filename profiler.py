@@ -0,0 +1,91 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import os
+import sys
+import time
+import threading
+
+import settings
+
+_idleFiles = ('threading.py', 'queue.py', 'Queue.py', 'selectors.py', 'socketserver.py', 'SocketServer.py')  # threads that wait in these files are not doing any work.
+
+
+class Sampler(object):
+    """
+    a sampling profiler: takes the stacks of all the threads at a fixed interval and counts how often every stack was
+    seen. Threads that are waiting on a lock, condition or queue are left out, so the report shows where the cpu time
+    goes. It only runs while a report is requested, so there is no cost the rest of the time.
+    """
+
+    def __init__(self, interval, depth, maxDuration):
+        """
+        create the object
+        :param interval: nr of seconds between 2 samples.
+        :param depth: max nr of frames per stack, starting from the innermost frame.
+        :param maxDuration: max nr of seconds that a single run can take.
+        """
+        self._interval = interval
+        self._depth = depth
+        self._maxDuration = maxDuration
+        self._running = threading.Lock()                                # only 1 run at a time.
+
+    def _getStack(self, frame):
+        stack = []
+        while frame and len(stack) < self._depth:
+            code = frame.f_code
+            stack.append((code.co_filename, frame.f_lineno, code.co_name))
+            frame = frame.f_back
+        return tuple(stack)
+
+    def sample(self, duration):
+        """
+        takes samples during a nr of seconds, blocks the calling thread.
+        :param duration: nr of seconds, limited to the max duration.
+        :return: a tuple (nr of samples, dict with stack -> nr of times seen), None if another run is busy.
+        """
+        if not self._running.acquire(False):
+            return None
+        try:
+            ownThread = threading.current_thread().ident
+            counts = {}
+            samples = 0
+            deadline = time.time() + min(duration, self._maxDuration)
+            while time.time() < deadline:
+                for thread, frame in sys._current_frames().items():
+                    if thread == ownThread or os.path.basename(frame.f_code.co_filename) in _idleFiles:
+                        continue
+                    stack = self._getStack(frame)
+                    counts[stack] = counts.get(stack, 0) + 1
+                samples += 1
+                time.sleep(self._interval)
+            return samples, counts
+        finally:
+            self._running.release()
+
+    def report(self, duration, top):
+        """
+        profiles the service and formats the hottest stacks.
+        :param duration: nr of seconds to sample.
+        :param top: nr of stacks to report.
+        :return: a string, or None if another run is busy.
+        """
+        result = self.sample(duration)
+        if result is None:
+            return None
+        samples, counts = result
+        total = sum(counts.values())
+        lines = ["{} samples, {} busy stacks".format(samples, total)]
+        for stack, count in sorted(counts.items(), key=lambda item: -item[1])[:top]:
+            lines.append("")
+            lines.append("{} ({:.1f}%)".format(count, 100.0 * count / total))
+            for fileName, line, function in stack:
+                lines.append("  {}:{} {}".format(fileName, line, function))
+        return "\n".join(lines) + "\n"
+
+
+profiler = Sampler(settings.ProfilerInterval, settings.ProfilerDepth, settings.ProfilerMaxDuration)
@@ -0,0 +1,166 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import logging
+import threading
+
+from att_event_engine.resources import Virtual, Device
+
+import settings
+from statestore import StateStore
+from metrics import metrics
+
+
+def isNotFound(error):
+    """
+    :param error: the exception of a platform call. The platform client raises plain exceptions with the text of the
+    response, so the text is checked.
+    :return: True if the error says that the asset doesn't exist.
+    """
+    text = str(error).lower()
+    return 'not found' in text or '404' in text
+
+
+class Manifest(object):
+    """
+    keeps track of the output assets that were already created on the platform for each monitored asset, together
+    with the label, description and profile they were created with. This way, registering an unchanged definition
+    (at startup or through a PUT) doesn't have to create all the assets again.
+    The first time the outputs of a monitored asset are provisioned by this process, the manifest is checked against
+    the assets of the device on the platform (1 call), so that outputs that were removed by hand are created again.
+    An output that is removed later, is created again when a value can't be sent to it (see recreate).
+    """
+
+    def __init__(self, store, enabled=True, verify=True):
+        """
+        create the object
+        :param store: the StateStore that holds the manifest, 1 record per monitored asset.
+        :param enabled: when false, all the assets are always created (the manifest is not used).
+        :param verify: when true, the manifest of a monitored asset is checked against the platform the first time it is used.
+        """
+        self._store = store
+        self.enabled = enabled
+        self.verify = verify
+        self._lock = threading.Lock()
+        self._verified = set()                                          # the monitored assets of which the manifest has been checked.
+        self._devices = {}                                              # device id -> set of monitored asset ids, to find the manifest of an output.
+        self.createCount = 0
+        self.skipCount = 0
+        self.missingCount = 0
+        self.recreateCount = 0
+
+    def provision(self, connection, asset, outputs, tenant=None):
+        """
+        makes certain that the output assets exist on the platform. Only the assets that are not yet in the manifest
+        or that were created with a different label, description or profile, are created.
+        :param connection: the connection to use for creating the assets.
+        :param asset: the monitored asset, the output assets are created on the same device.
+        :param outputs: a list of tuples: (name, label, description, profile)
+        :param tenant: the username of the definition, used as label of the metrics.
+        :return: the nr of assets that were created.
+        """
+        known = (self._store.load(asset.id) or {}) if self.enabled else {}
+        deviceId = getattr(asset.device, 'id', asset.device)
+        with self._lock:
+            self._devices.setdefault(deviceId, set()).add(asset.id)
+            check = bool(known) and self.verify and asset.id not in self._verified
+            self._verified.add(asset.id)
+        if check:
+            known = self._check(connection, deviceId, known, tenant)
+        created = 0
+        try:
+            for name, label, description, profile in outputs:
+                spec = {'label': label, 'description': description, 'profile': profile}
+                if known.get(name) == spec:
+                    self.skipCount += 1
+                    continue
+                with metrics.timed('platform', call='create', tenant=tenant):
+                    Virtual.create(connection, asset.device, name, label, description, profile)
+                known[name] = spec
+                created += 1
+                self.createCount += 1
+        finally:
+            if created and self.enabled:                             # also store the assets that were created before a failure.
+                with self._lock:
+                    current = self._store.load(asset.id) or {}      # other groups of the same asset can have been provisioned in the mean time.
+                    current.update(dict((name, known[name]) for name, label, description, profile in outputs if name in known))
+                    self._store.save(asset.id, current)
+        if created:
+            logging.info("created {} assets for {}".format(created, asset.id))
+        return created
+
+    def _check(self, connection, deviceId, known, tenant):
+        """
+        lists the assets of the device, in 1 call.
+        :return: the outputs in 'known' that still exist on the platform.
+        """
+        try:
+            with metrics.timed('platform', call='list', tenant=tenant):
+                existing = Device(id=deviceId, connection=connection).assets
+        except:
+            logging.exception("failed to list the assets of device {}, the manifest is not checked".format(deviceId))
+            return known
+        missing = [name for name in known if name not in existing]
+        if missing:
+            logging.warning("{} outputs of device {} no longer exist, they are created again".format(len(missing), deviceId))
+            self.missingCount += len(missing)
+        return dict((name, spec) for name, spec in known.items() if name in existing)
+
+    def recreate(self, connection, device, name, tenant=None):
+        """
+        creates an output asset again, with the label, description and profile of the manifest, for instance when the
+        platform doesn't know the asset that a value was sent to.
+        :param connection: the connection to use for creating the asset.
+        :param device: the device of the asset (Device object or id)
+        :param name: the name of the asset
+        :param tenant: the username of the definition, used as label of the metrics.
+        :return: True if the asset was created.
+        """
+        deviceId = getattr(device, 'id', device)
+        with self._lock:
+            assetIds = list(self._devices.get(deviceId, ()))
+        for assetId in assetIds:
+            spec = (self._store.load(assetId) or {}).get(name)
+            if spec:
+                with metrics.timed('platform', call='create', tenant=tenant):
+                    Virtual.create(connection, deviceId, name, spec['label'], spec['description'], spec['profile'])
+                self.recreateCount += 1
+                logging.warning("created asset {} of device {} again".format(name, deviceId))
+                return True
+        return False
+
+    def forget(self, assetId, names=None):
+        """
+        removes output assets from the manifest of an asset, so that they are created again when they are needed. Used
+        when a definition is removed or when groups or functions are removed from it: the assets are not removed from
+        the platform, but they may be removed by hand.
+        :param assetId: the id of the monitored asset.
+        :param names: the names of the output assets, None for all of them.
+        :return: None
+        """
+        with self._lock:
+            if names is None:
+                self._store.delete(assetId)
+                self._verified.discard(assetId)
+                for assetIds in self._devices.values():
+                    assetIds.discard(assetId)
+            else:
+                current = self._store.load(assetId)
+                if current:
+                    for name in names:
+                        current.pop(name, None)
+                    self._store.save(assetId, current)
+
+    def metrics(self):
+        """
+        :return: a dict with the nr of assets that were created, the nr of create calls that were skipped, the nr of
+        outputs that were missing on the platform at startup and the nr of assets that were created again after a failed send.
+        """
+        return {'created': self.createCount, 'skipped': self.skipCount, 'missing': self.missingCount, 'recreated': self.recreateCount}
+
+
+manifest = Manifest(StateStore(settings.StateStore, 'provisioning'), settings.ProvisioningCache, settings.ProvisioningVerify)
@@ -0,0 +1,360 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import time
+import copy
+import logging
+import threading
+from collections import OrderedDict
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from att_event_engine.resources import Actuator
+
+import settings
+from metrics import metrics
+from provisioning import manifest, isNotFound
+
+_missing = object()
+
+
+class Publisher(object):
+    """
+    write-behind output stage between the statisticians and the platform. Only the latest value of every output
+    asset is kept. The values are sent to the platform when the flush interval has passed or when enough changes
+    have been collected, whichever comes first.
+    """
+    __slots__ = ('interval', 'maxChanges', 'tenant', '_pending', '_last', '_changes', '_lastFlush', '_holdUntil', '_lock', '_flushLock',
+                 'flushCount', 'publishedCount', 'coalescedCount', 'unchangedCount', 'errorCount', 'lastFlushTime', 'maxFlushTime',
+                 'totalFlushTime')
+
+    def __init__(self, interval, maxChanges, tenant=None):
+        """
+        create the object
+        :param interval: max nr of seconds that a value is kept before it is sent to the platform. When 0, every value is sent immediately.
+        :param maxChanges: the nr of changes after which the values are sent, even if the interval hasn't passed yet.
+        :param tenant: the username of the definition, used as label of the metrics.
+        """
+        self.interval = interval
+        self.maxChanges = maxChanges
+        self.tenant = tenant
+        self._pending = OrderedDict()                               # (device, asset name) -> (connection, value)
+        self._last = {}                                             # (device, asset name) -> the last value that was queued, to skip values that didn't change.
+        self._changes = 0
+        self._lastFlush = time.time()
+        self._holdUntil = 0                                         # values are not sent before this time, unless too many changes have been collected.
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()                          # flushes are done one after the other, so that an older value never overwrites a newer one.
+        self.flushCount = 0
+        self.publishedCount = 0
+        self.coalescedCount = 0
+        self.unchangedCount = 0
+        self.errorCount = 0
+        self.lastFlushTime = 0                                      # duration of the last flush, in seconds.
+        self.maxFlushTime = 0
+        self.totalFlushTime = 0
+
+    @staticmethod
+    def fromDefinition(definition):
+        """
+        create a publisher with the settings found in the definition, if any. example: "publish": {"interval": 10, "max changes": 50}
+        :param definition: a json dict that contains the definition for the stats.
+        :return: a Publisher object.
+        """
+        params = definition.get('publish', {})
+        return Publisher(params.get('interval', settings.PublishInterval), params.get('max changes', settings.PublishMaxChanges), definition.get('username'))
+
+    def put(self, connection, device, name, value):
+        """
+        queue a value for an output asset. A previous value for the same asset that hasn't been sent yet, is replaced.
+        When settings.PublishSkipUnchanged is set, a value that is the same as the last one of the asset is skipped.
+        :param connection: the connection to use for sending the value
+        :param device: the device of the asset (Device object or id)
+        :param name: the name of the asset
+        :param value: the new value, or a function that returns the new value. The function is only called when the
+        value is sent, so that views (like percentages) don't have to be calculated for every change.
+        :return: None
+        """
+        key = (getattr(device, 'id', device), name)                # the asset returns a new Device object every time, only it's id identifies the device.
+        with self._lock:
+            if not callable(value) and settings.PublishSkipUnchanged:
+                last = self._last.get(key, _missing)
+                if type(last) is type(value) and last == value:        # the type is also compared: 1 and True are not the same output.
+                    self.unchangedCount += 1
+                    return
+                self._last[key] = copy.copy(value)
+            if key in self._pending:
+                self.coalescedCount += 1
+                del self._pending[key]                              # keep the order in which the assets last changed.
+            self._pending[key] = (connection, value if callable(value) else copy.copy(value))     # lists are updated in place by the statistician.
+            self._changes += 1
+            full = self._changes >= self.maxChanges or (not self.interval and time.time() >= self._holdUntil)
+        if full:
+            self.flush()
+
+    def discard(self, device, name):
+        """
+        drops the value of an output asset that wasn't sent yet.
+        :param device: the device of the asset (Device object or id)
+        :param name: the name of the asset
+        :return: None
+        """
+        key = (getattr(device, 'id', device), name)
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def hold(self, until):
+        """
+        don't send the values before the specified time (unless max changes is reached), used to spread the values
+        of a bulk reset over time.
+        :param until: the time (as in time.time()) at which the values are sent.
+        :return: None
+        """
+        with self._lock:
+            self._holdUntil = until
+
+    def isDue(self, now):
+        """
+        :param now: the current time
+        :return: True if there are values waiting and the flush interval has passed or the hold time has expired.
+        """
+        if not self._pending or now < self._holdUntil:
+            return False
+        return self._holdUntil > self._lastFlush or now - self._lastFlush >= self.interval
+
+    def flush(self, limit=None):
+        """
+        sends the queued values to the platform, the values that changed first are sent first. This is done synchronously.
+        :param limit: max nr of values to send, the others remain queued. When None, all the values are sent.
+        :return: the nr of values that were sent.
+        """
+        with self._flushLock:
+            with self._lock:
+                if limit is None or limit >= len(self._pending):
+                    pending = self._pending
+                    self._pending = OrderedDict()
+                    self._lastFlush = time.time()
+                else:
+                    pending = OrderedDict()
+                    for i in range(limit):
+                        key, value = self._pending.popitem(last=False)
+                        pending[key] = value
+                self._changes = len(self._pending)
+            if not pending:
+                return 0
+            start = time.time()
+            for (device, name), (connection, value) in pending.items():
+                try:
+                    self._send(connection, device, name, value() if callable(value) else value)
+                    self.publishedCount += 1
+                except:
+                    self.errorCount += 1
+                    self._forget([(device, name)])
+                    logging.exception("failed to publish value for {}".format(name))
+            self.lastFlushTime = time.time() - start
+            self.maxFlushTime = max(self.maxFlushTime, self.lastFlushTime)
+            self.totalFlushTime += self.lastFlushTime
+            self.flushCount += 1
+            return len(pending)
+
+    def _send(self, connection, device, name, value):
+        """
+        sends 1 value to the platform. When the platform doesn't know the asset (anymore), it is created again (see
+        Manifest.recreate) and the value is sent once more.
+        """
+        try:
+            with metrics.timed('platform', call='send', tenant=self.tenant):
+                Actuator(device=device, name=name, connection=connection).value = value
+        except Exception as e:
+            if not isNotFound(e) or not manifest.recreate(connection, device, name, self.tenant):
+                raise
+            with metrics.timed('platform', call='send', tenant=self.tenant):
+                Actuator(device=device, name=name, connection=connection).value = value
+
+    def _forget(self, keys):
+        """
+        the values could not be sent, so the next values of these assets are sent, even if they are the same.
+        """
+        with self._lock:
+            for key in keys:
+                self._last.pop(key, None)
+
+    @property
+    def depth(self):
+        """
+        :return: the nr of values that are waiting to be sent.
+        """
+        return len(self._pending)
+
+    def metrics(self):
+        """
+        :return: a dict with the queue depth and flush statistics of this publisher.
+        """
+        return {'depth': self.depth, 'flushes': self.flushCount, 'published': self.publishedCount,
+                'coalesced': self.coalescedCount, 'unchanged': self.unchangedCount, 'errors': self.errorCount, 'lastFlushTime': self.lastFlushTime,
+                'maxFlushTime': self.maxFlushTime,
+                'avgFlushTime': self.totalFlushTime / self.flushCount if self.flushCount else 0}
+
+
+class Flusher(object):
+    """
+    a single background thread that flushes all the publishers when their interval has passed, so that we don't
+    need a thread per definition. The publishers that are due are handed to a fixed pool of sender threads, so that
+    the platform calls of different definitions overlap and a slow one doesn't hold up the others. A publisher is
+    flushed by 1 sender at a time.
+    """
+
+    def __init__(self, tick, maxRate=0, senders=1):
+        """
+        create the object
+        :param tick: nr of seconds between 2 checks of the publishers.
+        :param maxRate: max nr of values per second that are sent by this thread, 0 for no limit. Publishers that are
+        flushed because they have too many changes (or an interval of 0), do so immediately, without this limit.
+        :param senders: nr of threads that send the values of the publishers to the platform. When 1, the background
+        thread sends them itself.
+        """
+        self._tick = tick
+        self._maxRate = maxRate
+        self._budget = 0
+        self._publishers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._senderCount = senders
+        self._senders = []
+        self._queue = Queue()                                           # (publisher, limit) for the sender threads, None stops a sender.
+        self._busy = set()                                              # the publishers that wait in the queue or are being flushed by a sender.
+
+    def add(self, publisher):
+        with self._lock:
+            self._publishers.add(publisher)
+        if not self._thread:
+            self.start()
+
+    def remove(self, publisher):
+        """
+        removes the publisher, after sending all of it's remaining values.
+        :param publisher: the publisher to remove
+        :return: None
+        """
+        with self._lock:
+            self._publishers.discard(publisher)
+        publisher.flush()
+
+    def start(self):
+        with self._lock:
+            if self._thread:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="publisher")
+            self._thread.daemon = True
+            self._thread.start()
+            if self._senderCount > 1:
+                for i in range(self._senderCount):
+                    sender = threading.Thread(target=self._send, name="publisher-{}".format(i))
+                    sender.daemon = True
+                    sender.start()
+                    self._senders.append(sender)
+
+    def stop(self):
+        """
+        stops the background thread and sends all the values that are still waiting.
+        :return: None
+        """
+        self._stop.set()
+        self._thread = None
+        for sender in self._senders:
+            self._queue.put(None)
+        self._senders = []
+        self.flushAll()                                                 # waits for the flushes of the senders that are still busy.
+
+    def flushAll(self):
+        with self._lock:
+            publishers = list(self._publishers)
+        for publisher in publishers:
+            publisher.flush()
+
+    def spread(self, publishers, window):
+        """
+        spreads the moments at which the publishers send their values evenly over a time window, so that the values
+        of a bulk reset don't all arrive at the platform at the same time.
+        :param publishers: a list of publishers
+        :param window: nr of seconds over which the publishers are spread.
+        :return: None
+        """
+        now = time.time()
+        count = len(publishers)
+        for i, publisher in enumerate(publishers):
+            publisher.hold(now + window * i / float(count))
+
+    def _run(self):
+        last = time.time()
+        while not self._stop.wait(self._tick):
+            now = time.time()
+            if self._maxRate:
+                self._budget = min(self._budget + (now - last) * self._maxRate, self._maxRate * max(self._tick, 1))  # no large bursts after a quiet period.
+            last = now
+            with self._lock:
+                publishers = [p for p in self._publishers if p not in self._busy and p.isDue(now)]
+            publishers.sort(key=lambda p: p._lastFlush)                    # the publishers that have waited the longest go first.
+            for publisher in publishers:
+                if self._maxRate and self._budget < 1:
+                    break
+                limit = None
+                if self._maxRate:
+                    limit = int(self._budget)
+                    self._budget -= min(limit, publisher.depth)         # reserved before the values are sent, the senders run at the same time.
+                if self._senders:
+                    with self._lock:
+                        self._busy.add(publisher)
+                    self._queue.put((publisher, limit))
+                else:
+                    self._flush(publisher, limit)
+
+    def _send(self):
+        """
+        the loop of a sender thread.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            publisher, limit = item
+            try:
+                self._flush(publisher, limit)
+            finally:
+                with self._lock:
+                    self._busy.discard(publisher)
+
+    def _flush(self, publisher, limit):
+        try:
+            publisher.flush(limit)
+        except:
+            logging.exception("failed to flush publisher")
+
+    def metrics(self):
+        """
+        :return: a dict with the totals of all the publishers.
+        """
+        with self._lock:
+            publishers = list(self._publishers)
+        now = time.time()
+        result = {'publishers': len(publishers), 'depth': 0, 'flushes': 0, 'published': 0, 'coalesced': 0, 'unchanged': 0, 'errors': 0,
+                  'maxFlushTime': 0, 'held': 0, 'sending': len(self._busy)}
+        for publisher in publishers:
+            values = publisher.metrics()
+            for key in ['depth', 'flushes', 'published', 'coalesced', 'unchanged', 'errors']:
+                result[key] += values[key]
+            result['maxFlushTime'] = max(result['maxFlushTime'], values['maxFlushTime'])
+            if publisher.depth and publisher._holdUntil > now:
+                result['held'] += 1
+        return result
+
+
+flusher = Flusher(settings.PublishTick, settings.PublishMaxRate, settings.PublishSenders)
@@ -0,0 +1,189 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import os
+import json
+import logging
+import threading
+
+import settings
+
+
+class DefinitionRegistry(object):
+    """
+    keeps all the known statistics definitions in memory, keyed by the id of the asset that they monitor, so that
+    the event path can find the definition of an asset without having to go to disk.
+    """
+
+    def __init__(self, path):
+        """
+        create the object
+        :param path: the directory that contains the definition files.
+        """
+        self._path = path
+        self._definitions = {}                                          # asset id -> definition
+        self._stats = {}                                                # asset id -> compiled AssetStats object for the definition
+        self._files = {}                                                # file name -> (modification time, asset id) when last loaded
+        self._lock = threading.Lock()
+        self._assetLocks = [threading.Lock() for i in range(settings.GroupLocks)]  # held while the statistics object of an asset is built and replaced, shared by the assets with the same hash.
+        self._watcher = None
+
+    def get(self, assetId):
+        """
+        find the definition for an asset. This is a plain dict lookup, no io is done.
+        :param assetId: the id of the asset
+        :return: the definition (json dict) or None if there is no definition for the asset.
+        """
+        return self._definitions.get(assetId)
+
+    def getStats(self, assetId):
+        """
+        find the compiled statistics object (AssetStats) for an asset.
+        :param assetId: the id of the asset
+        :return: the AssetStats object, or None if it hasn't been built yet or the definition has changed since.
+        """
+        return self._stats.get(assetId)
+
+    def getLock(self, assetId):
+        """
+        :param assetId: the id of the asset
+        :return: the lock that has to be held while the statistics object of the asset is built and stored, so that
+        the definition of an asset is only replaced by 1 thread at a time.
+        """
+        return self._assetLocks[hash(assetId) % len(self._assetLocks)]
+
+    def ids(self):
+        """
+        :return: a list with the id's of all the assets that have a definition.
+        """
+        return list(self._definitions.keys())
+
+    def set(self, definition, stats=None):
+        """
+        stores the definition in the registry. If the definition has already been stored on disk, the modification
+        time of the file is recorded so that the watcher doesn't pick it up as a change.
+        :param definition: a json dict that contains the definition for the stats.
+        :param stats: the AssetStats object that was built for the definition, if any. When none is given and the
+        definition is different from the previous one, the previously compiled object is discarded.
+        :return: None
+        """
+        assetId = definition['asset']
+        fileName = assetId + ".json"
+        with self._lock:
+            prev = self._stats.get(assetId)
+            if stats:
+                self._stats[assetId] = stats
+            elif self._definitions.get(assetId) != definition:
+                self._stats.pop(assetId, None)
+            else:
+                prev = None
+            self._definitions[assetId] = definition
+            mtime = self._getMTime(fileName)
+            if mtime:
+                self._files[fileName] = (mtime, assetId)
+        if prev and prev is not stats:
+            prev.close()
+
+    def remove(self, assetId):
+        """
+        removes the definition of the asset from the registry.
+        :param assetId: the id of the asset
+        :return: the definition that was removed, or None
+        """
+        with self._lock:
+            for name in [name for name, (mtime, id) in self._files.items() if id == assetId]:
+                del self._files[name]
+            stats = self._stats.pop(assetId, None)
+            definition = self._definitions.pop(assetId, None)
+        if stats:
+            stats.close()
+        return definition
+
+    def load(self, name):
+        """
+        loads a definition file from disk and stores it in the registry.
+        :param name: the name of the file (in the definitions dir)
+        :return: the definition (json dict)
+        """
+        definition, changed = self._load(name)
+        return definition
+
+    def _load(self, name):
+        mtime = self._getMTime(name)
+        with open(os.path.join(self._path, name)) as f:
+            definition = json.load(f)
+        changed = self.get(definition['asset']) != definition
+        if not changed or not self.getStats(definition['asset']):
+            self.set(definition)                                        # a compiled definition is replaced by the callback of the watcher, so the event path keeps using it until the new one is ready.
+        with self._lock:
+            self._files[name] = (mtime, definition['asset'])
+        return definition, changed
+
+    def _getMTime(self, name):
+        try:
+            return os.path.getmtime(os.path.join(self._path, name))
+        except OSError:
+            return None
+
+    def scan(self):
+        """
+        checks the definitions directory for files that were added, modified or removed since they were last loaded.
+        The definitions of removed files are not removed from the registry, that is up to the caller.
+        :return: a tuple: (list of changed definitions, list of removed asset id's)
+        """
+        files = [f for f in os.listdir(self._path) if os.path.isfile(os.path.join(self._path, f))]
+        changed = []
+        for file in files:
+            known = self._files.get(file)
+            if not known or known[0] != self._getMTime(file):
+                try:
+                    definition, isChanged = self._load(file)
+                    if isChanged:                                       # the api also stores the files, those are already known
+                        changed.append(definition)
+                except:
+                    logging.exception("failed to reload definition: {}".format(file))
+        removed = []
+        with self._lock:
+            for file in set(self._files.keys()) - set(files):
+                assetId = self._files.pop(file)[1]
+                if all(id != assetId for mtime, id in self._files.values()):   # the definition can have moved to another file.
+                    removed.append(assetId)
+        return changed, removed
+
+    def watch(self, interval, onChanged, onRemoved=None):
+        """
+        starts a background thread that periodically checks the definitions directory for changes.
+        :param interval: nr of seconds between 2 checks.
+        :param onChanged: callback, called with the definition for every file that was added or modified.
+        :param onRemoved: callback, called with the asset id for every file that was removed. When none, the
+        definition is removed from the registry.
+        :return: None
+        """
+        onRemoved = onRemoved or self.remove
+        def run():
+            while not stop.wait(interval):
+                try:
+                    changed, removed = self.scan()
+                    for definition in changed:
+                        onChanged(definition)
+                    for assetId in removed:
+                        onRemoved(assetId)
+                except:
+                    logging.exception("failed to check definitions for changes")
+        stop = threading.Event()
+        self._watcher = threading.Thread(target=run, name="definition watcher")
+        self._watcher.daemon = True
+        self._watcher.stop = stop
+        self._watcher.start()
+
+    def stopWatching(self):
+        if self._watcher:
+            self._watcher.stop.set()
+            self._watcher = None
+
+
+definitions = DefinitionRegistry(settings.DefinitionsDir)
@@ -0,0 +1,659 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import os
+import json
+import math
+import time
+import logging
+import calendar
+import datetime
+import sqlite3
+import threading
+
+from dateutil import tz
+
+from statistician import Statistician
+from statestore import store, encode
+from scheduler import Period, getPeriod
+from windows import getTime
+from aggregates import Moments, Histogram
+import settings
+
+
+class Partial(object):
+    """
+    the summary of the values of 1 slot of time: count, mean and variance, min, max and optionally a histogram. All
+    the parts can be merged, so the summary of a longer period is built from the summaries of it's slots.
+    """
+    __slots__ = ('moments', 'min', 'max', 'hist')
+
+    def __init__(self, hist=None):
+        """
+        create the object
+        :param hist: an empty Histogram object, None when no distribution is needed.
+        """
+        self.moments = Moments()
+        self.min = None
+        self.max = None
+        self.hist = hist
+
+    def add(self, value):
+        self.moments.update(value)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.hist:
+            self.hist.add(value)
+
+    def merge(self, other):
+        """
+        adds the values of another Partial object to this one.
+        :param other: a Partial object
+        :return: None
+        """
+        self.moments.merge(other.moments)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        if other.hist:
+            if not self.hist:
+                self.hist = Histogram.fromState(other.hist.toState())
+            else:
+                try:
+                    self.hist.merge(other.hist)
+                except ValueError:
+                    pass                                                # the buckets of the definition have changed, the old ones can't be combined.
+
+    @property
+    def count(self):
+        return self.moments.count
+
+    def toState(self):
+        """
+        :return: a json serializable representation, to store in the rollup store.
+        """
+        return [self.moments.toState(), self.min, self.max, self.hist.toState() if self.hist else None]
+
+    @staticmethod
+    def fromState(value):
+        """
+        create an object from the value that was returned by toState.
+        :param value: a list
+        :return: a Partial object
+        """
+        result = Partial(Histogram.fromState(value[3]) if value[3] else None)
+        result.moments = Moments.fromState(value[0])
+        result.min, result.max = value[1], value[2]
+        return result
+
+
+def _timestamp(moment):
+    return calendar.timegm(moment.utctimetuple())
+
+
+class Tier(object):
+    """
+    a level of detail of the rollup store: the length of the slots and how long they are kept.
+    """
+
+    def __init__(self, retention, resolution=None, period=None):
+        """
+        create the object
+        :param retention: nr of seconds that the slots are kept before they are merged into the next tier.
+        :param resolution: length of the slots in seconds, for the finest tier.
+        :param period: the length of the slots as 'year:month:week:day:hour:minute', for the coarser tiers. The slots
+        start at settings.PeriodOrigin, so days start at midnight, like the groups.
+        """
+        self.retention = retention
+        self.resolution = resolution
+        self._period = Period(period) if period else None
+
+    def getStart(self, timestamp):
+        """
+        :param timestamp: nr of seconds since the epoch.
+        :return: the start of the slot that contains the timestamp, nr of seconds since the epoch.
+        """
+        if self.resolution:
+            return math.floor(timestamp / self.resolution) * self.resolution
+        return _timestamp(self._period.previous(datetime.datetime.fromtimestamp(timestamp, tz.tzutc())))
+
+
+def getTiers():
+    """
+    :return: the list of tiers that are configured in the settings, finest first.
+    """
+    result = [Tier(settings.RollupRetention * 86400, resolution=settings.RollupResolution)]
+    for period, days in settings.RollupTiers:
+        result.append(Tier(days * 86400, period=period))
+    return result
+
+
+class RollupStore(object):
+    """
+    durable, local storage for the partial aggregates of the assets, 1 row per asset, tier and slot, in an sqlite
+    database. The data of every slot of time is in exactly 1 row: when the fine slots are compacted, they are merged
+    into the slot of the next tier and removed. So the summary of a period is the merge of all the rows in the period,
+    whatever their tier.
+    """
+
+    def __init__(self, path, table='rollup'):
+        """
+        create the object. The database is only opened when it is first used.
+        :param path: the path to the sqlite database file.
+        :param table: the name of the table, so that the database file can be shared with the other stores.
+        """
+        self._path = path
+        self._table = table
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if not self._db:
+            dir = os.path.dirname(self._path)
+            if dir and not os.path.isdir(dir):
+                os.makedirs(dir)
+            self._db = sqlite3.connect(self._path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS {} (asset TEXT NOT NULL, tier INTEGER NOT NULL, start REAL NOT NULL, "
+                             "value TEXT NOT NULL, PRIMARY KEY (asset, tier, start))".format(self._table))
+            self._db.execute("CREATE INDEX IF NOT EXISTS {0}_start ON {0} (asset, start)".format(self._table))
+            self._db.commit()
+        return self._db
+
+    def load(self, asset, tier, start):
+        """
+        :return: the Partial object of a slot, None if there is nothing stored for it.
+        """
+        with self._lock:
+            row = self._open().execute("SELECT value FROM {} WHERE asset = ? AND tier = ? AND start = ?".format(self._table),
+                                       (asset, tier, start)).fetchone()
+        return Partial.fromState(json.loads(row[0])) if row else None
+
+    def latest(self, asset):
+        """
+        :return: a tuple (start, Partial object) for the newest slot of the finest tier, None if there is none.
+        """
+        with self._lock:
+            row = self._open().execute("SELECT start, value FROM {} WHERE asset = ? AND tier = 0 ORDER BY start DESC LIMIT 1".format(self._table),
+                                       (asset,)).fetchone()
+        return (row[0], Partial.fromState(json.loads(row[1]))) if row else None
+
+    def saveMany(self, asset, slots):
+        """
+        stores the slots of the finest tier of an asset in 1 transaction.
+        :param asset: the id of the asset
+        :param slots: a list of (start, Partial object) tuples.
+        :return: None
+        """
+        data = [(asset, 0, start, encode(partial)) for start, partial in slots]
+        with self._lock:
+            db = self._open()
+            db.executemany("INSERT OR REPLACE INTO {} (asset, tier, start, value) VALUES (?, ?, ?, ?)".format(self._table), data)
+            db.commit()
+
+    def query(self, asset, start, end):
+        """
+        merges all the slots of an asset that start in the period, from all the tiers.
+        :param asset: the id of the asset
+        :param start: the start of the period, nr of seconds since the epoch.
+        :param end: the end of the period (not included), None = no end.
+        :return: a Partial object
+        """
+        with self._lock:
+            if end is None:
+                rows = self._open().execute("SELECT value FROM {} WHERE asset = ? AND start >= ?".format(self._table), (asset, start)).fetchall()
+            else:
+                rows = self._open().execute("SELECT value FROM {} WHERE asset = ? AND start >= ? AND start < ?".format(self._table),
+                                            (asset, start, end)).fetchall()
+        result = Partial()
+        for row in rows:
+            result.merge(Partial.fromState(json.loads(row[0])))
+        return result
+
+    def compact(self, tiers, now):
+        """
+        merges the slots that are older than the retention of their tier into the slots of the next tier. The old
+        slots of the last tier are removed. Every asset is done in 1 transaction that locks the database for writing
+        from the first read, so the same slots can't be merged twice by another process that shares the database.
+        :param tiers: the list of Tier objects, finest first.
+        :param now: nr of seconds since the epoch.
+        :return: the nr of slots that were compacted or removed.
+        """
+        result = 0
+        for index, tier in enumerate(tiers):
+            cutoff = now - tier.retention
+            with self._lock:
+                assets = [row[0] for row in self._open().execute("SELECT DISTINCT asset FROM {} WHERE tier = ? AND start < ?".format(self._table),
+                                                                 (index, cutoff))]
+            for asset in assets:
+                with self._lock:
+                    db = self._open()
+                    db.execute("BEGIN IMMEDIATE")
+                    try:
+                        rows = db.execute("SELECT start, value FROM {} WHERE asset = ? AND tier = ? AND start < ?".format(self._table),
+                                          (asset, index, cutoff)).fetchall()
+                        if index + 1 < len(tiers):
+                            merged = {}
+                            for start, value in rows:
+                                slot = tiers[index + 1].getStart(start)
+                                partial = merged.get(slot)
+                                if partial is None:
+                                    row = db.execute("SELECT value FROM {} WHERE asset = ? AND tier = ? AND start = ?".format(self._table),
+                                                     (asset, index + 1, slot)).fetchone()
+                                    partial = merged[slot] = Partial.fromState(json.loads(row[0])) if row else Partial()
+                                partial.merge(Partial.fromState(json.loads(value)))
+                            db.executemany("INSERT OR REPLACE INTO {} (asset, tier, start, value) VALUES (?, ?, ?, ?)".format(self._table),
+                                           [(asset, index + 1, slot, encode(partial)) for slot, partial in merged.items()])
+                        db.execute("DELETE FROM {} WHERE asset = ? AND tier = ? AND start < ?".format(self._table), (asset, index, cutoff))
+                        db.commit()
+                    except:
+                        db.rollback()
+                        raise
+                result += len(rows)
+        return result
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+
+def _toNumber(value):
+    return int(value) if isinstance(value, bool) else value
+
+
+class AssetRollup(object):
+    """
+    records the values of 1 asset in slots of the finest tier, once for all the groups of the asset. The open slot is
+    kept in memory and only stored when it ends, on the tick of the rollups (see flush) and before a reset of the
+    groups, so a crash loses at most settings.RollupTick seconds of values. When a slot ends, the groups that are derived from the rollup
+    (RollupStatistician objects) get it's summary, so they are updated once per slot instead of once per value.
+    """
+
+    def __init__(self, assetId, store, tiers, histogram=None):
+        """
+        create the object
+        :param assetId: the id of the asset.
+        :param store: the RollupStore object.
+        :param tiers: the list of Tier objects, finest first.
+        :param histogram: (bucket size, origin, low, high) of the distribution, None if no group needs one.
+        """
+        self.assetId = assetId
+        self.groups = []                                                # the RollupStatistician objects that are derived from this rollup.
+        self.last = None                                                # the last value of the asset.
+        self._store = store
+        self._resolution = tiers[0].resolution
+        self._retention = tiers[0].retention
+        self._histogram = histogram
+        self._start = None                                              # start of the newest slot.
+        self._partial = None                                            # the summary of the newest slot.
+        self._isOpen = False                                            # False when the newest slot has ended and the groups have it.
+        self._changed = False                                           # True when the open slot has values that are not stored yet.
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _newPartial(self):
+        if not self._histogram:
+            return Partial()
+        size, origin, low, high = self._histogram
+        return Partial(Histogram(size, origin, 'l', low, high))
+
+    def _load(self):
+        latest = self._store.latest(self.assetId)
+        if latest:
+            self._start, self._partial = latest
+            self._isOpen = True                                         # if it has ended, it's closed with the next value or tick.
+        self._loaded = True
+
+    def _close(self):
+        self._isOpen = False
+        self._notify(self._start, self._partial, None)
+
+    def _notify(self, start, partial, openStart):
+        for group in self.groups:
+            try:
+                group.slotClosed(start, partial, openStart)
+            except:
+                logging.exception("failed to update group {} from the rollup".format(group.getStateKey()))
+
+    def _flush(self, dirty):
+        if dirty:
+            self._store.saveMany(self.assetId, list(dirty.items()))
+            dirty.clear()
+
+    def _saveOpen(self, dirty):
+        """
+        stores the open slot if it changed, together with the other slots in 'dirty'.
+        :return: None
+        """
+        if self._changed:
+            dirty[self._start] = self._partial
+            self._changed = False
+        self._flush(dirty)
+
+    def _add(self, value, timestamp, dirty):
+        """
+        adds a value to it's slot, the slots that change are collected in 'dirty' (start -> Partial). They are stored
+        before the groups are notified, so that groups that rebuild their values from the store see them.
+        :return: None
+        """
+        value = _toNumber(value)
+        start = self._resolution * math.floor(timestamp / self._resolution)
+        if not self._loaded:
+            self._load()
+        if self._start is None or start > self._start:
+            if self._isOpen:
+                self._saveOpen(dirty)
+                self._close()
+            self._start, self._partial, self._isOpen = start, self._newPartial(), True
+        elif start < self._start or not self._isOpen:                   # a late value: the groups already have the slot.
+            if timestamp < time.time() - self._retention:
+                logging.warning("value of {} at {} is older than the rollup retention, ignored".format(self.assetId, timestamp))
+                return
+            partial = dirty.get(start) or self._store.load(self.assetId, 0, start) or self._newPartial()
+            partial.add(value)
+            dirty[start] = partial
+            self._flush(dirty)
+            single = self._newPartial()
+            single.add(value)
+            self._notify(start, single, self._start if self._isOpen else None)
+            return
+        self._partial.add(value)
+        self._changed = True                                            # stored when the slot ends or on the next tick, not for every value.
+        self.last = value
+
+    def add(self, value, valueAt):
+        """
+        records a value of the asset.
+        :param value: the value (number or boolean).
+        :param valueAt: the timestamp of the value: iso formatted string, nr of seconds since the epoch or None (= now).
+        :return: None
+        """
+        timestamp = getTime(valueAt)
+        with self._lock:
+            dirty = {}
+            self._add(value, timestamp, dirty)
+            self._flush(dirty)
+
+    def addMany(self, readings):
+        """
+        records a list of values, the slots are stored once, not for every value.
+        :param readings: a list of Reading objects, with their time (see rules.calculateBatch).
+        :return: None
+        """
+        readings = sorted(readings, key=lambda x: x.time)
+        with self._lock:
+            dirty = {}
+            for reading in readings:
+                self._add(reading.value, reading.time, dirty)
+            self._flush(dirty)
+
+    def closeEnded(self, now):
+        """
+        closes the newest slot if it has ended, so the groups are also updated when no new values arrive. An open slot
+        that changed is stored.
+        :param now: nr of seconds since the epoch.
+        :return: None
+        """
+        with self._lock:
+            self._saveOpen({})
+            if self._isOpen and self._start + self._resolution <= now:
+                self._close()
+
+    def flush(self):
+        """
+        stores the open slot if it changed. Don't call this while a group of the rollup is locked.
+        :return: None
+        """
+        with self._lock:
+            self._saveOpen({})
+
+
+class Rollups(object):
+    """
+    all the asset rollups of the service. A single thread closes the slots that have ended and compacts the store.
+    """
+
+    def __init__(self, store, tiers):
+        """
+        create the object
+        :param store: the RollupStore object
+        :param tiers: the list of Tier objects, finest first.
+        """
+        self.store = store
+        self.tiers = tiers
+        self._rollups = {}                                              # asset id -> AssetRollup
+        self._lock = threading.Lock()
+        self._thread = None
+        self._lastCompact = time.time()
+        self.compactCount = 0
+        self.compactedSlots = 0
+        self.lastCompactTime = 0
+
+    def create(self, assetId, histogram=None):
+        """
+        creates the rollup of an asset. It's slots are only closed once it has been added.
+        :param assetId: the id of the asset
+        :param histogram: (bucket size, origin, low, high) of the distribution, None if no group needs one.
+        :return: an AssetRollup object
+        """
+        return AssetRollup(assetId, self.store, self.tiers, histogram)
+
+    def add(self, rollup):
+        """
+        starts closing the slots of the rollup, it replaces the previous one of the asset (the definition has changed).
+        :param rollup: an AssetRollup object
+        :return: None
+        """
+        with self._lock:
+            self._rollups[rollup.assetId] = rollup
+        if not self._thread:
+            self.start()
+
+    def remove(self, rollup):
+        """
+        stops closing the slots of the rollup, if it hasn't been replaced yet.
+        :param rollup: an AssetRollup object
+        :return: None
+        """
+        with self._lock:
+            if self._rollups.get(rollup.assetId) is rollup:
+                del self._rollups[rollup.assetId]
+        rollup.flush()
+
+    def flushAll(self):
+        """
+        stores the open slots that changed, used when the service stops.
+        :return: None
+        """
+        with self._lock:
+            rollups = list(self._rollups.values())
+        for rollup in rollups:
+            rollup.flush()
+
+    def tick(self, now):
+        """
+        closes the slots that have ended and compacts the store every settings.RollupCompactInterval seconds.
+        :param now: nr of seconds since the epoch.
+        :return: None
+        """
+        with self._lock:
+            rollups = list(self._rollups.values())
+        for rollup in rollups:
+            rollup.closeEnded(now)
+        if rollups and now - self._lastCompact >= settings.RollupCompactInterval:     # only the process that records the rollups compacts them.
+            self._lastCompact = now
+            start = time.time()
+            self.compactedSlots += self.store.compact(self.tiers, now)
+            self.compactCount += 1
+            self.lastCompactTime = time.time() - start
+
+    def _run(self):
+        while True:
+            time.sleep(settings.RollupTick)
+            try:
+                self.tick(time.time())
+            except:
+                logging.exception("failed to update the rollups")
+
+    def start(self):
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name="rollups")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def metrics(self):
+        """
+        :return: a dict with the nr of assets and statistics about the compaction.
+        """
+        with self._lock:
+            return {'assets': len(self._rollups), 'compactions': self.compactCount, 'compactedSlots': self.compactedSlots,
+                    'lastCompactTime': self.lastCompactTime}
+
+
+rollups = Rollups(RollupStore(settings.StateStore), getTiers())
+
+
+class RollupStatistician(Statistician):
+    """
+    a group that is derived from the rollup of the asset instead of calculating it's functions for every value. The
+    current values are updated when a slot of the rollup ends, the history values are the merge of the slots of the
+    period that ended. So a group costs nothing per value and a little per slot. Needs a reset. Supported functions:
+    count, min, max, avg, std and dist.
+    """
+
+    __slots__ = ('_rollup', '_period', '_running', '_end')
+    supported = ['count', 'min', 'max', 'avg', 'std', 'dist']
+
+    def __init__(self, name, functions, resetEvery, startDate, asset, rollup, publisher=None, tenant=None):
+        """
+        create object
+        :param functions: a list of 'function' objects, the functions that can't be derived from a rollup are ignored.
+        :param resetEvery: the period of the group: 'year:month:week:day:hour:minute'.
+        :param asset: an Asset object or id string that this statistician should calculate values for.
+        :param rollup: the AssetRollup object of the asset.
+        :param publisher: the Publisher object that sends the results to the platform.
+        :param tenant: the username of the definition, used as label of the metrics.
+        """
+        for function in functions:
+            if function['function'] not in self.supported:
+                logging.warning("function '{}' can't be derived from a rollup, ignored in group '{}'".format(function['function'], name))
+        Statistician.__init__(self, name, [x for x in functions if x['function'] in self.supported], resetEvery, startDate, asset, publisher, tenant)
+        self._rollup = rollup
+        self._period = getPeriod(resetEvery, self.startDate)
+        self._running = None                                            # Partial object with the summary of the current period, rebuilt from the store when None.
+        self._end = None                                                # end of the current period, nr of seconds since the epoch.
+
+    @staticmethod
+    def getHistogram(functions, asset):
+        """
+        :param functions: the list of 'function' objects of a group.
+        :param asset: the asset that is monitored.
+        :return: (bucket size, origin, low, high) for the distribution of the rollup, None if the group has no 'dist'.
+        """
+        for function in functions:
+            if function['function'] == 'dist':
+                if asset.profile['type'] == 'boolean':
+                    return 1, 0, 0, 1
+                return function.get('bucketsize', 1), function.get('min', 0), function.get('min'), function.get('max')
+        return None
+
+    def _loadState(self):
+        state = store.load(self.getStateKey()) or {}
+        if 'start' not in state:
+            state['start'] = _timestamp(self._period.previous(datetime.datetime.now(tz.tzutc())))
+        return state
+
+    def _getEnd(self):
+        if self._end is None:
+            start = datetime.datetime.fromtimestamp(self.state['start'], tz.tzutc())
+            self._end = _timestamp(self._period.next(start))
+        return self._end
+
+    def _publishAll(self, partial):
+        for function in self._pipeline:
+            if function.name == 'count':
+                self.publish('count', partial.count)
+            elif function.name == 'avg':
+                self.publish('avg', partial.moments.mean)
+            elif function.name == 'std':
+                self.publish('std', partial.moments.std)
+            elif function.name == 'dist':
+                self.publish('dist', partial.hist.toList() if partial.hist else [])
+            elif function.name in ('min', 'max'):
+                value = partial.min if function.name == 'min' else partial.max
+                if value is not None:
+                    self.publish(function.name, value)
+
+    def slotClosed(self, start, partial, openStart):
+        """
+        called by the rollup when a slot has ended or when a late value arrived, updates and publishes the current values.
+        :param start: the start of the slot, nr of seconds since the epoch.
+        :param partial: the Partial object with the values that weren't given to the group yet.
+        :param openStart: the start of the slot that is still open, None if there is none.
+        :return: None
+        """
+        with self._lock:
+            end = self._getEnd()
+            if self._running is None:
+                self._running = rollups.store.query(self._rollup.assetId, self.state['start'], min(end, openStart) if openStart else end)
+            elif self.state['start'] <= start < end:
+                self._running.merge(partial)
+            else:
+                return
+            self._publishAll(self._running)
+
+    def calculate(self, asset):
+        pass                                                            # the value is recorded once for all the groups, by the rollup of the asset.
+
+    def correct(self, asset):
+        pass                                                            # the rollup puts late values in their own slot.
+
+    def calculate_batch(self, readings):
+        pass
+
+    def reset(self):
+        self._rollup.flush()                                            # the values of the open slot belong to the history, stored before the group is locked.
+        return Statistician.reset(self)
+
+    def resetValues(self):
+        self._rollup.flush()
+        Statistician.resetValues(self)
+
+    def _reset(self):
+        state = self.state
+        end = _timestamp(self._period.previous(datetime.datetime.now(tz.tzutc())))
+        if end <= state['start']:
+            return
+        history = rollups.store.query(self._rollup.assetId, state['start'], end)
+        for function in self._pipeline:
+            if function.name == 'count':
+                self.publish('countHistory', history.count)
+                self.publish('count', 0)
+            elif function.name == 'avg':
+                self.publish('avgHistory', history.moments.mean)
+                self.publish('avg', 0)
+            elif function.name == 'std':
+                self.publish('stdHistory', history.moments.std)
+                self.publish('std', 0)
+            elif function.name == 'dist':
+                self.publish('distHistory', history.hist.toList() if history.hist else [])
+                self.publish('dist', [])
+            elif function.name in ('min', 'max'):
+                self.publish(function.name + 'History', history.min if function.name == 'min' else history.max)
+                if self._rollup.last is not None:
+                    self.publish(function.name, self._rollup.last)
+        state['start'] = end
+        self._end = None
+        self._running = None
@@ -11,12 +11,24 @@ from att_event_engine.when import When
 from att_trusted_event_server.when_server import appendToMonitorList
 from att_event_engine.resources import Sensor, Asset
 from att_event_engine.timer import Timer
-from att_event_engine.att import HttpClient
 from dateutil.relativedelta import relativedelta
-import os
-import json
+import logging
 
-from statistician import Statistician
+from statistician import Statistician, Reading
+from windows import WindowStatistician, getTime
+from rollup import RollupStatistician, rollups
+from publisher import Publisher, flusher
+from registry import definitions
+from statestore import store
+from provisioning import manifest
+from timers import registrar
+from scheduler import scheduler
+from shards import engine
+from ingest import ingest
+from metrics import metrics
+from admission import admission, Apply, Correct
+import settings
+import connections
 
 
 def getSec(str, startDate):
@@ -45,9 +57,37 @@ def getSec(str, startDate):
     #return result.total_seconds()
 
 
-def loadDefinition(name):
-    with open(os.path.join('definitions', name)) as f:  # load the definitions for this asset
-        return json.load(f)
+def getStats(assetId):
+    """
+    get the statistics object for the asset, ready to be used on the event path.
+    :param assetId: the id of the asset
+    :return: an AssetStats object or None if there is no definition for the asset.
+    """
+    definition = definitions.get(assetId)
+    if not definition:
+        logging.warning("no statistics definition found for asset: {}".format(assetId))
+        return None
+    connection = connections.events.get(definition['username'], definition['pwd'], definition.get('api'))
+    stats = definitions.getStats(assetId)
+    if not stats:                                           # only build the groups once per definition, not for every event.
+        with definitions.getLock(assetId):
+            stats = definitions.getStats(assetId)
+            if not stats:
+                stats = AssetStats(definition, connection)
+                stats.takeOver()
+                definitions.set(definition, stats)
+                stats.schedule()                            # like a registered definition: the groups still have to be reset.
+    stats.asset.connection = connection                     # the connection can have been refreshed since the stats were built.
+    return stats
+
+
+def getTenant(assetId):
+    """
+    :param assetId: the id of the asset
+    :return: the username of the definition of the asset, used as label of the metrics.
+    """
+    definition = definitions.get(assetId)
+    return definition.get('username') if definition else None
 
 
 @When([])
@@ -57,12 +97,125 @@ def calculateStatistics():
     :return:
     """
     current = Asset.current()
-    definition = loadDefinition(current.id+".json")
-    current.connection = HttpClient()
-    current.connection.connect_api(definition['username'], definition['pwd'])    # create the connection -> this is a dynamic object, so we don't yet have the connection, can be for a different user.
-    stats = AssetStats(definition, current.connection, current)
+    if not metrics.enabled:
+        return _calculateStatistics(current)
+    with metrics.timed('event', tenant=getTenant(current.id)):
+        _calculateStatistics(current)
+
+
+def _calculateStatistics(current):
+    if engine.running:                                      # another process calculates the statistics for this asset.
+        engine.dispatch(current.id, current.value, current.value_at)
+        return
+    if ingest.running:                                      # calculated by the ingest workers, so a slow asset doesn't block the others.
+        ingest.put(current.id, current.value, current.value_at)
+        return
+    stats = getStats(current.id)
+    if not stats:
+        return
+    current.connection = stats.asset.connection             # this is a dynamic object, so we don't yet have the connection, can be for a different user.
+    _calculate(stats, current.id, current)
+
+
+def _calculate(stats, assetId, reading):
+    """
+    runs the groups of the asset for a value, if the admission stage lets it through.
+    :param stats: the AssetStats object of the asset
+    :param assetId: the id of the asset
+    :param reading: the asset or Reading object with the value
+    :return: None
+    """
+    action = admission.check(assetId, reading.value, reading.value_at)
+    if action == Apply:
+        for group in stats.groups:
+            group.calculate(reading)
+    elif action == Correct:
+        for group in stats.groups:
+            group.correct(reading)
+    else:
+        return
+    if stats.rollup:
+        stats.rollup.add(reading.value, reading.value_at)  # once for all the groups that are derived from the rollup.
+
+
+def calculateValue(assetId, value, valueAt):
+    """
+    calculates the statistics for a single value of the asset, when the value didn't arrive through a platform event,
+    for instance in a worker process of the sharded engine.
+    :param assetId: the id of the asset
+    :param value: the value
+    :param valueAt: the timestamp of the value (iso formatted string)
+    :return: False if there is no definition for the asset.
+    """
+    if not metrics.enabled:
+        return _calculateValue(assetId, value, valueAt)
+    with metrics.timed('value', tenant=getTenant(assetId)):
+        return _calculateValue(assetId, value, valueAt)
+
+
+def _calculateValue(assetId, value, valueAt):
+    stats = getStats(assetId)
+    if not stats:
+        return False
+    _calculate(stats, assetId, Reading(value, valueAt))
+    return True
+
+
+def calculateBatch(assetId, values):
+    """
+    calculates the statistics for a list of values of the asset in 1 go, for instance when a gateway replays it's
+    buffered readings. The batch takes the same route as the single values of the asset (worker process, ingest
+    queue), so it doesn't overtake the values that are still waiting.
+    :param assetId: the id of the asset
+    :param values: a list of (value, timestamp) tuples.
+    :return: False if there is no definition for the asset.
+    """
+    if engine.running or ingest.running:
+        if not definitions.get(assetId):
+            return False
+        if engine.running:
+            engine.dispatchBatch(assetId, values)
+        else:
+            ingest.putBatch(assetId, values)
+        return True
+    return calculateValues(assetId, values)
+
+
+def calculateValues(assetId, values):
+    """
+    calculates the statistics for a list of values of the asset in this thread (see calculateBatch). The values pass
+    the admission stage first, so the values that were already received are dropped.
+    :param assetId: the id of the asset
+    :param values: a list of (value, timestamp) tuples.
+    :return: False if there is no definition for the asset.
+    """
+    stats = getStats(assetId)
+    if not stats:
+        return False
+    readings = [Reading(value, valueAt, _getBatchTime(valueAt)) for value, valueAt in values]   # parsed once, for all the groups.
+    readings.sort(key=lambda x: x.time)                     # in order, so the values of the batch aren't late compared to each other. Stable: the same timestamps keep their order.
+    applied = []
+    corrected = []
+    for reading in readings:
+        action = admission.check(assetId, reading.value, reading.value_at)
+        if action == Apply:
+            applied.append(reading)
+        elif action == Correct:
+            corrected.append(reading)
     for group in stats.groups:
-        group.calculate(current)
+        group.calculate_batch(applied)
+        for reading in corrected:
+            group.correct(reading)
+    if stats.rollup:
+        stats.rollup.addMany(applied + corrected)
+    return True
+
+
+def _getBatchTime(valueAt):
+    try:
+        return getTime(valueAt)
+    except (ValueError, OverflowError, TypeError):
+        return 0                                            # admission lets values with a wrong timestamp through.
 
 
 @When([])
@@ -72,28 +225,100 @@ def resetGroup():
     :return: None
     """
     timer = Timer.current()
-    timer.set(getSec(timer.group.resetEvery, timer.group.startDate))  # restart the timer. do this first, so we get best possible timing.
+    registrar.add(timer, lambda: getSec(timer.group.resetEvery, timer.group.startDate), timer.group.tenant)  # restart the timer. do this first, so we get best possible timing.
     timer.group.resetValues()
 
 
+def _getOutputNames(groups):
+    return set(name for group in groups for name in group.getOutputNames())
+
+
+class ForwardedStats(object):
+    """
+    the definition of an asset of which the statistics are calculated by a worker of the sharded engine. This process
+    only monitors the asset and forwards it's values to the worker, so it doesn't keep any groups, publisher or resets
+    for it: the worker builds them (see worker.define).
+    """
+    def __init__(self, definition, connection):
+        """
+        create the object
+        :param definition: a json dict that contains the definition for the stats.
+        :param connection: the connection to use
+        """
+        self.asset = Sensor(definition['asset'], connection=connection)
+        self.definition = definition
+        self.groups = []
+        self.added = []
+        self.rollup = None
+
+    def takeOver(self):
+        pass
+
+    def close(self):
+        pass
+
+    def register(self):
+        appendToMonitorList(calculateStatistics, self.asset)
+
+
 class AssetStats(object):
     """
     wraps a single asset statistics definition. This object contains all the groupings that are defined and which
      should be calculated whenever the value of the asset to be monitored, changes.
+    When the definition is updated, the new object is built from the previous one: the groups that didn't change are
+    reused as they are, the groups that changed continue with the values of their functions that didn't change (see
+    Statistician.takeOver) and only the timers of new groups or groups with a new reset are set.
     """
-    def __init__(self, definition, connection, asset=None):
+    def __init__(self, definition, connection, asset=None, previous=None):
         """
         create the object
         :param connection: the connection to use
         :param asset: the asset object, if none, the object will be created from the definition,
         :param definition: a json dict that contains the definition for the stats. (see examples in definitions dir)
+        :param previous: the AssetStats object of the previous version of the definition, if any. Call takeOver
+        before the new object is used by the event path.
         """
-        if not asset:
+        if previous and all(previous.definition.get(x) == definition.get(x) for x in ('username', 'pwd', 'api')):
+            self.asset = previous.asset                             # the groups that are kept, use the same asset.
+        elif not asset:
             self.asset = Sensor(definition['asset'], connection=connection)
         else:
             self.asset = asset
+        self.definition = definition
+        self.successor = None                                       # the object that replaced this one, see close.
+        self.scheduled = False                                      # True when the resets of the groups have been scheduled.
+        self._previous = previous
+        self._replaced = []                                         # (previous group, new group) for the groups that changed.
+        self._armed = set()                                         # the groups and timers of which the resets are already scheduled.
+        self._moved = []                                            # (timer, new group) for the timers of the groups that changed.
+        self.added = []                                             # the groups that are new or changed, their assets have to be created.
+        prevGroups = {}                                             # group name -> (group definition, Statistician, Timer)
+        if previous:
+            timers = dict((timer.group, timer) for timer in previous.timers)
+            for group, stat in zip(previous.definition['groups'], previous.groups):
+                prevGroups[group['name']] = (group, stat, timers.get(stat))
+        if previous and previous.definition.get('publish') == definition.get('publish') and previous.definition.get('username') == definition.get('username'):
+            self.publisher = previous.publisher
+        else:
+            self.publisher = Publisher.fromDefinition(definition)
+            flusher.add(self.publisher)
         self.groups = []
         self.timers = []
+        self.rollup = None                                          # records the values once for all the groups with 'rollup'.
+        self._histogram = None
+        self._rollupGroups = None                                   # the groups of a rollup that is reused, they replace it's groups in takeOver.
+        rollupGroups = [group for group in definition['groups'] if group.get('rollup')]
+        if rollupGroups:
+            histograms = [RollupStatistician.getHistogram(group['calculate'], self.asset) for group in rollupGroups]
+            histograms = [x for x in histograms if x]
+            if len(set(histograms)) > 1:
+                logging.warning("the rollup groups of {} have different dist parameters, the first ones are used".format(definition['name']))
+            self._histogram = histograms[0] if histograms else None
+            if previous and previous.rollup and previous._histogram == self._histogram:
+                self.rollup = previous.rollup
+                self._rollupGroups = []
+            else:
+                self.rollup = rollups.create(self.asset.id, self._histogram)
         groupNames = set()                                          # used to check that all the groupnames are unique, otherwise, we have an issue.
         for group in definition['groups']:
             groupname = group['name']
@@ -103,19 +328,119 @@ class AssetStats(object):
 
             reset = group['reset'] if 'reset' in group else None
             startDate = group['start date'] if 'start date' in group else None
-            stat = Statistician(group['name'], group['calculate'], reset, startDate, self.asset)
+            prevGroup, prevStat, prevTimer = prevGroups.get(groupname, (None, None, None))
+            if prevGroup == group and self.asset is previous.asset and prevStat.publisher is self.publisher and (not group.get('rollup') or self._rollupGroups is not None):
+                stat = prevStat                                     # unchanged: keeps it's values and it's timer.
+                if previous.scheduled:
+                    self._armed.add(stat)
+            elif 'window' in group:
+                if reset:
+                    raise Exception("group '{}' in {} can't have both a reset and a window".format(groupname, definition['name']))
+                stat = WindowStatistician(group['name'], group['calculate'], group['window'], group.get('resolution'), self.asset, self.publisher, definition.get('username'))
+            elif group.get('rollup'):
+                if not reset:
+                    raise Exception("group '{}' in {} is derived from the rollup, it needs a reset".format(groupname, definition['name']))
+                stat = RollupStatistician(group['name'], group['calculate'], reset, startDate, self.asset, self.rollup, self.publisher, definition.get('username'))
+            else:
+                stat = Statistician(group['name'], group['calculate'], reset, startDate, self.asset, self.publisher, definition.get('username'))
+            if stat is not prevStat:
+                self.added.append(stat)
+                if prevStat:
+                    self._replaced.append((prevStat, stat))
+                    if previous.scheduled and prevGroup.get('reset') == reset and prevGroup.get('start date') == startDate:
+                        self._armed.add(stat)                       # the reset is moved to the new group in takeOver.
+            if group.get('rollup'):
+                if self._rollupGroups is not None:
+                    self._rollupGroups.append(stat)
+                else:
+                    self.rollup.groups.append(stat)
             self.groups.append(stat)
-            if "reset" in group:
-                timer = Timer(self.asset, group['name'])
+            if "reset" in group and settings.UseRemoteTimers:
+                if prevTimer and stat in self._armed:
+                    timer = prevTimer
+                    self._armed.add(timer)
+                    if stat is not prevStat:
+                        self._moved.append((timer, stat))           # it's group is replaced in takeOver.
+                else:
+                    timer = Timer(self.asset, group['name'])
+                    timer.group = stat
                 self.timers.append(timer)
-                timer.group = stat
+
+    def takeOver(self):
+        """
+        hands the values, timers and resets of the previous version of the definition over to this object and
+        starts the rollup. Call this right before the object is used by the event path (see DefinitionRegistry.set):
+        values that still arrive at the previous object are calculated once, in the state that is now shared by both.
+        :return: None
+        """
+        if self.rollup and self._rollupGroups is None:
+            rollups.add(self.rollup)                                # a new rollup, replaces the one of the previous object.
+        previous = self._previous
+        replaced, moved, added = self._replaced, self._moved, self.added
+        self._replaced = self._moved = self.added = None            # only needed until now, there can be a lot of these objects.
+        if not previous:
+            return
+        dropped = _getOutputNames(previous.groups).difference(_getOutputNames(self.groups))   # before the changed groups take over the functions that are kept.
+        for prevStat, stat in replaced:
+            stat.takeOver(prevStat)
+            if stat in self._armed and not settings.UseRemoteTimers:
+                scheduler.replace(prevStat, stat)
+        for timer, stat in moved:
+            timer.group = stat
+        if self._rollupGroups is not None:
+            self.rollup.groups = self._rollupGroups
+        previous.successor = self
+        if dropped:
+            manifest.forget(self.asset.id, dropped)             # they are created again if the groups or functions come back.
+        logging.info("updated definition {}: {} groups kept, {} changed, {} added, {} removed".format(
+            self.definition['name'], len(self.groups) - len(added), len(replaced),
+            len(added) - len(replaced), len(previous.groups) - len(self.groups) + len(added) - len(replaced)))
+        self._previous = None
+
+    def close(self):
+        """
+        called when the object is no longer used (the definition has changed): sends the remaining values to the
+        platform. The parts that were taken over by the object that replaced it, are left running.
+        :return: None
+        """
+        successor = self.successor
+        registrar.remove([x for x in self.timers if not successor or x not in successor.timers])
+        removed = [x for x in self.groups if not successor or x not in successor.groups]
+        scheduler.remove(removed)
+        if removed:
+            store.flush()                                           # a group with the same name that is built later, loads it's last values from the store.
+        if not successor or successor.publisher is not self.publisher:
+            flusher.remove(self.publisher)
+        if self.rollup and (not successor or successor.rollup is not self.rollup):
+            rollups.remove(self.rollup)
 
     def register(self):
+        """
+        monitors the asset for changes and schedules the resets of the groups. When the sharded engine is running,
+        the resets are scheduled by the worker process that owns the asset.
+        :return: None
+        """
+        appendToMonitorList(calculateStatistics, self.asset)
+        if not engine.running:
+            self.schedule()
+
+    def schedule(self):
+        """
+        schedules the resets of the groups, except the ones that are still scheduled by the previous version of the
+        definition (see takeOver).
+        :return: None
+        """
         def registerTimer(timer):
             appendToMonitorList(resetGroup, timer)
-            success = timer.set(getSec(timer.group.resetEvery, timer.group.startDate))
-            while not success:                  # when we are starting up and on the same server or at the same time, other service could still be starting up, give it some time. Also, no need to try indefinetely.
-                success = timer.set(getSec(timer.group.resetEvery, timer.group.startDate))
-                #todo: don't get stuck indefinetely, but stop or something.
-        appendToMonitorList(calculateStatistics, self.asset)
-        map(lambda x: registerTimer(x), self.timers)
+            registrar.add(timer, lambda: getSec(timer.group.resetEvery, timer.group.startDate), timer.group.tenant)    # set in the background, with retries when the timer service is not yet available.
+        armed = self._armed or ()
+        if settings.UseRemoteTimers:
+            for timer in self.timers:
+                if timer not in armed:
+                    registerTimer(timer)
+        else:
+            for group in self.groups:
+                if group.resetEvery and group not in armed:
+                    scheduler.add(group)
+        self.scheduled = True
+        self._armed = None
@@ -0,0 +1,324 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import time
+import heapq
+import logging
+import datetime
+import threading
+
+import dateutil.parser
+from dateutil import tz
+from dateutil.relativedelta import relativedelta
+
+import settings
+from statestore import StateStore
+from statistician import resetAll
+from publisher import flusher
+
+
+def getTimeZone():
+    """
+    :return: the time zone that is used for start dates without time zone info, from settings.TimeZone or the local time zone of the server.
+    """
+    return tz.gettz(settings.TimeZone) if settings.TimeZone else tz.tzlocal()
+
+
+class Period(object):
+    """
+    a repeating time period, expressed as 'year:month:week:day:hour:minute', that starts at a fixed point in time.
+    The boundaries are calculated from the start date with calendar arithmetic (the n-th boundary is start + n * period),
+    so they don't drift: a monthly period that starts on the 31st stays at the end of the month and a daily period
+    stays at the same hour of the day, also when the daylight saving time changes.
+    """
+
+    def __init__(self, value, startDate=None):
+        """
+        create the object
+        :param value: the period as a string: 'year:month:week:day:hour:minute'
+        :param startDate: datetime or string, a boundary of the period. When it has no time zone, settings.TimeZone is
+        used. When None, settings.PeriodOrigin is used, so that, for instance, daily periods end at midnight.
+        """
+        values = [int(x) for x in value.split(':')]
+        self.calendar = (values[0], values[1], values[2], values[3])    # years, months, weeks, days: done on the wall clock
+        self.clock = (values[4], values[5])                             # hours, minutes: done in absolute time
+        self._approx = ((values[0] * 365.2425 + values[1] * 30.436875 + values[2] * 7 + values[3]) * 86400
+                        + values[4] * 3600 + values[5] * 60)           # nr of seconds, to find the nr of periods without iterating.
+        if self._approx <= 0:
+            raise ValueError("invalid period: {}".format(value))
+        if not startDate:
+            startDate = settings.PeriodOrigin
+        if not isinstance(startDate, datetime.datetime):
+            startDate = dateutil.parser.parse(startDate)
+        if not startDate.tzinfo:
+            startDate = startDate.replace(tzinfo=getTimeZone())
+        self.start = startDate
+
+    def getBoundary(self, n):
+        """
+        :param n: the index of the boundary, 0 is the start date, can be negative.
+        :return: an aware datetime
+        """
+        years, months, weeks, days = self.calendar
+        result = self.start + relativedelta(years=n * years, months=n * months, weeks=n * weeks, days=n * days)
+        hours, minutes = self.clock
+        if hours or minutes:                                            # kept in utc, so that times that occur twice when the clock goes back, stay distinct.
+            result = result.astimezone(tz.tzutc()) + datetime.timedelta(hours=n * hours, minutes=n * minutes)
+        return result
+
+    def _getIndex(self, moment):
+        """
+        :return: the index of the last boundary that is at or before the moment.
+        """
+        n = int((moment - self.start).total_seconds() // self._approx)
+        while self.getBoundary(n) > moment:
+            n -= 1
+        while self.getBoundary(n + 1) <= moment:
+            n += 1
+        return n
+
+    def previous(self, moment):
+        """
+        :param moment: an aware datetime
+        :return: the last boundary at or before the moment.
+        """
+        return self.getBoundary(self._getIndex(moment))
+
+    def next(self, moment):
+        """
+        :param moment: an aware datetime
+        :return: the first boundary after the moment.
+        """
+        return self.getBoundary(self._getIndex(moment) + 1)
+
+
+_periods = {}                                                           # (value, start date) -> Period
+
+
+def getPeriod(value, startDate=None):
+    """
+    the Period objects don't change, so all the groups with the same reset and start date share 1 object.
+    :param value: the period as a string: 'year:month:week:day:hour:minute'
+    :param startDate: datetime or string, a boundary of the period, see Period.
+    :return: a Period object
+    """
+    key = (value, startDate)
+    result = _periods.get(key)
+    if result is None:
+        result = _periods.setdefault(key, Period(value, startDate))
+    return result
+
+
+class _Entry(object):
+    """
+    a group that is scheduled.
+    """
+    __slots__ = ('group', 'period', 'last', 'due')
+
+    def __init__(self, group, period, last):
+        self.group = group
+        self.period = period
+        self.last = last                                                # the last boundary at which the group was reset.
+        self.due = period.next(last)
+
+
+class Scheduler(object):
+    """
+    resets the statistical groups at the end of their period. A single thread keeps 1 heap with the next boundary of
+    all the groups. All the groups that share the same boundary (like all daily groups at midnight) are reset in 1
+    batch. The last boundary of every group is stored, so that a reset that was missed while the service was down, is
+    done as soon as the group is scheduled again. When more then 1 period was missed, they are collapsed into 1 reset:
+    the values of all the missed periods go to the history of the last one, the periods before it get no history.
+    A batch that fails is tried again after settings.ResetRetryDelay seconds, the thread keeps running.
+    """
+
+    def __init__(self, store):
+        """
+        create the object
+        :param store: StateStore in which the last boundary of every group is stored.
+        """
+        self._store = store
+        self._queue = []                                                # heap of (due timestamp, seq nr, entry)
+        self._seq = 0
+        self._entries = {}                                              # group key -> entry
+        self._condition = threading.Condition()
+        self._thread = None
+        self.resetCount = 0
+        self.catchUpCount = 0
+        self.batchCount = 0
+        self.lastBatchSize = 0
+        self.lastBatchTime = 0                                          # duration of the last batch, in seconds.
+        self.maxBatchTime = 0
+        self.totalResetTime = 0
+        self.lastBacklog = 0                                            # nr of values that the last batch left to be sent to the platform.
+        self.maxLag = 0                                                 # max nr of seconds between a boundary and the moment that it was handled.
+
+    def add(self, group):
+        """
+        schedule the resets of a group.
+        :param group: a Statistician object with a 'resetEvery' value.
+        :return: None
+        """
+        period = getPeriod(group.resetEvery, group.startDate)
+        key = group.getStateKey()
+        now = datetime.datetime.now(tz.tzutc())
+        last = self._store.load(key)
+        if last:
+            last = dateutil.parser.parse(last)
+        else:
+            last = period.previous(now)                                 # first time: the current period started at the last boundary.
+            self._store.save(key, last.isoformat())                     # so a reset that is missed before the first one is done, is also caught up.
+        entry = _Entry(group, period, last)
+        with self._condition:
+            self._entries[key] = entry
+            self._push(entry)
+            self._condition.notify()
+        if not self._thread:
+            self.start()
+
+    def replace(self, previous, group):
+        """
+        moves the schedule of a group to the group that replaces it (the definition has changed but the reset of the
+        group didn't), so that the next boundary stays the same.
+        :param previous: the Statistician object that is scheduled.
+        :param group: the Statistician object that replaces it, with the same state key.
+        :return: None
+        """
+        with self._condition:
+            entry = self._entries.get(previous.getStateKey())
+            if entry and entry.group is previous:
+                entry.group = group
+
+    def remove(self, groups):
+        """
+        stop the resets of the groups.
+        :param groups: a list of Statistician objects.
+        :return: None
+        """
+        with self._condition:
+            for group in groups:
+                key = group.getStateKey()
+                entry = self._entries.get(key)
+                if entry and entry.group is group:
+                    del self._entries[key]
+
+    def _push(self, entry, due=None):
+        self._seq += 1
+        heapq.heappush(self._queue, (due or _timestamp(entry.due), self._seq, entry))
+
+    def start(self):
+        with self._condition:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name="scheduler")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _next(self):
+        """
+        waits until 1 or more groups need to be reset.
+        :return: list of entries.
+        """
+        with self._condition:
+            while True:
+                now = time.time()
+                result = []
+                while self._queue and self._queue[0][0] <= now:
+                    entry = heapq.heappop(self._queue)[2]
+                    if self._entries.get(entry.group.getStateKey()) is entry:  # removed or replaced entries are skipped.
+                        result.append(entry)
+                if result:
+                    return result
+                self._condition.wait(self._queue[0][0] - now if self._queue else None)
+
+    def _run(self):
+        while True:
+            entries = self._next()
+            try:
+                self.fire(entries)
+            except:
+                logging.exception("failed to reset a batch of {} groups".format(len(entries)))
+                self._retry(entries)
+
+    def _retry(self, entries):
+        """
+        schedules the entries of a batch that failed again, after settings.ResetRetryDelay seconds. The entries that
+        already got their next boundary, were scheduled by fire.
+        """
+        now = time.time()
+        with self._condition:
+            for entry in entries:
+                if _timestamp(entry.due) <= now and self._entries.get(entry.group.getStateKey()) is entry:
+                    self._push(entry, now + settings.ResetRetryDelay)
+
+    def fire(self, entries):
+        """
+        resets a batch of groups and schedules their next boundary. When more then 1 period was missed (the service
+        was down), the group is reset once and scheduled at the first boundary in the future. The publishers of the groups are held during the
+        reset, then released spread over settings.ResetPublishWindow seconds, so that the values of the groups are sent
+        to the platform spread over that window.
+        :param entries: the entries that are due.
+        :return: None
+        """
+        start = time.time()
+        now = datetime.datetime.now(tz.tzutc())
+        publishers = set(entry.group.publisher for entry in entries if entry.group.publisher)
+        for publisher in publishers:
+            publisher.hold(float('inf'))                                # also with a publish interval of 0: nothing is sent before the spread.
+        try:
+            groups = resetAll([entry.group for entry in entries])[0]
+        except:
+            flusher.spread(list(publishers), 0)                         # release them, the values are sent as usual.
+            raise
+        self.resetCount += len(groups)
+        boundaries = []
+        for entry in entries:
+            last = entry.period.previous(now)
+            if last != entry.due:
+                self.catchUpCount += 1                                  # more then 1 period was missed, they are handled as 1 reset.
+            else:
+                self.maxLag = max(self.maxLag, (now - entry.due).total_seconds())
+            boundaries.append((entry, last, entry.period.next(last)))
+        with self._condition:                                           # all at once, so that a failure leaves the batch for _retry.
+            for entry, last, due in boundaries:
+                entry.last = last
+                entry.due = due
+                if self._entries.get(entry.group.getStateKey()) is entry:
+                    self._push(entry)
+        self._store.saveMany([(entry.group.getStateKey(), last.isoformat()) for entry, last, due in boundaries])   # 1 transaction for the whole batch.
+        flusher.spread(list(publishers), settings.ResetPublishWindow)
+        self.batchCount += 1
+        self.lastBatchSize = len(entries)
+        self.lastBatchTime = time.time() - start
+        self.maxBatchTime = max(self.maxBatchTime, self.lastBatchTime)
+        self.totalResetTime += self.lastBatchTime
+        self.lastBacklog = sum(publisher.depth for publisher in publishers)
+
+    def metrics(self):
+        """
+        :return: a dict with the nr of scheduled groups and statistics about the resets.
+        """
+        with self._condition:
+            nextDue = self._queue[0][0] if self._queue else None
+            return {'groups': len(self._entries), 'resets': self.resetCount, 'catchUps': self.catchUpCount,
+                    'batches': self.batchCount, 'lastBatchSize': self.lastBatchSize, 'lastBatchTime': self.lastBatchTime,
+                    'maxBatchTime': self.maxBatchTime, 'totalResetTime': self.totalResetTime, 'lastBacklog': self.lastBacklog,
+                    'maxLag': self.maxLag, 'nextDue': nextDue}
+
+
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=tz.tzutc())
+
+
+def _timestamp(moment):
+    """
+    :param moment: an aware datetime
+    :return: the nr of seconds since the epoch, like time.time().
+    """
+    return (moment - _epoch).total_seconds()
+
+
+scheduler = Scheduler(StateStore(settings.StateStore, 'schedule'))
@@ -0,0 +1,173 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+# the parts of the service that are used by the web server (main.py): loading and registering the definitions,
+# starting and stopping the engine. Import this module after the IotApplication has been created.
+
+import os
+import time
+import logging
+
+import settings
+from registry import definitions
+import connections
+from publisher import flusher
+from startup import loader
+from timers import registrar, isTimerServiceAvailable
+from provisioning import manifest
+from scheduler import scheduler
+from shards import engine
+from ingest import ingest
+from rollup import rollups
+from admission import admission
+from statestore import store
+import rules
+
+
+def registerEventsForDef(definition):
+    """
+    load the statistsc object for the definition, create the assets required for the statistics and register for
+    topic events. When the asset already has a definition, only the groups that changed are rebuilt and the new
+    definition replaces the previous one in 1 step (see AssetStats.takeOver).
+    :param definition:
+    :return:
+    """
+    try:
+        with definitions.getLock(definition['asset']):              # 2 updates of the same asset would both replace the same previous object.
+            connection = connections.provisioning.get(definition['username'], definition['pwd'], definition.get('api'))
+            if engine.running:
+                obj = rules.ForwardedStats(definition, connection)  # the worker that owns the asset builds the groups and creates their assets.
+            else:
+                obj = rules.AssetStats(definition, connection, previous=definitions.getStats(definition['asset']))
+            for group in obj.added:
+                group.createAssets(connection)                  # make certain that all the assets have been created.
+            obj.takeOver()
+            definitions.set(definition, obj)                    # the event path reuses the same object, until the definition changes. Set before registering, so the first events already use it.
+            obj.register()
+            if engine.running:
+                engine.define(definition)                       # the worker that owns the asset calculates the statistics.
+            return obj
+    except:
+        logging.exception("failed to load definition: {}".format(definition))
+
+
+def loadAll():
+    """
+    loads al the known statistics defs from disc and registers them to monitor for incomming events. The
+    registration is done in the background by the startup loader: definitions become active as soon as they are
+    registered, while the others are still loading.
+    :return:
+    """
+    files = [f for f in os.listdir(settings.DefinitionsDir) if os.path.isfile(os.path.join(settings.DefinitionsDir, f))]
+    toLoad = []
+    for file in files:
+        try:
+            toLoad.append(definitions.load(file))
+        except:
+            logging.exception("failed to load def: {}".format(file))
+    loader.start(toLoad, registerEventsForDef, watchDefinitions)
+
+
+def watchDefinitions():
+    """
+    starts monitoring the definitions dir for changes, once all the definitions have been loaded.
+    :return: None
+    """
+    if settings.WatchDefinitions:
+        definitions.watch(settings.WatchInterval, registerEventsForDef, removeDefinition)
+
+
+def removeDefinition(assetId):
+    """
+    called when the definition file of an asset was removed: removes the definition from the registry and closes it's
+    statistics, so that the timers, resets, publisher and rollup of the asset stop.
+    :param assetId: the id of the asset
+    :return: None
+    """
+    try:
+        with definitions.getLock(assetId):                              # not while the definition is being updated.
+            definitions.remove(assetId)                                 # also closes the stats.
+            if engine.running:
+                engine.remove(assetId)                                  # the worker that owns the asset closes it's groups and forgets it's assets.
+            else:
+                manifest.forget(assetId)                                # the assets are created again when the definition comes back.
+        logging.info("removed definition of asset {}".format(assetId))
+    except:
+        logging.exception("failed to remove definition of asset {}".format(assetId))
+
+
+def storeDef(name, value):
+    """
+    stores the definition on disk
+    :param name: the name to use
+    :param value: the value (string)
+    :return:None
+    """
+    with open(os.path.join(settings.DefinitionsDir, name), 'w') as f:
+        f.write(value)
+
+
+def getStatus():
+    """
+    reports the state of the engine: the progress of the startup, the timers that are waiting to be set or that
+    failed, the publishers, the provisioning of the assets, the rollups and the values that were dropped or corrected
+    by the admission stage.
+    :return: a dict
+    """
+    result = {'startup': loader.metrics(), 'timers': registrar.metrics(), 'scheduler': scheduler.metrics(),
+              'publishers': flusher.metrics(), 'provisioning': manifest.metrics(), 'rollups': rollups.metrics(),
+              'admission': admission.metrics(), 'state': store.metrics()}
+    if engine.running:
+        result['shards'] = engine.metrics()
+    if ingest.running:
+        result['ingest'] = ingest.metrics()
+    return result
+
+
+def wait_for_timer_service():
+    """
+    waits until the timer service is available, with an increasing delay between 2 checks. After
+    settings.TimerServiceWaitTimeout seconds, the startup continues: timers that can't be set yet are retried in the background.
+    :return: True if the timer service is available.
+    """
+    start = time.time()
+    delay = settings.TimerRetryDelay
+    while not isTimerServiceAvailable():
+        remaining = settings.TimerServiceWaitTimeout - (time.time() - start)
+        if remaining <= 0:
+            logging.warning("timer service not available, continuing without it")
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, settings.TimerMaxRetryDelay)
+    return True
+
+
+def start():
+    """
+    starts the engine and loads the definitions.
+    :return: None
+    """
+    if settings.UseRemoteTimers:
+        wait_for_timer_service()
+    if settings.Shards > 1:
+        engine.start()
+    elif settings.IngestWorkers:
+        ingest.start(rules.calculateValue, rules.calculateValues)
+    loadAll()
+
+
+def stop():
+    """
+    finishes the work that is still waiting and sends the last values to the platform.
+    :return: None
+    """
+    engine.stop()
+    if ingest.running:
+        ingest.drain(settings.ShardStopTimeout)
+    flusher.stop()
+    rollups.flushAll()
+    store.stop()
@@ -11,4 +11,80 @@ Api = "api.smartliving.io"
 Broker = "broker.smartliving.io"
 vhost = "space-maker-vhost"
 
-HTTPPort = 2000                     #port used to upload definitions to the application.
\ No newline at end of file
+HTTPPort = 2000                     #port used to upload definitions to the application.
+HTTPDebug = False                   # when true, the web api runs in the debug mode of flask (stack traces in the responses, extra work per request). Not for production.
+
+DefinitionsDir = "definitions"      # the directory that contains the statistics definitions.
+WatchDefinitions = True             # when true, definition files that are added or changed on disk are (re)loaded automatically, the statistics of removed files are stopped.
+WatchInterval = 10                  # nr of seconds between 2 checks of the definitions directory.
+
+TokenLifetime = 3000                # nr of seconds that a login to the api is reused before a new one is done.
+ConnectionIdleTimeout = 3600        # nr of seconds that a tenant connection can be unused before it is closed.
+
+StateStore = "state/statistician.db"  # the sqlite database that holds the running values of all the statistical groups.
+StateFlushInterval = 1              # max nr of seconds before a changed state of a group is written to the StateStore, the values of this period are lost when the process crashes.
+StateFlushMaxDirty = 10000          # nr of changed group states after which they are written, even if the interval hasn't passed.
+
+PublishInterval = 5                 # default max nr of seconds that a new statistic value is held back before it is sent to the platform (0 = send immediately). Can be overwritten per definition.
+PublishMaxChanges = 100             # default nr of queued changes of a definition after which the values are sent, even if the interval hasn't passed.
+PublishTick = 1                     # nr of seconds between 2 checks for publishers that need to be flushed.
+
+Percentiles = [50, 95, 99]          # default percentiles that are calculated by the 'percentile' function.
+PercentileAccuracy = 0.01           # default relative error of the percentile estimates.
+PercentileMaxBuckets = 2048         # default max nr of buckets (per sign) of a percentile sketch, this bounds the memory per group.
+
+StartupWorkers = 16                 # max nr of definitions that are registered at the same time during startup.
+StartupTenantConcurrency = 4        # max nr of definitions of the same account that are registered at the same time during startup.
+StartupProgressInterval = 5         # nr of seconds between 2 progress messages in the log while starting up.
+
+ProvisioningCache = True            # when true, the output assets that were already created are remembered (in the StateStore database), so they are not created again at every restart.
+ProvisioningVerify = True           # when true, the remembered output assets of a monitored asset are checked against the assets of it's device (1 call) the first time they are provisioned, the missing ones are created again.
+
+TimerRetryDelay = 1                 # nr of seconds before a timer that could not be set is tried again, doubled for every next attempt.
+TimerMaxRetryDelay = 300            # max nr of seconds between 2 attempts to set a timer.
+TimerMaxAttempts = 20               # nr of attempts after which a timer is reported as failed (see /status).
+TimerProbeTimeout = 5               # nr of seconds to wait for a response of the timer service when checking if it is available.
+TimerServiceWaitTimeout = 60        # max nr of seconds to wait for the timer service at startup.
+
+UseRemoteTimers = False             # when true, every group with a reset uses a timer of the remote timer service (old behaviour), otherwise the resets are scheduled in this process.
+TimeZone = None                     # time zone for start dates without time zone info, like 'Europe/Brussels'. None = time zone of the server.
+PeriodOrigin = "2016-01-04T00:00:00"  # start date for groups that don't have one, so that days start at midnight and weeks on monday.
+ResetRetryDelay = 60                # nr of seconds before the resets of a batch that failed, are tried again.
+
+ResetPublishWindow = 30             # nr of seconds over which the values of groups that are reset at the same moment, are sent to the platform.
+PublishMaxRate = 0                  # max nr of values per second that are sent to the platform by the background publisher, 0 = no limit.
+PublishSenders = 8                  # nr of threads that send the values of the publishers to the platform, so the calls of different definitions overlap. 1 = sent by the background publisher thread itself.
+
+Shards = 1                          # nr of worker processes that calculate the statistics, each for a part of the assets. 1 = everything is done in this process.
+ShardQueueSize = 10000              # max nr of messages that can wait for a worker process, when full, the incomming events wait.
+ShardCheckInterval = 5              # nr of seconds between 2 checks for worker processes that have stopped and need to be restarted.
+ShardAckInterval = 100              # a worker reports the nr of messages it has processed after this many messages, or when it has nothing left to do.
+ShardStopTimeout = 30               # max nr of seconds to wait for the worker processes to finish their work when the service stops.
+
+IngestWorkers = 8                   # nr of threads that calculate the statistics of the incomming values, 0 = calculate in the thread that receives the event.
+IngestMaxLength = 100000            # max nr of values that can wait to be processed.
+IngestPolicy = 'block'              # what to do when IngestMaxLength is reached: 'block' (wait) or 'drop oldest'.
+IngestDrainLimit = 50               # max nr of values of 1 asset that a worker thread processes before it moves on to another asset.
+
+Metrics = True                      # when true, the latency, nr of calls and errors of the events, functions, resets and platform calls are recorded, see /metrics.
+MetricsBuckets = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]  # upper bounds (in seconds) of the buckets of the latency histograms.
+ProfilerEnabled = False             # when true, GET /profile samples the stacks of the running threads and returns the hottest ones.
+ProfilerInterval = 0.005            # nr of seconds between 2 samples of the profiler.
+ProfilerDepth = 30                  # max nr of frames per sampled stack.
+ProfilerMaxDuration = 60            # max nr of seconds that 1 profile request can sample.
+
+WindowPanes = 60                    # default nr of panes of a sliding window (group with a 'window'), the values expire per pane.
+WindowMaxPanes = 1440               # max nr of panes of a sliding window, this bounds the memory per group.
+
+RollupResolution = 60               # nr of seconds of the finest slots of the rollup store (groups with 'rollup'), their current values are updated once per slot.
+RollupRetention = 2                 # nr of days that the finest slots are kept, then they are merged into the first tier of RollupTiers.
+RollupTiers = [["0:0:0:0:1:0", 62], ["0:0:0:1:0:0", 800]]  # the coarser tiers of the rollup store: [period, nr of days]. Older slots are merged into the next tier, those of the last tier are removed.
+RollupTick = 10                     # nr of seconds between 2 checks for slots that have ended, so the groups are also updated when no new values arrive. The open slots that changed are stored at the same time.
+RollupCompactInterval = 3600        # nr of seconds between 2 compactions of the rollup store.
+
+AdmissionEnabled = True             # when true, values with the same timestamp and value as a recent value of the asset (redelivered messages, retries) are dropped before the statistics are calculated.
+AdmissionHistory = 4                # nr of recent values per asset that are remembered to recognize duplicates, also the ones that are older than the last value.
+LatePolicy = 'apply'                # what to do with values that are older than the last value of the asset: 'apply' (calculate them like the others), 'drop' or 'correct' (only the functions that don't depend on the order of the values, so not delta and distsumtime).
+PublishSkipUnchanged = True         # when true, a value that is the same as the last value of the output asset is not sent again.
+
+GroupLocks = 1024                   # nr of locks that are shared by all the statistical groups (a group only holds 1 at a time), so there is no lock object per group.
@@ -0,0 +1,296 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import os
+import sys
+import time
+import bisect
+import hashlib
+import logging
+import binascii
+import threading
+import subprocess
+from multiprocessing.connection import Listener
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import settings
+from registry import definitions
+
+ShardKeyVar = "STATISTICIAN_SHARD_KEY"                                  # environment variable used to pass the authentication key to the workers.
+
+
+def getShardPath(path, index):
+    """
+    :param path: the path of the state database of the service.
+    :param index: the index of the worker.
+    :return: the path of the state database of a worker. Every worker has it's own database, so the workers don't
+    wait for each other's writes.
+    """
+    root, ext = os.path.splitext(path)
+    return "{}-shard{}{}".format(root, index, ext)
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    consistent hashing of asset id's over a nr of shards: every shard has a set of points on a ring, an asset belongs
+    to the shard of the first point after the hash of it's id. When the nr of shards changes, only a small part of
+    the assets moves to another shard.
+    """
+
+    def __init__(self, count, replicas=64):
+        """
+        create the object
+        :param count: the nr of shards
+        :param replicas: the nr of points per shard, more points give a more even distribution.
+        """
+        points = sorted((_hash("shard-{}-{}".format(shard, i)), shard) for shard in range(count) for i in range(replicas))
+        self._keys = [key for key, shard in points]
+        self._shards = [shard for key, shard in points]
+
+    def getShard(self, assetId):
+        """
+        :param assetId: the id of the asset
+        :return: the index of the shard that owns the asset.
+        """
+        pos = bisect.bisect(self._keys, _hash(assetId)) % len(self._keys)
+        return self._shards[pos]
+
+
+class _Shard(object):
+    """
+    a worker process and the queue of messages that still need to be sent to it.
+    """
+    def __init__(self, index, queueSize):
+        self.index = index
+        self.queue = Queue(queueSize)                                   # the caller blocks when the worker can't keep up.
+        self.process = None
+        self.connection = None
+        self.synced = None                                              # the connection that received all the definitions of the shard.
+        self.condition = threading.Condition()
+        self.restarts = 0
+        self.sent = 0
+        self.unconfirmed = 0                                            # nr of messages that were sent to the worker but not yet reported as processed.
+        self.lost = 0                                                   # nr of messages that were sent to a worker that stopped before processing them.
+        self.startedAt = 0
+
+
+class ShardManager(object):
+    """
+    runs the statistical calculations in multiple worker processes (see worker.py), so that all the cores can be
+    used. Every worker owns the assets of it's part of the hash ring: it keeps their state, calculates the statistics
+    and does the resets. This process receives the events and forwards them to the worker that owns the asset. All the
+    messages for a worker go through 1 queue and connection, so the values of an asset are processed in the order in
+    which they arrived. A worker that stops is restarted and receives all of it's definitions again, the state is
+    reloaded from the state store.
+    """
+
+    def __init__(self, count, queueSize):
+        """
+        create the object
+        :param count: the nr of worker processes.
+        :param queueSize: max nr of messages that can wait for a worker.
+        """
+        self.count = count
+        self.ring = HashRing(count) if count > 1 else None
+        self._queueSize = queueSize
+        self._shards = []
+        self._listener = None
+        self._authkey = None
+        self.running = False
+
+    def start(self):
+        """
+        starts the worker processes and the threads that send them their messages.
+        :return: None
+        """
+        if settings.UseRemoteTimers:
+            raise Exception("the sharded engine can't be used together with remote timers")
+        self._authkey = os.urandom(16)
+        self._listener = Listener(('127.0.0.1', 0), authkey=self._authkey)
+        self._shards = [_Shard(i, self._queueSize) for i in range(self.count)]
+        self.running = True
+        for shard in self._shards:
+            self._startProcess(shard)
+            thread = threading.Thread(target=self._send, args=(shard,), name="shard-{}".format(shard.index))
+            thread.daemon = True
+            thread.start()
+        for target, name in [(self._accept, "shard-listener"), (self._monitor, "shard-monitor")]:
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+        logging.info("started {} shard workers".format(self.count))
+
+    def _startProcess(self, shard):
+        env = dict(os.environ)
+        env[ShardKeyVar] = binascii.hexlify(self._authkey).decode('ascii')
+        host, port = self._listener.address
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+        shard.process = subprocess.Popen([sys.executable, script, str(shard.index), str(self.count), host, str(port)], env=env)
+        shard.startedAt = time.time()
+
+    def _accept(self):
+        while self.running:
+            try:
+                connection = self._listener.accept()
+                index = connection.recv()                               # the worker announces itself with it's index.
+            except:
+                if self.running:
+                    logging.exception("failed to accept shard worker")
+                continue
+            shard = self._shards[index]
+            with shard.condition:
+                shard.connection = connection
+                shard.condition.notify_all()
+            logging.info("shard worker {} connected".format(index))
+
+    def _monitor(self):
+        while self.running:
+            time.sleep(settings.ShardCheckInterval)
+            for shard in self._shards:
+                if self.running and shard.process.poll() is not None:
+                    with shard.condition:
+                        shard.connection = None
+                        lost = shard.unconfirmed
+                        shard.lost += lost
+                        shard.unconfirmed = 0
+                    logging.error("shard worker {} stopped with code {}, restarting. {} messages that were sent to it may have been lost".format(shard.index, shard.process.returncode, lost))
+                    shard.restarts += 1
+                    self._startProcess(shard)
+
+    def _getConnection(self, shard):
+        """
+        waits until the worker is connected.
+        """
+        with shard.condition:
+            while not shard.connection:
+                shard.condition.wait()
+            return shard.connection
+
+    def _confirm(self, shard, connection):
+        """
+        reads the nr of messages that the worker has processed since the previous check.
+        """
+        while connection.poll():
+            message = connection.recv()
+            if message[0] == 'processed':
+                with shard.condition:
+                    if shard.connection is connection:
+                        shard.unconfirmed = max(shard.unconfirmed - message[1], 0)
+
+    def _sync(self, shard, connection):
+        """
+        sends the definitions of all the assets that the worker owns, done when the worker has just (re)started.
+        """
+        for assetId in definitions.ids():
+            definition = definitions.get(assetId)
+            if definition and self.ring.getShard(assetId) == shard.index:
+                connection.send(('define', definition))
+                with shard.condition:
+                    shard.unconfirmed += 1
+        shard.synced = connection
+
+    def _send(self, shard):
+        while True:
+            try:
+                message = shard.queue.get(timeout=settings.ShardCheckInterval)
+            except Empty:
+                connection = shard.connection
+                if connection:
+                    try:
+                        self._confirm(shard, connection)                # also when there is nothing to send.
+                    except:
+                        pass                                            # the monitor restarts the worker.
+                continue
+            while True:
+                connection = self._getConnection(shard)
+                try:
+                    self._confirm(shard, connection)
+                    if shard.synced is not connection:
+                        self._sync(shard, connection)
+                    connection.send(message)
+                    with shard.condition:
+                        shard.sent += 1
+                        shard.unconfirmed += 1
+                    break
+                except:
+                    if not self.running:
+                        return
+                    logging.exception("failed to send message to shard worker {}".format(shard.index))
+                    with shard.condition:
+                        if shard.connection is connection:
+                            shard.connection = None                     # wait for the restarted worker.
+
+    def _put(self, assetId, message):
+        self._shards[self.ring.getShard(assetId)].queue.put(message)
+
+    def dispatch(self, assetId, value, valueAt):
+        """
+        forwards a value of an asset to the worker that owns the asset.
+        :return: None
+        """
+        self._put(assetId, ('event', assetId, value, valueAt))
+
+    def dispatchBatch(self, assetId, values):
+        """
+        forwards a list of (value, timestamp) tuples of an asset to the worker that owns the asset.
+        :return: None
+        """
+        self._put(assetId, ('values', assetId, values))
+
+    def define(self, definition):
+        """
+        sends a new or changed definition to the worker that owns the asset.
+        :return: None
+        """
+        self._put(definition['asset'], ('define', definition))
+
+    def remove(self, assetId):
+        """
+        lets the worker that owns the asset know that the definition has been removed.
+        :return: None
+        """
+        self._put(assetId, ('remove', assetId))
+
+    def stop(self):
+        """
+        asks the workers to stop after they have processed all the messages that they already received.
+        :return: None
+        """
+        if not self.running:
+            return
+        self.running = False                                            # stopped workers are no longer restarted.
+        for shard in self._shards:
+            shard.queue.put(('stop',))
+        deadline = time.time() + settings.ShardStopTimeout
+        while time.time() < deadline and any(shard.process.poll() is None for shard in self._shards):
+            time.sleep(0.1)
+        for shard in self._shards:
+            if shard.process.poll() is None:
+                logging.error("shard worker {} didn't stop in time".format(shard.index))
+                shard.process.terminate()
+        self._listener.close()
+
+    def metrics(self):
+        """
+        :return: a list with a dict per worker: is it running, the nr of restarts, the nr of messages sent, waiting,
+        not yet processed and lost when the worker stopped.
+        """
+        return [{'shard': shard.index, 'alive': shard.process.poll() is None, 'connected': shard.connection is not None,
+                 'restarts': shard.restarts, 'sent': shard.sent, 'depth': shard.queue.qsize(),
+                 'unconfirmed': shard.unconfirmed, 'lost': shard.lost,
+                 'uptime': time.time() - shard.startedAt} for shard in self._shards]
+
+
+engine = ShardManager(settings.Shards, settings.ShardQueueSize)
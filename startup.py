@@ -0,0 +1,174 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import settings
+
+
+class Loader(object):
+    """
+    registers a large set of definitions with a bounded nr of worker threads, so that a restart doesn't have to wait
+    for the logins, asset creations and timer registrations of every definition one after the other.
+    The nr of definitions that is registered at the same time for a single tenant is limited, so that 1 large account
+    doesn't overload the api or block the others. Definitions become active as soon as they are registered, the
+    event path doesn't wait for the rest.
+    """
+
+    def __init__(self, workers, perTenant, progressInterval=None):
+        """
+        create the object
+        :param workers: max nr of definitions that are registered at the same time.
+        :param perTenant: max nr of definitions of the same tenant (username + api) that are registered at the same time.
+        :param progressInterval: nr of seconds between 2 progress messages in the log.
+        """
+        self._workers = workers
+        self._perTenant = perTenant
+        self._progressInterval = progressInterval if progressInterval is not None else settings.StartupProgressInterval
+        self._queue = Queue()
+        self._tenants = {}                                              # (username, api) -> semaphore
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._done.set()                                                # nothing to load yet.
+        self._threads = []
+        self.total = 0
+        self.loaded = 0
+        self.failed = 0
+        self.startedAt = None
+        self.readyAt = None
+
+    def _getTenantSlot(self, definition):
+        key = (definition.get('username'), definition.get('api') or settings.Api)
+        with self._lock:
+            slot = self._tenants.get(key)
+            if not slot:
+                slot = threading.BoundedSemaphore(self._perTenant)
+                self._tenants[key] = slot
+            return slot
+
+    @staticmethod
+    def interleave(definitions):
+        """
+        orders the definitions round robin over the tenants, so that the workers don't all wait for the slots of the
+        same tenant while the definitions of other tenants could be registered.
+        :param definitions: a list of definitions (json dicts)
+        :return: a new list with the same definitions.
+        """
+        tenants = OrderedDict()
+        for definition in definitions:
+            tenants.setdefault((definition.get('username'), definition.get('api')), []).append(definition)
+        lists = list(tenants.values())
+        result = []
+        for i in range(max(len(x) for x in lists) if lists else 0):
+            result.extend(x[i] for x in lists if i < len(x))
+        return result
+
+    def start(self, definitions, register, onReady=None):
+        """
+        starts registering the definitions in the background, this function returns immediately.
+        :param definitions: a list of definitions (json dicts)
+        :param register: callable that registers a single definition, returns a false value when it failed.
+        :param onReady: optional callable, called (without arguments) when all the definitions have been processed.
+        :return: None
+        """
+        definitions = self.interleave(definitions)
+        with self._lock:
+            self.total = len(definitions)
+            self.loaded = 0
+            self.failed = 0
+            self.startedAt = time.time()
+            self.readyAt = None
+            self._onReady = onReady
+            self._done.clear()
+        for definition in definitions:
+            self._queue.put(definition)
+        logging.info("loading {} definitions with {} workers".format(self.total, self._workers))
+        if not definitions:
+            self._finish()
+            return
+        self._threads = []
+        for i in range(min(self._workers, len(definitions))):
+            thread = threading.Thread(target=self._run, args=(register,), name="startup-{}".format(i))
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+        reporter = threading.Thread(target=self._report, name="startup-progress")
+        reporter.daemon = True
+        reporter.start()
+
+    def _run(self, register):
+        while True:
+            try:
+                definition = self._queue.get_nowait()
+            except Empty:
+                return
+            success = False
+            try:
+                with self._getTenantSlot(definition):
+                    success = bool(register(definition))
+            except:
+                logging.exception("failed to load definition: {}".format(definition.get('name')))
+            with self._lock:
+                if success:
+                    self.loaded += 1
+                else:
+                    self.failed += 1
+                finished = self.loaded + self.failed == self.total
+            if finished:
+                self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self.readyAt = time.time()
+            onReady = self._onReady
+        logging.info("ready: {} definitions loaded, {} failed, in {:.1f} seconds".format(self.loaded, self.failed, self.timeToReady))
+        self._done.set()
+        if onReady:
+            onReady()
+
+    def _report(self):
+        while not self._done.wait(self._progressInterval):
+            logging.info("loading definitions: {}/{} done, {} failed".format(self.loaded + self.failed, self.total, self.failed))
+
+    def wait(self, timeout=None):
+        """
+        blocks until all the definitions have been processed.
+        :param timeout: max nr of seconds to wait.
+        :return: True if all the definitions have been processed.
+        """
+        return self._done.wait(timeout)
+
+    @property
+    def isReady(self):
+        return self._done.is_set()
+
+    @property
+    def timeToReady(self):
+        """
+        :return: nr of seconds that the startup took, or has taken so far if it is still busy.
+        """
+        if not self.startedAt:
+            return 0
+        return (self.readyAt or time.time()) - self.startedAt
+
+    def metrics(self):
+        """
+        :return: a dict with the progress of the startup.
+        """
+        return {'total': self.total, 'loaded': self.loaded, 'failed': self.failed,
+                'pending': self.total - self.loaded - self.failed, 'ready': self.isReady, 'timeToReady': self.timeToReady}
+
+
+loader = Loader(settings.StartupWorkers, settings.StartupTenantConcurrency)
@@ -0,0 +1,215 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+import settings
+
+
+def _toState(value):
+    if hasattr(value, 'toState'):
+        return value.toState()
+    raise TypeError("{} is not serializable".format(value))
+
+
+def encode(value):
+    """
+    converts a value to the json text that is stored. Objects with a 'toState' function are stored as the result of
+    that function.
+    :param value: the value to convert
+    :return: a string
+    """
+    return json.dumps(value, default=_toState)
+
+
+class StateStore(object):
+    """
+    durable, local storage for the running state of the statistical groups (counts, minimums, averages,...).
+    The state of each group is stored as a json document in an sqlite database, so that the values survive a
+    restart of the service without having to read them back from the platform.
+    The groups don't write their state for every value: they are marked dirty (see markDirty) and a background thread
+    stores all the dirty states in 1 transaction, every flushInterval seconds or when maxDirty groups are waiting.
+    When the process crashes, the values of the last flushInterval seconds are lost.
+    """
+
+    def __init__(self, path, table='state', flushInterval=1, maxDirty=0):
+        """
+        create the object. The database is only opened when it is first used.
+        :param path: the path to the sqlite database file.
+        :param table: the name of the table that contains the values, so that multiple stores can share the same database file.
+        :param flushInterval: max nr of seconds that a dirty state waits before it is stored.
+        :param maxDirty: nr of dirty states after which they are stored, even if the interval hasn't passed. 0 = no limit.
+        """
+        self._path = path
+        self._table = table
+        self._db = None
+        self._lock = threading.Lock()
+        self._flushInterval = flushInterval
+        self._maxDirty = maxDirty
+        self._dirty = {}                                                # key -> object with an 'encodeState' function, stored by the next flush.
+        self._dirtyLock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.flushCount = 0
+        self.savedCount = 0
+        self.errorCount = 0
+        self.maxFlushTime = 0
+
+    def _open(self):
+        if not self._db:
+            dir = os.path.dirname(self._path)
+            if dir and not os.path.isdir(dir):
+                os.makedirs(dir)
+            self._db = sqlite3.connect(self._path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")                    # cheap commits, every flush does one.
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT NOT NULL)".format(self._table))
+            self._db.commit()
+        return self._db
+
+    def load(self, key):
+        """
+        load the state of a group.
+        :param key: the unique key of the group.
+        :return: a dict with the state, or None if nothing was stored yet for the key.
+        """
+        with self._lock:
+            row = self._open().execute("SELECT value FROM {} WHERE key = ?".format(self._table), (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, key, value):
+        """
+        store the state of a group.
+        :param key: the unique key of the group.
+        :param value: a dict with the state, must be json serializable. Objects with a 'toState' function are stored as
+        the result of that function.
+        :return: None
+        """
+        data = encode(value)
+        with self._lock:
+            db = self._open()
+            db.execute("INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)".format(self._table), (key, data))
+            db.commit()
+
+    def saveMany(self, values, encoded=False):
+        """
+        store multiple values in 1 transaction.
+        :param values: a list of (key, value) tuples.
+        :param encoded: when true, the values have already been converted with 'encode', for instance while the
+        object was locked.
+        :return: None
+        """
+        data = values if encoded else [(key, encode(value)) for key, value in values]
+        with self._lock:
+            db = self._open()
+            db.executemany("INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)".format(self._table), data)
+            db.commit()
+
+    def delete(self, key):
+        """
+        removes the state of a group.
+        :param key: the unique key of the group.
+        :return: None
+        """
+        with self._lock:
+            db = self._open()
+            db.execute("DELETE FROM {} WHERE key = ?".format(self._table), (key,))
+            db.commit()
+
+    def markDirty(self, key, owner):
+        """
+        schedules the state of a group to be stored by the next flush. The state is only encoded at that moment, so
+        a group that changes many times between 2 flushes is written once.
+        :param key: the unique key of the group.
+        :param owner: the object that holds the state, it's 'encodeState' function is called (without any locks held)
+        to get the json text.
+        :return: None
+        """
+        with self._dirtyLock:
+            self._dirty[key] = owner
+            full = self._maxDirty and len(self._dirty) >= self._maxDirty
+        if not self._thread:
+            self.start()
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """
+        stores all the dirty states in 1 transaction. States that could not be stored stay dirty.
+        :return: the nr of states that were stored.
+        """
+        with self._dirtyLock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        start = time.time()
+        data = []
+        for key, owner in dirty.items():
+            try:
+                data.append((key, owner.encodeState()))
+            except:
+                self.errorCount += 1
+                logging.exception("failed to encode the state of {}".format(key))
+        try:
+            self.saveMany(data, encoded=True)
+        except:
+            self.errorCount += 1
+            logging.exception("failed to store {} states".format(len(data)))
+            with self._dirtyLock:
+                for key, owner in dirty.items():
+                    self._dirty.setdefault(key, owner)                  # unless it was marked again in the mean time.
+            return 0
+        self.flushCount += 1
+        self.savedCount += len(data)
+        self.maxFlushTime = max(self.maxFlushTime, time.time() - start)
+        return len(data)
+
+    def start(self):
+        with self._dirtyLock:
+            if self._thread:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="state")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        stops the background thread and stores the states that are still dirty.
+        :return: None
+        """
+        self._stop.set()
+        self._wake.set()
+        self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self._flushInterval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self.flush()
+
+    def metrics(self):
+        return {'dirty': len(self._dirty), 'flushes': self.flushCount, 'saved': self.savedCount, 'errors': self.errorCount,
+                'maxFlushTime': self.maxFlushTime}
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+
+store = StateStore(settings.StateStore, flushInterval=settings.StateFlushInterval, maxDirty=settings.StateFlushMaxDirty)
@@ -5,55 +5,671 @@ __maintainer__ = "Jan Bogaerts"
 __email__ = "jb@allthingstalk.com"
 __status__ = "Prototype"  # "Development", or "Production"
 
-import math
-import datetime
+import json
+import time
+import logging
+import itertools
+import threading
 import dateutil.parser
-from att_event_engine.resources import Sensor, Actuator, Virtual, Gateway, Parameter
-import urllib                                                           # to make certain that the name of the asset doesn't contain any wrong chars (from the name of the timer)
+from att_event_engine.resources import Sensor, Actuator
 
-class Statistician:
+from statestore import store, encode
+from provisioning import manifest
+from metrics import metrics
+from aggregates import Moments, Histogram, QuantileSketch
+import settings
+
+try:
+    import numpy                                                        # optional: used to speed up the batch calculations.
+except ImportError:
+    numpy = None
+
+try:
+    basestring
+except NameError:                                                       # python 3
+    basestring = str
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+
+def _intern(value):
+    """
+    :return: the shared copy of a name (group name, tenant, key of the state), so it is stored only once for all the groups.
+    """
+    try:
+        return intern(str(value))
+    except UnicodeEncodeError:                                          # python 2: only ascii names can be interned.
+        return value
+
+
+class Reading(object):
+    """
+    a single value of the asset, as used by the batch calculations and the shard workers (has the same fields as the asset object)
+    """
+    __slots__ = ('value', 'value_at', 'time')
+
+    def __init__(self, value, value_at, time=None):
+        self.value = value
+        self.value_at = value_at
+        self.time = time                                                # nr of seconds since the epoch, when it's already known (see rules.calculateBatch).
+
+
+def _isVectorizable(values):
+    """
+    checks if the list of values can be handled by numpy without changing the results: all int or all float.
+    """
+    if not numpy or not values:
+        return False
+    kind = type(values[0])
+    return kind in (int, float) and all(type(x) is kind for x in values)
+
+
+def _extreme(values, prev, isMin):
+    """
+    calculates the minimum (or maximum) of the values and the previous minimum (or maximum)
+    """
+    seq = values if prev is None else [prev] + values
+    if _isVectorizable(seq):
+        return (numpy.min(seq) if isMin else numpy.max(seq)).item()
+    return min(seq) if isMin else max(seq)
+
+
+def _assetProfile(asset):
+    return asset.profile
+
+
+class Output(object):
+    """
+    describes an asset that a statistical function publishes it's results to.
+    """
+    def __init__(self, name, label, description, profile, history=False):
+        """
+        create the object
+        :param name: the name of the asset, without the asset and group name
+        :param label: the label of the asset, without the asset and group name
+        :param description: the description of the asset
+        :param profile: the profile of the asset, or a function that calculates the profile from the monitored asset.
+        :param history: when True, the asset is only created for groups that are reset.
+        """
+        self.name = name
+        self.label = label
+        self.description = description
+        self.profile = profile
+        self.history = history
+
+    def getProfile(self, asset):
+        return self.profile(asset) if callable(self.profile) else self.profile
+
+
+knownFunctions = {}                                                     # all the known statistical functions: name -> Function class
+
+
+def statistic(cls):
+    """
+    class decorator that registers a statistical function, so that it can be used in definitions.
+    """
+    cls.order = len(knownFunctions)                                     # functions without dependencies between them are calculated in the order of registration.
+    knownFunctions[cls.name] = cls
+    return cls
+
+
+class Function(object):
+    """
+    base class for the statistical functions. A function declares which functions it depends on, the assets that
+    it publishes to and how it's values are updated and reset. Register new functions with the @statistic decorator.
+    The running values are stored in the state of the group, which is shared by all the functions of the group.
+    """
+    name = None
+    requires = []                                                       # functions that have to be calculated first. They get the same parameters, if they are not in the definition.
+    outputs = []                                                        # Output objects
+    stateAssets = []                                                    # outputs that contain a running value, used to initialize the state from the platform.
+    ordered = False                                                     # True if the result depends on the order of the values: late values are not given to it on the correction path (see admission.py).
+
+    def __init__(self, params):
+        """
+        create the object
+        :param params: the parameters of the function, as found in the definition (dict), can be None.
+        """
+        self.params = params or {}
+
+    def getOutputs(self):
+        """
+        :return: the Output objects of the function, some functions have outputs that depend on their parameters.
+        """
+        return self.outputs
+
+    def getRequires(self, asset):
+        """
+        :param asset: the asset that is monitored, some functions only need dependencies for some types of assets.
+        :return: the names of the functions that have to be calculated before this one.
+        """
+        return self.requires
+
+    def getStateKeys(self):
+        """
+        :return: the keys of the state of the group that hold the running values of this function, they are removed
+        when the function changes (see Statistician.takeOver).
+        """
+        return [self.name]
+
+    def update(self, group, reading, context):
+        """
+        process a new value.
+        :param group: the Statistician object: provides the state and publish function.
+        :param reading: an object with a 'value' and 'value_at' field.
+        :param context: a dict with the results of the functions that were calculated before this one, for this value.
+        :return: None
+        """
+        raise NotImplementedError()
+
+    def updateBatch(self, group, readings, context):
+        """
+        process a list of values, sorted on timestamp. Called after the batch has been processed by all the
+        functions that this one requires, so only their end result is in the context.
+        By default, every value is processed separately.
+        """
+        for reading in readings:
+            self.update(group, reading, context)
+
+    def reset(self, group, last):
+        """
+        called at the end of a period: publish the history values and start again.
+        :param group: the Statistician object
+        :param last: the last known value of the asset
+        :return: None
+        """
+        pass
+
+
+def _getHistogram(state, name, params, value):
+    """
+    get the histogram of a distribution function from the state, create it if needed.
+    :param state: the state of the group
+    :param name: the name of the function: 'dist' or 'distsumtime'
+    :param params: the parameters of the function (bucketsize, min, max)
+    :param value: the value that will be added, used to recognize a boolean distribution.
+    :return: a Histogram object
+    """
+    hist = state.get(name)
+    if isinstance(hist, Histogram):
+        return hist
+    typecode = 'l' if name == 'dist' else 'd'
+    if isinstance(value, bool):
+        low, high, size = 0, 1, 1                                       # boolean dist: false, true
+    else:
+        low, high, size = params.get('min'), params.get('max'), params.get('bucketsize', 1)
+    if isinstance(hist, dict):
+        result = Histogram.fromState(hist)
+    elif hist:                                                          # a list from before the histograms, starts at the min.
+        start = low if low is not None else state.get('min', value)
+        result = Histogram.fromState({'size': size, 'origin': start, 'type': typecode, 'low': low, 'high': high, 'first': 0, 'buckets': hist})
+    else:
+        result = Histogram(size, low if low is not None else 0, typecode, low, high)  # fixed bucket boundaries: min + n * bucketsize, or n * bucketsize without a min.
+    state[name] = result
+    return result
+
+
+@statistic
+class Count(Function):
+    name = 'count'
+    outputs = [Output('count', 'count', "generated by the statistician", "integer"),
+               Output('countHistory', 'count history', "generated by the statistician. count of previous time windows", "integer", True)]
+    stateAssets = ['count']
+
+    def update(self, group, reading, context):
+        cnt = (group.state.get('count') or 0) + 1
+        group.state['count'] = cnt
+        group.publish('count', cnt)
+        context['count'] = cnt
+
+    def updateBatch(self, group, readings, context):
+        cnt = (group.state.get('count') or 0) + len(readings)
+        group.state['count'] = cnt
+        group.publish('count', cnt)
+        context['count'] = cnt
+
+    def reset(self, group, last):
+        group.publish('countHistory', group.state.get('count'))
+        group.state['count'] = 0
+        group.publish('count', 0)
+
+
+class _Extreme(Function):
+    """
+    min or max
+    """
+    isMin = True
+
+    def update(self, group, reading, context):
+        prevVal = group.state.get(self.name)
+        value = reading.value
+        if prevVal == None or (value < prevVal if self.isMin else value > prevVal):
+            group.state[self.name] = value
+            group.publish(self.name, value)
+        context[self.name] = group.state[self.name]
+
+    def updateBatch(self, group, readings, context):
+        prevVal = group.state.get(self.name)
+        value = _extreme([x.value for x in readings], prevVal, self.isMin)
+        if value != prevVal:
+            group.state[self.name] = value
+            group.publish(self.name, value)
+        context[self.name] = value
+
+    def reset(self, group, last):
+        group.publish(self.name + 'History', group.state.get(self.name))
+        group.state[self.name] = last
+        group.publish(self.name, last)
+
+
+@statistic
+class Min(_Extreme):
+    name = 'min'
+    isMin = True
+    outputs = [Output('min', 'min', "generated by the statistician", _assetProfile),
+               Output('minHistory', 'min history', "generated by the statistician. min of previous time windows", _assetProfile, True)]
+    stateAssets = ['min']
+
+
+@statistic
+class Max(_Extreme):
+    name = 'max'
+    isMin = False
+    outputs = [Output('max', 'max', "generated by the statistician", _assetProfile),
+               Output('maxHistory', 'max history', "generated by the statistician. max of previous time windows", _assetProfile, True)]
+    stateAssets = ['max']
+
+
+@statistic
+class Avg(Function):
+    name = 'avg'
+    requires = ['count']
+    outputs = [Output('avg', 'avg', "generated by the statistician", "number"),
+               Output('avgHistory', 'avg history', "generated by the statistician. avg of previous time windows", "number", True)]
+    stateAssets = ['avg']
+
+    def getStateKeys(self):
+        return ['avg', 'moments']
+
+    def getMoments(self, state):
+        """
+        get the running count, mean and variance of the values in this period.
+        :return: a Moments object
+        """
+        moments = state.get('moments')
+        if moments is None and state.get('avg') is not None and state.get('count'):
+            count = state['count']                                      # state from before the moments were stored: continue from the published avg and std.
+            return Moments(count, float(state['avg']), (state.get('std') or 0) ** 2 * count)
+        return Moments.fromState(moments)
+
+    def update(self, group, reading, context):
+        moments = self.getMoments(group.state)
+        moments.update(reading.value)
+        self.store(group, moments, context)
+
+    def updateBatch(self, group, readings, context):
+        moments = self.getMoments(group.state)
+        for reading in readings:                                        # in order, so the result is the same as for single values.
+            moments.update(reading.value)
+        self.store(group, moments, context)
+
+    def store(self, group, moments, context):
+        group.state['moments'] = moments.toState()
+        group.state['avg'] = moments.mean
+        group.publish('avg', moments.mean)
+        context['avg'] = moments.mean
+        context['moments'] = moments
+
+    def reset(self, group, last):
+        group.publish('avgHistory', group.state.get('avg'))
+        group.state['avg'] = 0
+        group.state['moments'] = None
+        group.publish('avg', 0)
+
+
+@statistic
+class Std(Function):
+    name = 'std'
+    requires = ['avg']                                                  # avg calculates the moments
+    outputs = [Output('std', 'std', "generated by the statistician", "number"),
+               Output('stdHistory', 'std history', "generated by the statistician. std of previous time windows", "number", True)]
+    stateAssets = ['std']
+
+    def update(self, group, reading, context):
+        std = context['moments'].std
+        group.state['std'] = std
+        group.publish('std', std)
+        context['std'] = std
+
+    def updateBatch(self, group, readings, context):
+        self.update(group, None, context)
+
+    def reset(self, group, last):
+        group.publish('stdHistory', group.state.get('std'))
+        group.state['std'] = 0
+        group.publish('std', 0)
+
+
+class _Distribution(Function):
+    """
+    base class for the distributions: they need the min and max of the values, unless the asset is a boolean or
+    the definition specifies the range.
+    """
+    def getRequires(self, asset):
+        if asset.profile['type'] == 'boolean':                          # boolean dist does not need min or max
+            return []
+        return [name for name in ['min', 'max'] if name not in self.params]  # if user specified min or max, don't need to calculate it.
+
+    def reset(self, group, last):
+        dist = group.state.get(self.name)
+        group.publish(self.name + 'History', dist.toList() if isinstance(dist, Histogram) else dist)
+        group.state[self.name] = None                                   # a new histogram is started with the next value.
+        group.publish(self.name, [])
+
+
+@statistic
+class Dist(_Distribution):
+    name = 'dist'
+    outputs = [Output('dist', 'dist', "generated by the statistician", {"type": "array", "items": {"type": "integer"}}),
+               Output('distHistory', 'dist history', "generated by the statistician. dist of previous time windows", {"type": "array", "items": {"type": "integer"}}, True)]
+    stateAssets = ['dist']
+
+    def update(self, group, reading, context):
+        value = reading.value
+        hist = _getHistogram(group.state, 'dist', self.params, value)
+        if hist.add(int(value) if isinstance(value, bool) else value):
+            group.publish('dist', hist.toList)                          # the list is only built when the value is sent to the server.
+            context['dist'] = hist
+
+    def updateBatch(self, group, readings, context):
+        values = [int(x.value) if isinstance(x.value, bool) else x.value for x in readings]
+        hist = _getHistogram(group.state, 'dist', self.params, readings[0].value)
+        if hist.addMany(values):                                        # the buckets don't depend on the order, so they can all be counted at once.
+            group.publish('dist', hist.toList)
+            context['dist'] = hist
+
+
+@statistic
+class DistPercent(Function):
+    name = 'distprocent'
+    requires = ['dist']
+    outputs = [Output('distprocent', 'dist %', "generated by the statistician. Distribution expressed in percentages", {"type": "array", "items": {"type": "number"}}),
+               Output('distprocentHistory', 'dist % history', "generated by the statistician. dist % of previous time windows", {"type": "array", "items": {"type": "number"}}, True)]
+
+    def getStateKeys(self):
+        return []                                                       # only views of the state of the distribution.
+
+    def update(self, group, reading, context):
+        if 'dist' in context:
+            group.publish('distprocent', context['dist'].percentages)   # only calculated when the value is sent.
+
+    def updateBatch(self, group, readings, context):
+        self.update(group, None, context)
+
+    def reset(self, group, last):
+        dist = group.state.get('dist')
+        group.publish('distprocentHistory', dist.percentages() if isinstance(dist, Histogram) else [])
+        group.publish('distprocent', [])
+
+
+@statistic
+class DistSumTime(_Distribution):
+    name = 'distsumtime'
+    ordered = True
+    outputs = [Output('distsumtime', 'dist sum time', "generated by the statistician", {"type": "array", "items": {"type": "integer"}}),
+               Output('distsumtimeprev', 'dist sum time prev', "generated by the statistician", lambda asset: {"type": "object", "properties": {"value": asset.profile, "timestamp": {"type": "string"}}}),
+               Output('distsumtimeHistory', 'dist-sum-time history', "generated by the statistician. dist sum time of previous time windows", {"type": "array", "items": {"type": "integer"}}, True)]
+    stateAssets = ['distsumtime', 'distsumtimeprev']
+
+    def getStateKeys(self):
+        return self.stateAssets
+
+    def update(self, group, reading, context):
+        prevVal = group.state.get('distsumtimeprev')
+        newTime = reading.value_at
+        if prevVal and prevVal['timestamp']:
+            prevDate = dateutil.parser.parse(prevVal['timestamp'])
+            prevVal = prevVal['value']
+            hist = _getHistogram(group.state, 'distsumtime', self.params, prevVal)
+            timeDif = dateutil.parser.parse(newTime) - prevDate
+            if hist.add(int(prevVal) if isinstance(prevVal, bool) else prevVal, timeDif.total_seconds()):
+                context['distsumtime'] = hist
+                group.publish('distsumtime', hist.toList)
+        group.state['distsumtimeprev'] = {'value': reading.value, 'timestamp': newTime}
+        group.publish('distsumtimeprev', group.state['distsumtimeprev'])
+
+    def reset(self, group, last):
+        group.state['distsumtimeprev'] = {"value": None, "timestamp": None}
+        group.publish('distsumtimeprev', group.state['distsumtimeprev'])
+        _Distribution.reset(self, group, last)
+
+
+@statistic
+class DistSumTimePercent(Function):
+    name = 'distsumtimeprocent'
+    requires = ['distsumtime']
+    outputs = [Output('distsumtimeprocent', 'distsumtime %', "generated by the statistician. Distribution expressed in percentages", {"type": "array", "items": {"type": "number"}}),
+               Output('distsumtimeprocentHistory', 'dist sum time % history', "generated by the statistician. dist sum time % of previous time windows", {"type": "array", "items": {"type": "number"}}, True)]
+
+    def getStateKeys(self):
+        return []                                                       # only views of the state of the distribution.
+
+    def update(self, group, reading, context):
+        if 'distsumtime' in context:
+            group.publish('distsumtimeprocent', context['distsumtime'].percentages)
+
+    def updateBatch(self, group, readings, context):
+        self.update(group, None, context)
+
+    def reset(self, group, last):
+        dist = group.state.get('distsumtime')
+        group.publish('distsumtimeprocentHistory', dist.percentages() if isinstance(dist, Histogram) else [])
+        group.publish('distsumtimeprocent', [])
+
+
+@statistic
+class Delta(Function):
+    name = 'delta'
+    ordered = True
+    outputs = [Output('deltaCurrentPeriod', 'delta current period', "generated by the statistician", _assetProfile),
+               Output('deltaPrevTotal', 'delta prev total', "generated by the statistician. The value of the asset at the end of the previous period", _assetProfile),
+               Output('deltaHistory', 'delta history', "generated by the statistician. The deltas of the previous periods", _assetProfile, True),
+               Output('deltaHistoryPrevTotal', 'delta history previous total', "generated by the statistician. The total value, at the end of the previous time group. Used to calcualte the history delta, when the period has ended", _assetProfile, True)]
+    stateAssets = ['deltaPrevTotal', 'deltaCurrentPeriod', 'deltaHistoryPrevTotal']
+
+    def getStateKeys(self):
+        return self.stateAssets
+
+    def update(self, group, reading, context):
+        value = reading.value
+        prevDelta = group.state.get('deltaPrevTotal')
+        if prevDelta:
+            group.state['deltaCurrentPeriod'] = value - prevDelta
+            group.publish('deltaCurrentPeriod', group.state['deltaCurrentPeriod'])
+        group.state['deltaPrevTotal'] = value
+        group.publish('deltaPrevTotal', value)
+        context['delta'] = group.state.get('deltaCurrentPeriod')
+
+    def reset(self, group, last):
+        if last is not None:
+            group.publish('deltaHistory', last - (group.state.get('deltaHistoryPrevTotal') or 0))
+            group.state['deltaHistoryPrevTotal'] = last
+            group.publish('deltaHistoryPrevTotal', last)
+
+
+@statistic
+class Percentile(Function):
+    """
+    estimates of percentiles (median, p95, p99,...) with bounded memory, see QuantileSketch for the error bound.
+    parameters: "percentiles": list of percentiles (default: settings.Percentiles), "accuracy": relative error
+    (default: settings.PercentileAccuracy), "max buckets": memory bound (default: settings.PercentileMaxBuckets)
+    """
+    name = 'percentile'
+
+    def __init__(self, params):
+        Function.__init__(self, params)
+        self.percentiles = self.params.get('percentiles', settings.Percentiles)
+
+    @staticmethod
+    def getOutputName(percentile):
+        return "p{}".format(percentile).replace('.', '_')
+
+    def getOutputs(self):
+        result = []
+        for percentile in self.percentiles:
+            name = self.getOutputName(percentile)
+            result.append(Output(name, name, "generated by the statistician. estimate of the {} percentile".format(percentile), "number"))
+            result.append(Output(name + 'History', name + ' history', "generated by the statistician. {} percentile of previous time windows".format(percentile), "number", True))
+        return result
+
+    def getSketch(self, state):
+        sketch = state.get('percentile')
+        if isinstance(sketch, QuantileSketch):
+            return sketch
+        if sketch:
+            sketch = QuantileSketch.fromState(sketch)
+        else:
+            sketch = QuantileSketch(self.params.get('accuracy', settings.PercentileAccuracy), self.params.get('max buckets', settings.PercentileMaxBuckets))
+        state['percentile'] = sketch
+        return sketch
+
+    def publishAll(self, group, sketch):
+        for percentile in self.percentiles:
+            group.publish(self.getOutputName(percentile), lambda q=percentile / 100.0: sketch.quantile(q))  # only calculated when the value is sent.
+
+    def update(self, group, reading, context):
+        sketch = self.getSketch(group.state)
+        sketch.add(reading.value)
+        self.publishAll(group, sketch)
+        context['percentile'] = sketch
+
+    def updateBatch(self, group, readings, context):
+        sketch = self.getSketch(group.state)
+        for reading in readings:
+            sketch.add(reading.value)
+        self.publishAll(group, sketch)
+        context['percentile'] = sketch
+
+    def reset(self, group, last):
+        sketch = self.getSketch(group.state)
+        for percentile in self.percentiles:
+            name = self.getOutputName(percentile)
+            group.publish(name + 'History', sketch.quantile(percentile / 100.0))
+            group.unpublish(name)                                       # an estimate that wasn't sent yet belongs to the period that ended, the next value publishes a new one.
+        group.state['percentile'] = None                                # a new sketch is started with the next value.
+
+
+def compileFunctions(definitions, asset):
+    """
+    builds the list of functions that need to be calculated for a group: the functions in the definition and all the
+    functions that they depend on, sorted so that every function comes after the functions it requires.
+    :param definitions: the list of 'function' objects of the group
+    :param asset: the asset that is monitored.
+    :return: a list of Function objects.
+    """
+    params = {}
+    pending = []
+    for definition in definitions:
+        name = definition['function']
+        if name not in knownFunctions:
+            logging.warning("unknown statistical function '{}', ignored".format(name))
+            continue
+        params[name] = definition                                       # so we can store some parameters, if there are any
+        pending.append(name)
+    instances = {}
+    while pending:
+        name = pending.pop(0)
+        if name in instances:
+            continue
+        instances[name] = knownFunctions[name](params[name])
+        for required in instances[name].getRequires(asset):
+            if required not in params:
+                params[required] = params[name]                         # the parameters for dist are the same as for distprocent
+            pending.append(required)
+    result = []
+    visiting = set()
+    def visit(name):
+        if name in visiting:
+            raise Exception("circular dependency detected for function '{}'".format(name))
+        if instances[name] in result:
+            return
+        visiting.add(name)
+        for required in sorted(instances[name].getRequires(asset), key=lambda x: knownFunctions[x].order):
+            visit(required)
+        visiting.discard(name)
+        result.append(instances[name])
+    for name in sorted(instances.keys(), key=lambda x: knownFunctions[x].order):
+        visit(name)
+    return result
+
+
+_pipelines = {}                                                         # (functions as json, type of the asset) -> tuple of Function objects
+
+
+def getPipeline(definitions, asset):
+    """
+    compiles the functions of a group, see compileFunctions. The Function objects don't hold any values, so all the
+    groups with the same functions (and the same type of asset) share the same objects.
+    :param definitions: the list of 'function' objects of the group
+    :param asset: the asset that is monitored, it's profile is only needed for the distributions.
+    :return: a tuple of Function objects.
+    """
+    needsType = any(issubclass(knownFunctions.get(x['function'], Function), _Distribution) for x in definitions)
+    key = (json.dumps(definitions, sort_keys=True), asset.profile['type'] if needsType else None)
+    result = _pipelines.get(key)
+    if result is None:
+        result = _pipelines.setdefault(key, tuple(compileFunctions(definitions, asset)))
+    return result
+
+
+_locks = [threading.Lock() for i in range(settings.GroupLocks)]        # shared by the groups, so there is no lock object per group.
+_nextLock = itertools.count()
+_series = {}                                                            # (pipeline, tenant) -> list of metric series, shared by the groups with the same functions.
+
+
+class Statistician(object):
     """
     performs all the statistical calculations for a single asset.
+    There can be hundreds of thousands of groups in 1 process, so a group only keeps references to shared objects (the
+    compiled functions, the locks, the metric series, interned names) and it's running values.
     """
+    __slots__ = ('_asset', '_name', '_publisher', 'tenant', '_series', '_batch', 'resetEvery', 'startDate', '_pipeline',
+                 '_lock', '_state')
 
-    def __init__(self, name, functions, resetEvery, startDate, asset):
+    def __init__(self, name, functions, resetEvery, startDate, asset, publisher=None, tenant=None):
         """
         create object
         :param functions: a list of 'function' objects that this statistician has to calculate when a value is changed
         :param asset: an Asset object or id string that this statistician should calculate values for.
+        :param publisher: the Publisher object that sends the results to the platform. When none, the values are sent immediately.
+        :param tenant: the username of the definition, used as label of the metrics.
         """
         if isinstance(asset, basestring):
             self._asset = Sensor(asset)                                 # we treat it as a sensor, could also be an actuator.
         else:
             self._asset = asset
-        self._name = name                                               # the name of the statistical group.
-        self._functions = {}
+        self._name = _intern(name)                                      # the name of the statistical group.
+        self._publisher = publisher
+        self.tenant = _intern(tenant) if tenant else tenant
+        self._series = None                                             # the metrics of the functions, in the order of the pipeline.
+        self._batch = None                                              # when calculating a batch, the values to publish are collected here.
         self.resetEvery = resetEvery                                    # so we can restart the timer.
         self.startDate = dateutil.parser.parse(startDate) if startDate else None
-        for function in functions:
-            name = function['function']
-            self._functions[function['function']] = function            # so we can store some parameters, if there are any
-            if name == "std":                                           # for std, we need avg
-                if "avg" not in self._functions:
-                    name = 'avg'                                        # change the name to avg so the next if works: for avg, we also need count.
-                    self._functions[name] = None
-            # this is correct: for std, we need avg and count
-            if name == "avg" and "count" not in self._functions:        # if we need avg, then we need count to get the avg right.
-                self._functions['count'] = None
-            if name == "distprocent":  # for std%, we also need std
-                if "dist" not in self._functions:
-                    name = "dist"                                       # change the name to std, so we process the next 'if' statemtn (include std and it's subparts)
-                    self._functions[name] = function                    # the parameters for std are the same as for distprocent
-            if name == "distsumtimeprocent":                                  # for distsumtime%, we also need distsumtime
-                if "distsumtime" not in self._functions:
-                    name = "distsumtime"                                 # change the name to std, so we process the next 'if' statemtn (include std and it's subparts)
-                    self._functions[name] = function                     # the parameters for std are the same as for distprocent
-            if (name == "dist" or name == "distsumtime") and self._asset.profile['type'] != 'boolean':    # boolean dist does not need min or max
-                if "min" not in self._functions and "min" not in function:      # if user specified min, don't need to calculate it.
-                    self._functions['min'] = None
-                if "max" not in self._functions and "max" not in function:      # if user specified max, don't need to calculate it.
-                    self._functions['max'] = None
+        self._pipeline = getPipeline(functions, self._asset)            # the functions to calculate, in order.
+        self._lock = _locks[next(_nextLock) % len(_locks)]              # events and timers can arrive on different threads. Only held for 1 group at a time, so sharing can't deadlock.
+        self._state = None                                              # the running values, kept locally, the platform assets are only written to. Loaded when first needed.
 
+    @property
+    def state(self):
+        """
+        the running values of the group, shared by all the functions of the group.
+        """
+        if self._state is None:
+            self._state = self._loadState()
+        return self._state
 
     def createAssets(self, context):
         """
@@ -61,51 +677,22 @@ class Statistician:
         :param device: the device object or id to attach the assets too.
         :return: None
         """
-        if 'count' in self._functions:
-            Virtual.create(context, self._asset.device, self.getAssetName('count'), self.getAssetLabel('count'), "generated by the statistician", "integer")
-            if self.resetEvery:
-                Virtual.create(context, self._asset.device, self.getAssetName('countHistory'), self.getAssetLabel('count history'), "generated by the statistician. count of previous time windows", "integer")
-        if 'min' in self._functions:
-            Virtual.create(context, self._asset.device, self.getAssetName('min'), self.getAssetLabel('min'), "generated by the statistician", self._asset.profile)
-            if self.resetEvery:
-                Virtual.create(context, self._asset.device, self.getAssetName('minHistory'), self.getAssetLabel('min history'), "generated by the statistician. min of previous time windows", self._asset.profile)
-        if 'max' in self._functions:
-            Virtual.create(context, self._asset.device, self.getAssetName('max'), self.getAssetLabel('max'), "generated by the statistician", self._asset.profile)
-            if self.resetEvery:
-                Virtual.create(context, self._asset.device, self.getAssetName('maxHistory'), self.getAssetLabel('max history'), "generated by the statistician. max of previous time windows", self._asset.profile)
-        if 'avg' in self._functions:
-            Virtual.create(context, self._asset.device, self.getAssetName('avg'), self.getAssetLabel('avg'), "generated by the statistician", "number")
-            if self.resetEvery:
-                Virtual.create(context, self._asset.device, self.getAssetName('avgHistory'), self.getAssetLabel('avg history'), "generated by the statistician. avg of previous time windows", "number")
-        if "std" in self._functions:
-            Virtual.create(context, self._asset.device, self.getAssetName('devSum'), self.getAssetLabel('devSum'), "generated by the statistician","number")
-            Virtual.create(context, self._asset.device, self.getAssetName('std'), self.getAssetLabel('std'), "generated by the statistician", "number")
-            if self.resetEvery:
-                Virtual.create(context, self._asset.device, self.getAssetName('stdHistory'), self.getAssetLabel('std history'), "generated by the statistician. std of previous time windows", "number")
-        if "dist" in self._functions:
-            Virtual.create(context, self._asset.device, self.getAssetName('dist'), self.getAssetLabel('dist'), "generated by the statistician",{"type": "array", "items":{"type": "integer" }})
-            if self.resetEvery:
-                Virtual.create(context, self._asset.device, self.getAssetName('distHistory'), self.getAssetLabel('dist history'), "generated by the statistician. dist of previous time windows", {"type": "array", "items":{"type": "integer" }})
-        if "distprocent" in self._functions:
-            Virtual.create(context, self._asset.device, self.getAssetName('distprocent'), self.getAssetLabel('dist %'), "generated by the statistician. Distribution expressed in percentages", {"type": "array", "items": {"type": "number"}})
-            if self.resetEvery:
-                Virtual.create(context, self._asset.device, self.getAssetName('distprocentHistory'), self.getAssetLabel('dist % history'), "generated by the statistician. dist % of previous time windows", {"type": "array", "items": {"type": "number"}})
-        if "distsumtime" in self._functions:
-            Virtual.create(context, self._asset.device, self.getAssetName('distsumtime'), self.getAssetLabel('dist sum time'), "generated by the statistician",{"type": "array", "items": {"type": "integer"}})
-            Virtual.create(context, self._asset.device, self.getAssetName('distsumtimeprev'), self.getAssetLabel('dist sum time prev'), "generated by the statistician", {"type": "object", "properties": { "value": self._asset.profile, "timestamp": {"type": "string"}}})
-            if self.resetEvery:
-                Virtual.create(context, self._asset.device, self.getAssetName('distsumtimeHistory'), self.getAssetLabel('dist-sum-time history'), "generated by the statistician. dist sum time of previous time windows", {"type": "array", "items": {"type": "integer"}})
-        if "distsumtimeprocent" in self._functions:
-            Virtual.create(context, self._asset.device, self.getAssetName('distsumtimeprocent'), self.getAssetLabel('distsumtime %'), "generated by the statistician. Distribution expressed in percentages", {"type": "array", "items": {"type": "number"}})
-            if self.resetEvery:
-                Virtual.create(context, self._asset.device, self.getAssetName('distsumtimeprocentHistory'), self.getAssetLabel('dist sum time % history'), "generated by the statistician. dist sum time % of previous time windows", {"type": "array", "items": {"type": "number"}})
-        if "delta" in self._functions:
-            Virtual.create(context, self._asset.device, self.getAssetName('deltaCurrentPeriod'), self.getAssetLabel('delta current period'), "generated by the statistician", self._asset.profile)
-            Virtual.create(context, self._asset.device, self.getAssetName('deltaPrevTotal'), self.getAssetLabel('delta prev total'), "generated by the statistician. The value of the asset at the end of the previous period", self._asset.profile)
-            if self.resetEvery:
-                Virtual.create(context, self._asset.device, self.getAssetName('deltaHistory'), self.getAssetLabel('delta history'), "generated by the statistician. The deltas of the previous periods", self._asset.profile)
-                Virtual.create(context, self._asset.device, self.getAssetName('deltaHistoryPrevTotal'),self.getAssetLabel('delta history previous total'), "generated by the statistician. The total value, at the end of the previous time group. Used to calcualte the history delta, when the period has ended", self._asset.profile)
+        outputs = [(self.getAssetName(output.name), self.getAssetLabel(output.label), output.description, output.getProfile(self._asset))
+                   for output in self._getOutputs()]
+        with metrics.timed('provisioning', tenant=self.tenant):
+            manifest.provision(context, self._asset, outputs, self.tenant)     # only the assets that don't exist yet or that changed are created.
 
+    def _getOutputs(self):
+        for function in self._pipeline:
+            for output in function.getOutputs():
+                if not output.history or self.resetEvery:
+                    yield output
+
+    def getOutputNames(self):
+        """
+        :return: the names of the assets that represent the values of the statistical functions.
+        """
+        return [self.getAssetName(output.name) for output in self._getOutputs()]
 
     def getAssetLabel(self, functionName):
         return "{}-{}-{}".format(self._asset.name, self._name, functionName)
@@ -119,171 +706,123 @@ class Statistician:
         return "{}-{}-{}".format(self._asset.name, self._name.replace(" ", "-"), functionName)
 
 
-    def try_calculate_count(self, context):
+    def getStateKey(self):
+        return "{}/{}".format(self._asset.id, self._name)
+
+    def _loadState(self):
         """
-        calculate the count.
+        loads the running values of this group from the local state store. When there is no local state yet (first
+        run after an upgrade), the values are read once from the platform, so that the statistics continue where they were.
+        :return: a dict with the state.
         """
-        if 'count' in self._functions:
-            cnt = Actuator(device=self._asset.device, name=self.getAssetName('count'), connection=self._asset.connection)
-            prevVal = cnt.value
-            if not prevVal:
-                cnt.value = 1
-                context['count'] = 1
-            else:
-                cnt.value = prevVal + 1
-                context['count'] = prevVal + 1
-
-
-    def try_calculate_min(self, value, context):
-        if 'min' in self._functions:
-            minAct = Actuator(device=self._asset.device, name=self.getAssetName('min'), connection=self._asset.connection)
-            prevVal = minAct.value
-            if prevVal == None or value < prevVal:
-                minAct.value = value
-                context['prev_min'] = prevVal
-                context['min'] = value
-            else:
-                context['prev_min'] = prevVal
-                context['min'] = prevVal
-
-
-    def try_calculate_max(self, value, context):
-        if 'max' in self._functions:
-            maxAct = Actuator(device=self._asset.device, name=self.getAssetName('max'), connection=self._asset.connection)
-            prevVal = maxAct.value
-            if prevVal == None or value > prevVal:
-                maxAct.value = value
-                context['prev_max'] = prevVal
-                context['max'] = value
-            else:
-                context['prev_max'] = prevVal
-                context['max'] = prevVal
-
-    def try_calculate_avg(self, value, context):
-        if 'avg' in self._functions:
-            avg = Actuator(device=self._asset.device, name=self.getAssetName('avg'), connection=self._asset.connection)
-            avgVal = avg.value
-            if avgVal == None:
-                avg.value = value
-                context['avg'] = value
-            else:
-                cntVal = context['count']
-                val = avgVal - (avgVal / cntVal) + (float(value) / cntVal)
-                avg.value = val
-                context['prev_avg'] = avgVal
-                context['avg'] = val
-
-
-    def try_calculate_std(self, value, context):
-        if "std" in self._functions:
-            devSum = Actuator(device=self._asset.device, name=self.getAssetName('devSum'), connection=self._asset.connection)  # we use a helper actuator for this to store a midstage value
-            if devSum.value == None:
-                devSum.value = 0
-            else:
-                devSum.value += (value - context['avg'])
-                std = Actuator(device=self._asset.device, name=self.getAssetName('std'), connection=self._asset.connection)
-                context['prev_avg'] = std.value
-                std.value = math.sqrt((devSum.value * devSum.value) / context['count'])
-                context['std'] = std.value
-
-
-    def try_calculate_dist(self, value, context):
-        if "dist" in self._functions:
-            distDef = self._functions['dist']
-            dist = Actuator(device=self._asset.device, name=self.getAssetName('dist'),
-                            connection=self._asset.connection)
-            if isinstance(value, bool):
-                index = 0 if value == False else 1
-                result = dist.value
-                if not result:
-                    result = [0, 0]
-            else:
-                result, min = self.prepareDistList(dist.value, context, distDef)
-                index = (value - min) / distDef['bucketsize']
-            if index < len(result) and index >= 0:
-                result[index] += 1
-                dist.value = result                         # send the value back to the server.
-                context['dist'] = result
-
-    def prepareDistList(self, value, context, distDef):
-        """
-        prepare a list for the distribution functions: create all the slots
-        :param value: the current list, if any
-        :param context: the context (previously calcualted values)
-        :param distDef: the definition object of the function parameters
-        :return: the list, minimum value
-        """
-        if value == None:
-            result = []
-            min = context['min'] if 'min' not in distDef else distDef['min']
-            max = context['max'] if 'max' not in distDef else distDef['max']
-            for x in range(min, max + 1, distDef['bucketsize']):
-                result.append(0)
+        state = store.load(self.getStateKey())
+        if state is not None:
+            return dict((_intern(key), value) for key, value in state.items())  # the same names in every group.
+        state = {}
+        for function in self._pipeline:
+            for name in function.stateAssets:
+                try:
+                    with metrics.timed('platform', call='get', tenant=self.tenant):
+                        value = Actuator(device=self._asset.device, name=self.getAssetName(name), connection=self._asset.connection).value
+                    if value is not None and value != []:               # an empty list is a distribution that was reset, a missing value is the same as no value.
+                        state[name] = value
+                except:
+                    logging.exception("failed to read initial value of {}".format(self.getAssetName(name)))
+        return state
+
+    def _saveState(self):
+        store.markDirty(self.getStateKey(), self)                       # written by the background thread of the store.
+
+    def encodeState(self):
+        """
+        called by the state store when it writes the dirty states.
+        :return: the state of the group as json text.
+        """
+        with self._lock:
+            return encode(self._state)
+
+    def publish(self, functionName, value):
+        """
+        sends a new value to the platform for the asset of the specified function, through the publisher, if any.
+        The platform is only written to, the running values are always taken from the local state.
+        :param functionName: the name of the function (or helper)
+        :param value: the new value, or a function that calculates the value when it is sent.
+        :return: None
+        """
+        if self._batch is not None:
+            self._batch[functionName] = value
+        elif self._publisher:
+            self._publisher.put(self._asset.connection, self._asset.device, self.getAssetName(functionName), value)
         else:
-            result = value
-            if 'min' not in distDef:
-                min = context['min']
-                for x in range(min, context['prev_min'], distDef['bucketsize']):
-                    result.insert(0, 0)
-            else:
-                min = distDef['min']
-            if 'max' not in distDef:
-                for x in range(context['prev_max'] + 1, context['max'] + 1, distDef['bucketsize']):
-                    result.append(0)
-        return result, min
-
-    def try_calculate_dist_sum_time(self, asset, context):
-        if "distsumtime" in self._functions:
-            distDef = self._functions['distsumtime']
-            dist = Actuator(device=self._asset.device, name=self.getAssetName('distsumtime'), connection=self._asset.connection)
-            value = asset.value
-
-            prevValAct = Actuator(device=self._asset.device, name=self.getAssetName('distsumtimeprev'), connection=self._asset.connection)
-            prevVal = prevValAct.value
-            newTime = asset.value_at
-            if prevVal:
-                prevDate = dateutil.parser.parse(prevVal['timestamp'])
-                prevVal = prevVal['value']
-                if isinstance(prevVal, bool):
-                    index = 0 if prevVal == False else 1
-                    result = dist.value
-                    if not result:
-                        result = [0, 0]
-                else:
-                    result, min = self.prepareDistList(dist.value, context, distDef)
-                    index = (prevVal - min) / distDef['bucketsize']
-                if index < len(result) and index >= 0:
-                    timeDif = dateutil.parser.parse(newTime) - prevDate
-                    result[index] += timeDif.total_seconds()
-                    context['distsumtime'] = result
-                dist.value = result  # send the value back to the server.
-            prevValAct.value = {'value': value, 'timestamp': newTime}
-
-    def try_calculate_delta(self, value, context):
-        if "delta" in self._functions:
-            deltaPrev = Actuator(device=self._asset.device, name=self.getAssetName('deltaPrevTotal'), connection=self._asset.connection)
-            deltaCur = Actuator(device=self._asset.device, name=self.getAssetName('deltaCurrentPeriod'), connection=self._asset.connection)
-            prevDelta = deltaPrev.value
-            if prevDelta:
-                deltaCur.value = value - deltaPrev.value
-            deltaPrev.value = value
-            context['delta'] = deltaCur.value
-
-    def try_calculate_dist_percent(self, context):
-        if "distprocent" in self._functions:
-            res = Actuator(device=self._asset.device, name=self.getAssetName('distprocent'), connection=self._asset.connection)
-            dist = context['dist']
-            total = sum(dist)
-            res.value = [(i * 100) / total for i in dist]
-            context['distprocent'] = res.value
-
-    def try_calculate_dist_sum_time_percent(self, context):
-        if "distsumtimeprocent" in self._functions:
-            res = Actuator(device=self._asset.device, name=self.getAssetName('distsumtimeprocent'), connection=self._asset.connection)
-            dist = context['distsumtime']
-            total = sum(dist)
-            res.value = [(i * 100) / total for i in dist]
-            context['distsumtimeprocent'] = res.value
+            with metrics.timed('platform', call='send', tenant=self.tenant):
+                Actuator(device=self._asset.device, name=self.getAssetName(functionName), connection=self._asset.connection).value = value() if callable(value) else value
+
+    def unpublish(self, functionName):
+        """
+        drops the value of the asset of the specified function that wasn't sent yet, if any.
+        :param functionName: the name of the function (or helper)
+        :return: None
+        """
+        if self._batch is not None:
+            self._batch.pop(functionName, None)
+        elif self._publisher:
+            self._publisher.discard(self._asset.device, self.getAssetName(functionName))
+
+    def _reset(self):
+        state = self.state
+        last = state.get('last')                                        # the current value of the asset, we keep track of it, so no need to query the platform.
+        for function in reversed(self._pipeline):                       # functions that depend on others still see the values of the period that ended.
+            function.reset(self, last)
+
+    def reset(self):
+        """
+        resets the values like resetValues, but without storing the state or sending the values to the platform, so
+        that this can be done for many groups at once (see resetAll).
+        :return: a tuple: (state key, encoded state)
+        """
+        with self._lock:
+            self._reset()
+            return self.getStateKey(), encode(self._state)
+
+    def takeOver(self, previous):
+        """
+        continues with the running values of the group that this group replaces (the definition has changed): the
+        values of the functions that didn't change are kept, the other functions start again. From now on, both groups
+        use the same lock and state, and the previous group only calculates the functions that are kept, so values that
+        are still on their way to the previous group are counted once. Call before this group is used.
+        :param previous: the Statistician object with the same name in the previous version of the definition.
+        :return: None
+        """
+        with previous._lock:
+            state = previous.state
+            kept = []
+            for function in previous._pipeline:                         # in order, so the functions that it requires are already known.
+                if any(function.name == x.name and function.params == x.params for x in self._pipeline) and \
+                        all(any(x.name == required for x in kept) for required in function.getRequires(previous._asset)):
+                    kept.append(function)
+            kept = tuple(kept)
+            if type(previous) is type(self):
+                dropped = [key for function in previous._pipeline if function not in kept for key in function.getStateKeys()]
+            else:                                                       # a window or rollup group has a different kind of state.
+                dropped = [key for key in state if key != 'last']
+            for key in dropped:
+                state.pop(key, None)
+            previous._pipeline = kept
+            previous._series = None                                     # the metrics of the functions that are left.
+            self._lock = previous._lock
+            self._state = state
+
+    @property
+    def publisher(self):
+        return self._publisher
+
+    def _getSeries(self):
+        if self._series is None:
+            key = (self._pipeline, self.tenant)
+            if key not in _series:
+                _series[key] = [metrics.getSeries('function', function=function.name, tenant=self.tenant) for function in self._pipeline]
+            self._series = _series[key]
+        return self._series
 
     def calculate(self, asset):
         """
@@ -292,18 +831,62 @@ class Statistician:
         :return:
         """
         context = {}
-        self.try_calculate_count(context)
-        self.try_calculate_min(asset.value, context)
-        self.try_calculate_max(asset.value, context)
-        self.try_calculate_avg(asset.value, context)
-        self.try_calculate_std(asset.value, context)
-        self.try_calculate_dist(asset.value, context)
-        self.try_calculate_dist_percent(context)
-        self.try_calculate_dist_sum_time(asset, context)
-        self.try_calculate_dist_sum_time_percent(context)
-        self.try_calculate_delta(asset.value, context)
+        with self._lock:
+            state = self.state
+            if metrics.enabled:
+                for function, series in zip(self._pipeline, self._getSeries()):
+                    start = time.time()
+                    try:
+                        function.update(self, asset, context)
+                    except:
+                        series.observe(time.time() - start, True)
+                        raise
+                    series.observe(time.time() - start)
+            else:
+                for function in self._pipeline:
+                    function.update(self, asset, context)
+            state['last'] = asset.value
+            self._saveState()
 
+    def correct(self, asset):
+        """
+        updates the functions with a value that is older than the last one (a late value, see admission.py). The
+        functions that depend on the order of the values are skipped and the last value of the asset is not changed.
+        :param asset: the asset with the late value.
+        :return: None
+        """
+        context = {}
+        with self._lock:
+            for function in self._pipeline:
+                if not function.ordered:
+                    function.update(self, asset, context)
+            self._saveState()
 
+    def calculate_batch(self, readings):
+        """
+        updates all the functions with a list of values in 1 pass and publishes the results only once. The results are
+        the same as calling calculate for every value, in the order of the timestamps.
+        :param readings: a list of Reading objects, sorted on their time (done once for all the groups, see
+        rules.calculateBatch).
+        :return: None
+        """
+        if not readings:
+            return
+        context = {}
+        with self._lock:
+            state = self.state
+            self._batch = {}                                            # collects the published values, so each asset is only sent once.
+            try:
+                for function in self._pipeline:
+                    with metrics.timed('function', function=function.name, tenant=self.tenant):
+                        function.updateBatch(self, readings, context)
+                state['last'] = readings[-1].value
+                self._saveState()
+            finally:
+                batch = self._batch
+                self._batch = None
+            for name, value in batch.items():
+                self.publish(name, value)
 
     def resetValues(self):
         """
@@ -311,54 +894,37 @@ class Statistician:
         a time period has passed.
         :return:
         """
-        if 'count' in self._functions:
-            cnt = Actuator(device=self._asset.device, name=self.getAssetName('count'), connection=self._asset.connection)
-            cntHist = Actuator(device=self._asset.device, name=self.getAssetName('countHistory'), connection=self._asset.connection)
-            cntHist.value = cnt.value
-            cnt.value = 0
-        if 'min' in self._functions:
-            minAct = Actuator(device=self._asset.device, name=self.getAssetName('min'), connection=self._asset.connection)
-            minActHist = Actuator(device=self._asset.device, name=self.getAssetName('minHistory'), connection=self._asset.connection)
-            minAct.value = self._asset.value
-        if 'max' in self._functions:
-            maxAct = Actuator(device=self._asset.device, name=self.getAssetName('max'), connection=self._asset.connection)
-            maxActHist = Actuator(device=self._asset.device, name=self.getAssetName('maxHistory'), connection=self._asset.connection)
-            maxActHist.value = maxAct.value
-            maxAct.value = self._asset.value
-        if 'avg' in self._functions:
-            avg = Actuator(device=self._asset.device, name=self.getAssetName('avg'), connection=self._asset.connection)
-            avgHist = Actuator(device=self._asset.device, name=self.getAssetName('avgHistory'), connection=self._asset.connection)
-            avgHist.value = avg.value
-            avg.value = 0
-        if "std" in self._functions:
-            devSum = Actuator(device=self._asset.device, name=self.getAssetName('devSum'), connection=self._asset.connection)
-            devSum.value = 0
-            std = Actuator(device=self._asset.device, name=self.getAssetName('std'), connection=self._asset.connection)
-            stdHist = Actuator(device=self._asset.device, name=self.getAssetName('stdHistory'), connection=self._asset.connection)
-            stdHist.value = std.value
-            std.value = 0
-        if "dist" in self._functions:
-            dist = Actuator(device=self._asset.device, name=self.getAssetName('dist'), connection=self._asset.connection)
-            distHist = Actuator(device=self._asset.device, name=self.getAssetName('distHistory'), connection=self._asset.connection)
-            distHist.value = dist.value
-            dist.value = []
-        if "distprocent" in self._functions:
-            dist = Actuator(device=self._asset.device, name=self.getAssetName('distprocent'), connection=self._asset.connection)
-            distHist = Actuator(device=self._asset.device, name=self.getAssetName('distprocentHistory'), connection=self._asset.connection)
-            distHist.value = dist.value
-            dist.value = []
-        if "distsumtime" in self._functions:
-            distSumPrev = Actuator(device=self._asset.device, name=self.getAssetName('distsumtimeprev'), connection=self._asset.connection)  # we use a helper actuator for this to store a midstage value
-            distSumPrev.value = {"value": None, "timestamp": None}
-            distSum = Actuator(device=self._asset.device, name=self.getAssetName('distsumtime'), connection=self._asset.connection)
-            distSumHist = Actuator(device=self._asset.device, name=self.getAssetName('distsumtimeHistory'), connection=self._asset.connection)
-            distSumHist.value = distSum.value
-            distSum.value = []
-        if "distsumtimeprocent" in self._functions:
-            dist = Actuator(device=self._asset.device, name=self.getAssetName('distsumtimeprocent'), connection=self._asset.connection)
-            dist.value = []
-        if 'delta' in self._functions:
-            deltaHist = Actuator(device=self._asset.device, name=self.getAssetName('deltaHistory'), connection=self._asset.connection)
-            deltaHistPrevTotal = Actuator(device=self._asset.device, name=self.getAssetName('deltaHistoryPrevTotal'), connection=self._asset.connection)
-            deltaHist.value = self._asset.value - deltaHistPrevTotal.value
-            deltaHistPrevTotal.value = self._asset.value
+        with metrics.timed('reset', tenant=self.tenant), self._lock:
+            self._reset()
+            self._saveState()
+        if self._publisher:
+            self._publisher.flush()                                     # the history values need to arrive at the end of the period, not later.
+
+
+def resetAll(groups):
+    """
+    resets a batch of groups that reached the end of their period at the same moment. The values of all the groups
+    are moved to their history in 1 pass and the states are stored in 1 transaction. The values are not sent yet: they
+    are left in the publishers of the groups.
+    :param groups: a list of Statistician objects.
+    :return: a tuple: (list of groups that were reset, set of publishers that have values to send)
+    """
+    done = []
+    states = []
+    publishers = set()
+    for group in groups:
+        try:
+            with metrics.timed('reset', tenant=group.tenant):
+                states.append(group.reset())
+            done.append(group)
+            if group.publisher:
+                publishers.add(group.publisher)
+        except:
+            logging.exception("failed to reset group {}".format(group.getStateKey()))
+    try:
+        store.saveMany(states, encoded=True)
+    except:
+        logging.exception("failed to store the state of {} groups after their reset".format(len(done)))
+        for group in done:                                              # the groups are reset, they are stored by the next flush.
+            store.markDirty(group.getStateKey(), group)
+    return done, publishers
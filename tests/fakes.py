@@ -0,0 +1,29 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+# makes the modules of the service use the fake platform of the benchmarks (benchmark/fakeplatform.py) and a state
+# database in a temporary directory, so the tests don't need the platform packages and don't touch the state of the
+# service. Import this before any module of the service.
+
+import os
+import sys
+import tempfile
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_root, 'benchmark'))
+sys.path.insert(0, _root)
+
+import fakeplatform
+
+platform = fakeplatform.install()
+
+import settings
+
+settings.StateStore = os.path.join(tempfile.mkdtemp(), 'statistician.db')
+settings.IngestWorkers = 0                                              # the values are calculated in the thread of the test.
+settings.PublishInterval = 3600                                         # the values stay in the publishers, where the tests can see them.
+settings.PublishMaxChanges = 100000
@@ -0,0 +1,99 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import unittest
+
+from fakes import platform
+from admission import Admission, admission, Apply, Drop, Correct
+import rules
+import service
+
+
+def tearDownModule():
+    service.stop()
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def testDuplicate(self):
+        stage = Admission(True, Apply)
+        self.assertEqual(stage.check('a', 10, '2017-07-14T10:00:00Z'), Apply)
+        self.assertEqual(stage.check('a', 10, '2017-07-14T10:00:00Z'), Drop)
+        self.assertEqual(stage.check('a', 10, '2017-07-14T10:00:00+00:00'), Drop)   # the same moment, written differently.
+        self.assertEqual(stage.check('a', 11, '2017-07-14T10:00:00Z'), Apply)       # another value at the same moment.
+        self.assertEqual(stage.check('a', True, '2017-07-14T10:01:00Z'), Apply)
+        self.assertEqual(stage.check('a', 1, '2017-07-14T10:01:00Z'), Apply)        # 1 and True are not the same value.
+        self.assertEqual(stage.check('b', 10, '2017-07-14T10:00:00Z'), Apply)       # per asset.
+        self.assertEqual(stage.metrics()['duplicates'], 2)
+
+    def testOlderDuplicate(self):
+        stage = Admission(True, Apply, size=2)
+        stage.check('a', 1, '2017-07-14T10:00:00Z')
+        stage.check('a', 2, '2017-07-14T10:01:00Z')
+        self.assertEqual(stage.check('a', 1, '2017-07-14T10:00:00Z'), Drop)         # redelivered after a newer value.
+        stage.check('a', 3, '2017-07-14T10:02:00Z')
+        self.assertEqual(stage.check('a', 1, '2017-07-14T10:00:00Z'), Apply)        # no longer remembered: a late value.
+
+    def testLate(self):
+        for policy in (Apply, Drop, Correct):
+            stage = Admission(True, policy)
+            stage.check('a', 2, '2017-07-14T10:01:00Z')
+            self.assertEqual(stage.check('a', 1, '2017-07-14T10:00:00Z'), policy)
+            self.assertEqual(stage.check('a', 3, '2017-07-14T10:02:00Z'), Apply)    # the late value doesn't move the last moment back.
+            self.assertEqual(stage.metrics()['late'], 1)
+        self.assertEqual((stage.metrics()['corrected'], stage.metrics()['dropped']), (1, 0))
+
+    def testNotChecked(self):
+        stage = Admission(True, Drop)
+        stage.check('a', 2, '2017-07-14T10:01:00Z')
+        self.assertEqual(stage.check('a', 2, None), Apply)              # no timestamp.
+        self.assertEqual(stage.check('a', 2, 'yesterday'), Apply)       # a timestamp that can't be read.
+        self.assertEqual(Admission(False, Drop).check('a', 2, '2017-07-14T10:01:00Z'), Apply)
+
+    def testUnknownPolicy(self):
+        self.assertRaises(ValueError, Admission, True, 'ignore')
+
+
+class RulesTest(unittest.TestCase):
+    """
+    the admission stage in front of the statistics.
+    """
+
+    def setUp(self):
+        self.policy = admission.latePolicy
+        self.asset = self.id().split('.')[-1]                           # every test starts with a new asset.
+        platform.addAsset(self.asset, 'dev', self.asset, {'type': 'number'})
+        self.stats = service.registerEventsForDef({"name": self.asset, "username": "test", "pwd": "test", "asset": self.asset, "groups": [
+            {"name": "day", "reset": "0:0:0:1:0:0", "calculate": [{"function": "count"}, {"function": "max"}, {"function": "delta"}]}]})
+        self.state = self.stats.groups[0].state
+
+    def tearDown(self):
+        admission.latePolicy = self.policy
+
+    def testDuplicate(self):
+        rules.calculateValue(self.asset, 10, '2017-07-14T10:00:00Z')
+        rules.calculateValue(self.asset, 10, '2017-07-14T10:00:00Z')
+        rules.calculateBatch(self.asset, [(10, '2017-07-14T10:00:00Z'), (12, '2017-07-14T10:01:00Z')])
+        self.assertEqual(self.state['count'], 2)
+
+    def testCorrect(self):
+        admission.latePolicy = Correct
+        rules.calculateValue(self.asset, 10, '2017-07-14T11:00:00Z')
+        rules.calculateValue(self.asset, 20, '2017-07-14T11:02:00Z')
+        rules.calculateValue(self.asset, 50, '2017-07-14T11:01:00Z')    # late: counted, but not used for the delta.
+        self.assertEqual((self.state['count'], self.state['max']), (3, 50))
+        self.assertEqual((self.state['deltaPrevTotal'], self.state['deltaCurrentPeriod']), (20, 10))
+
+    def testDrop(self):
+        admission.latePolicy = Drop
+        rules.calculateValue(self.asset, 10, '2017-07-14T12:00:00Z')
+        rules.calculateBatch(self.asset, [(20, '2017-07-14T12:02:00Z'), (50, '2017-07-14T11:59:00Z')])   # late compared to the values before the batch.
+        self.assertEqual((self.state['count'], self.state['max']), (2, 20))
+
+
+if __name__ == '__main__':
+    unittest.main()
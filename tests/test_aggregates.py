@@ -0,0 +1,248 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import random
+import unittest
+
+from aggregates import Moments, Histogram, QuantileSketch
+
+
+def _exactMoments(values):
+    mean = sum(values) / float(len(values))
+    return len(values), mean, sum((x - mean) ** 2 for x in values) / len(values)
+
+
+def _exactQuantile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+def _moments(values):
+    result = Moments()
+    for value in values:
+        result.update(value)
+    return result
+
+
+class MomentsTest(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(1)
+        self.values = [rnd.gauss(1000, 25) for i in range(1000)]
+
+    def assertMoments(self, moments, values):
+        count, mean, variance = _exactMoments(values)
+        self.assertEqual(moments.count, count)
+        self.assertAlmostEqual(moments.mean, mean, places=9)
+        self.assertAlmostEqual(moments.variance, variance, places=6)
+
+    def testUpdate(self):
+        self.assertMoments(_moments(self.values), self.values)
+
+    def testMerge(self):
+        result = Moments()
+        for start in range(0, len(self.values), 300):                   # uneven parts, the last one is smaller.
+            result.merge(_moments(self.values[start:start + 300]))
+        self.assertMoments(result, self.values)
+
+    def testMergeEmpty(self):
+        result = _moments(self.values)
+        result.merge(Moments())
+        self.assertMoments(result, self.values)
+        empty = Moments()
+        empty.merge(_moments(self.values))
+        self.assertMoments(empty, self.values)
+
+    def testRemove(self):
+        result = _moments(self.values)
+        result.remove(_moments(self.values[:400]))
+        self.assertMoments(result, self.values[400:])
+
+    def testRemoveAll(self):
+        result = _moments(self.values)
+        result.remove(_moments(self.values))
+        self.assertEqual((result.count, result.mean, result.m2), (0, 0.0, 0.0))
+
+    def testState(self):
+        self.assertMoments(Moments.fromState(_moments(self.values).toState()), self.values)
+        self.assertEqual(Moments.fromState(None).count, 0)
+
+
+class HistogramTest(unittest.TestCase):
+
+    def testGrowUp(self):
+        hist = Histogram(2, 0)
+        for value in [3, 5, 9, 21]:
+            hist.add(value)
+        self.assertEqual(hist.start, 2)
+        self.assertEqual(hist.toList(), [1, 1, 0, 1, 0, 0, 0, 0, 0, 1])
+
+    def testGrowDown(self):
+        hist = Histogram(2, 0)
+        for value in [21, 9, 5, 3, -4]:
+            hist.add(value)
+        self.assertEqual(hist.start, -4)
+        self.assertEqual(hist.toList(), [1, 0, 0, 1, 1, 0, 1, 0, 0, 0, 0, 0, 1])
+
+    def testGrowBothWays(self):
+        hist = Histogram(1, 0)
+        values = [0, 10, -10, 20, -20, 5, -5]
+        for value in values:
+            hist.add(value)
+        expected = [0] * 41
+        for value in values:
+            expected[value + 20] += 1
+        self.assertEqual(hist.start, -20)
+        self.assertEqual(hist.toList(), expected)
+
+    def testFixedRange(self):
+        hist = Histogram(10, 0, low=0, high=49)
+        self.assertEqual(hist.toList(), [0, 0, 0, 0, 0])                # the range is there before the first value.
+        self.assertTrue(hist.add(12))
+        self.assertFalse(hist.add(-1))
+        self.assertFalse(hist.add(50))
+        self.assertEqual(hist.toList(), [0, 1, 0, 0, 0])
+
+    def testLowWithoutHigh(self):
+        hist = Histogram(5, 10, low=10)
+        hist.add(27)
+        self.assertEqual(hist.start, 10)                                # the list starts at the bucket of low.
+        self.assertEqual(hist.toList(), [0, 0, 0, 1])
+
+    def testAddMany(self):
+        values = [random.Random(2).randint(-50, 50) for i in range(500)]
+        one = Histogram(3, 0)
+        for value in values:
+            one.add(value)
+        many = Histogram(3, 0)
+        self.assertEqual(many.addMany(values), len(values))
+        self.assertEqual(many.start, one.start)
+        self.assertEqual(many.toList(), one.toList())
+
+    def testMerge(self):
+        left, right, both = Histogram(2, 0), Histogram(2, 0), Histogram(2, 0)
+        for value in [1, 3, 5]:
+            left.add(value)
+            both.add(value)
+        for value in [-7, 3, 15]:
+            right.add(value)
+            both.add(value)
+        left.merge(right)
+        self.assertEqual(left.start, both.start)
+        self.assertEqual(left.toList(), both.toList())
+
+    def testMergeUnaligned(self):
+        hist = Histogram(2, 0)
+        other = Histogram(2, 1)
+        other.add(4)
+        self.assertRaises(ValueError, hist.merge, other)
+
+    def testPercentages(self):
+        hist = Histogram(1, 0)
+        for value in [0, 0, 1, 3]:
+            hist.add(value)
+        self.assertEqual(hist.percentages(), [50.0, 25.0, 0.0, 25.0])
+        self.assertEqual(Histogram(1, 0).percentages(), [])
+
+    def testState(self):
+        hist = Histogram(2, 0, 'd')
+        hist.add(-3, 1.5)
+        hist.add(7, 2.5)
+        copy = Histogram.fromState(hist.toState())
+        self.assertEqual(copy.start, hist.start)
+        self.assertEqual(copy.toList(), hist.toList())
+
+
+class QuantileSketchTest(unittest.TestCase):
+
+    accuracy = 0.01
+
+    def setUp(self):
+        rnd = random.Random(3)
+        self.values = [rnd.lognormvariate(3, 1.5) for i in range(5000)]
+
+    def assertAccurate(self, sketch, values, quantiles=(0.01, 0.25, 0.5, 0.75, 0.95, 0.99)):
+        for q in quantiles:
+            exact = _exactQuantile(values, q)
+            self.assertLessEqual(abs(sketch.quantile(q) - exact), self.accuracy * abs(exact) + 1e-9, "quantile {}".format(q))
+
+    def testAccuracy(self):
+        sketch = QuantileSketch(self.accuracy)
+        for value in self.values:
+            sketch.add(value)
+        self.assertAccurate(sketch, self.values, (0, 0.01, 0.25, 0.5, 0.75, 0.95, 0.99, 1))
+        self.assertGreaterEqual(sketch.quantile(0), min(self.values))   # clamped to the exact min and max.
+        self.assertLessEqual(sketch.quantile(1), max(self.values))
+
+    def testNegativeAndZero(self):
+        values = [-x for x in self.values[:1000]] + [0] * 100 + self.values[1000:2000]
+        sketch = QuantileSketch(self.accuracy)
+        for value in values:
+            sketch.add(value)
+        self.assertAccurate(sketch, values)
+
+    def testMerge(self):
+        parts = [QuantileSketch(self.accuracy) for i in range(4)]
+        for i, value in enumerate(self.values):
+            parts[i % 4].add(value)
+        result = QuantileSketch(self.accuracy)
+        for part in parts:
+            result.merge(part)
+        whole = QuantileSketch(self.accuracy)
+        for value in self.values:
+            whole.add(value)
+        self.assertEqual(result.count, len(self.values))
+        for q in (0.01, 0.5, 0.99):                                     # no extra loss: the same buckets as 1 sketch.
+            self.assertEqual(result.quantile(q), whole.quantile(q))
+        self.assertAccurate(result, self.values)
+
+    def testMergeDifferentAccuracy(self):
+        self.assertRaises(ValueError, QuantileSketch(0.01).merge, QuantileSketch(0.02))
+
+    def testCollapse(self):
+        maxBuckets = 50
+        sketch = QuantileSketch(self.accuracy, maxBuckets)
+        values = [1.1 ** i for i in range(200)]                         # every value in it's own bucket.
+        for value in values:
+            sketch.add(value)
+        self.assertLessEqual(len(sketch._positive), maxBuckets)
+        self.assertEqual(sketch.count, len(values))
+        kept = values[-maxBuckets + 1:]                                 # the highest buckets are not collapsed.
+        for q in (0.8, 0.9, 0.99):
+            exact = _exactQuantile(values, q)
+            self.assertGreaterEqual(exact, kept[0])
+            self.assertLessEqual(abs(sketch.quantile(q) - exact), self.accuracy * exact)
+        self.assertGreaterEqual(sketch.quantile(0.1), _exactQuantile(values, 0.1))   # collapsed: rounded up, never down.
+
+    def testCollapseAfterMerge(self):
+        maxBuckets = 50
+        low, high = QuantileSketch(self.accuracy, maxBuckets), QuantileSketch(self.accuracy, maxBuckets)
+        for i in range(100):
+            low.add(1.1 ** i)
+            high.add(1.1 ** (i + 100))
+        low.merge(high)
+        self.assertLessEqual(len(low._positive), maxBuckets)
+        self.assertEqual(low.count, 200)
+        exact = _exactQuantile([1.1 ** i for i in range(200)], 0.99)
+        self.assertLessEqual(abs(low.quantile(0.99) - exact), self.accuracy * exact)
+
+    def testState(self):
+        sketch = QuantileSketch(self.accuracy, 50)
+        for value in self.values:
+            sketch.add(value)
+        copy = QuantileSketch.fromState(sketch.toState())
+        for q in (0.1, 0.5, 0.9):
+            self.assertEqual(copy.quantile(q), sketch.quantile(q))
+        copy.add(0.001)                                                 # the floor of the collapse is kept.
+        self.assertLessEqual(len(copy._positive), 50)
+
+    def testEmpty(self):
+        self.assertIsNone(QuantileSketch().quantile(0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
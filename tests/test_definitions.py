@@ -0,0 +1,95 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import copy
+import unittest
+
+from fakes import platform
+import rules
+import service
+from provisioning import manifest
+from scheduler import scheduler
+from statistician import Reading
+
+
+def tearDownModule():
+    service.stop()
+
+
+class UpdateTest(unittest.TestCase):
+    """
+    a definition that is registered again, replaces the previous one without losing or double counting values.
+    """
+
+    def setUp(self):
+        self.asset = self.id().split('.')[-1]                           # every test starts with a new asset.
+        platform.addAsset(self.asset, 'dev', self.asset, {'type': 'number'})
+        self.definition = {"name": self.asset, "username": "test", "pwd": "test", "asset": self.asset, "groups": [
+            {"name": "g1", "reset": "0:0:0:1:0:0", "calculate": [{"function": "count"}, {"function": "max"}, {"function": "dist", "bucketsize": 10, "min": 0, "max": 100}]},
+            {"name": "g2", "reset": "0:0:0:1:0:0", "calculate": [{"function": "min"}]},
+            {"name": "g3", "reset": "0:0:0:0:1:0", "calculate": [{"function": "avg"}]}]}
+        self.previous = service.registerEventsForDef(self.definition)
+        for i in range(10):
+            rules.calculateValue(self.asset, i, '2017-07-14T10:00:{:02d}Z'.format(i))
+
+    def update(self):
+        """
+        g1: max removed, dist changed and min added. g2 removed, g3 unchanged and g4 added.
+        """
+        definition = copy.deepcopy(self.definition)
+        calculate = definition['groups'][0]['calculate']
+        calculate.remove({"function": "max"})
+        calculate[1]['bucketsize'] = 5
+        calculate.append({"function": "min"})
+        del definition['groups'][1]
+        definition['groups'].append({"name": "g4", "reset": "0:0:0:1:0:0", "calculate": [{"function": "count"}]})
+        return service.registerEventsForDef(definition)
+
+    def getKey(self, group):
+        return "{}/{}".format(self.asset, group)
+
+    def testCarryOver(self):
+        due = scheduler._entries[self.getKey('g1')].due
+        stats = self.update()
+        self.assertIs(stats.groups[1], self.previous.groups[2])         # g3 didn't change: the same object.
+        g1 = stats.groups[0]
+        self.assertIsNot(g1, self.previous.groups[0])
+        self.assertEqual(g1.state['count'], 10)                         # count didn't change: it's value is kept.
+        self.assertNotIn('max', g1.state)
+        self.assertNotIn('dist', g1.state)                              # the parameters changed: starts again.
+        entry = scheduler._entries[self.getKey('g1')]
+        self.assertEqual((entry.group, entry.due), (g1, due))           # the reset didn't change: moved to the new group.
+        self.assertNotIn(self.getKey('g2'), scheduler._entries)
+        self.assertIn(self.getKey('g4'), scheduler._entries)
+
+    def testProvisioning(self):
+        created = set(platform.created)
+        platform.resetCalls()
+        self.update()
+        calls = platform.resetCalls()
+        added = platform.created - created
+        self.assertEqual(calls.get('create'), len(added))               # only the assets that are new.
+        self.assertEqual(set(name.split('-')[2] for device, name in added), set(["min", "minHistory", "count", "countHistory"]))
+        known = manifest._store.load(self.asset)
+        self.assertNotIn(self.asset + '-g1-max', known)                 # forgotten: created again if it comes back.
+        self.assertNotIn(self.asset + '-g2-min', known)
+        platform.resetCalls()
+        self.update()                                                   # the same definition again.
+        self.assertEqual(platform.resetCalls(), {})
+
+    def testInFlight(self):
+        previous = self.previous.groups[0]
+        stats = self.update()
+        previous.calculate(Reading(100, '2017-07-14T10:00:20Z'))        # a value that was already on it's way to the previous definition.
+        rules.calculateValue(self.asset, 101, '2017-07-14T10:00:21Z')
+        state = stats.groups[0].state
+        self.assertEqual(state['count'], 12)                            # both counted once.
+        self.assertNotIn('max', state)                                  # the previous group only calculates the functions that are kept.
+
+
+if __name__ == '__main__':
+    unittest.main()
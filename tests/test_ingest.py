@@ -0,0 +1,67 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import threading
+import unittest
+
+from ingest import IngestQueue, Block, DropOldest
+
+
+class IngestQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.processed = []
+        self.lock = threading.Lock()
+
+    def process(self, assetId, value, valueAt):
+        with self.lock:
+            self.processed.append((assetId, value))
+
+    def processBatch(self, assetId, values):
+        with self.lock:
+            self.processed.extend((assetId, value) for value, valueAt in values)
+
+    def start(self, queue):
+        queue.start(self.process, self.processBatch)
+
+    def testBatchInOrder(self):
+        queue = IngestQueue(4, 1000, Block, 2)
+        queue.put('a', 1, None)
+        queue.putBatch('a', [(2, None), (3, None)])
+        queue.put('a', 4, None)
+        queue.putBatch('b', [(1, None)])
+        queue.put('a', 5, None)
+        self.assertEqual(queue.depth, 6)                                # a batch counts for all it's values. Checked before the workers start.
+        self.start(queue)
+        self.assertTrue(queue.drain(5))
+        self.assertEqual([value for assetId, value in self.processed if assetId == 'a'], [1, 2, 3, 4, 5])
+        self.assertEqual(queue.metrics()['processed'], 6)
+
+    def testDropOldestBatch(self):
+        queue = IngestQueue(1, 3, DropOldest, 10)
+        queue.putBatch('a', [(1, None), (2, None)])
+        queue.put('a', 3, None)
+        queue.put('a', 4, None)                                         # the queue is full: the batch is dropped as a whole.
+        self.assertEqual((queue.depth, queue.droppedCount), (2, 2))
+        self.start(queue)
+        self.assertTrue(queue.drain(5))
+        self.assertEqual([value for assetId, value in self.processed], [3, 4])
+
+    def testErrors(self):
+        def fail(assetId, values):
+            raise ValueError("broken")
+        queue = IngestQueue(1, 100, Block, 10)
+        queue.start(self.process, fail)
+        queue.putBatch('a', [(1, None), (2, None)])
+        queue.put('a', 3, None)                                         # still processed after the batch failed.
+        self.assertTrue(queue.drain(5))
+        self.assertEqual(self.processed, [('a', 3)])
+        self.assertEqual(queue.metrics()['errors'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
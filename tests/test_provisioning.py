@@ -0,0 +1,112 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from fakes import platform
+from att_event_engine.resources import Sensor
+import service
+from provisioning import Manifest, manifest
+from publisher import Publisher
+from statestore import StateStore
+
+
+Outputs = [('a-count', 'count', '', {'type': 'integer'}), ('a-max', 'max', '', {'type': 'number'})]
+
+
+def tearDownModule():
+    service.stop()
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = StateStore(os.path.join(self.dir, 'provisioning.db'), 'provisioning')
+        self.manifest = Manifest(self.store)
+        platform.addAsset('a', 'dev-a', 'a', {'type': 'number'})
+        self.asset = Sensor('a')
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def testSkipKnown(self):
+        self.assertEqual(self.manifest.provision(None, self.asset, Outputs), 2)
+        self.assertEqual(self.manifest.provision(None, self.asset, Outputs), 0)
+        changed = [('a-max', 'maximum', '', {'type': 'number'})]       # the label changed.
+        self.assertEqual(self.manifest.provision(None, self.asset, changed), 1)
+
+    def testForget(self):
+        self.manifest.provision(None, self.asset, Outputs)
+        self.manifest.forget('a', ['a-max'])
+        self.assertEqual(list(self.store.load('a').keys()), ['a-count'])
+        self.assertEqual(self.manifest.provision(None, self.asset, Outputs), 1)
+        self.manifest.forget('a')
+        self.assertIsNone(self.store.load('a'))
+
+    def testCheckAtStartup(self):
+        self.manifest.provision(None, self.asset, Outputs)
+        platform.created.discard(('dev-a', 'a-max'))                    # removed by hand.
+        restarted = Manifest(self.store)
+        platform.resetCalls()
+        self.assertEqual(restarted.provision(None, self.asset, Outputs), 1)
+        self.assertEqual(platform.resetCalls(), {'get device': 1, 'create': 1})
+        self.assertEqual(restarted.provision(None, self.asset, Outputs), 0)   # only checked the first time.
+        self.assertEqual(platform.resetCalls(), {})
+        self.assertEqual(restarted.metrics()['missing'], 1)
+
+
+class RecreateTest(unittest.TestCase):
+
+    def setUp(self):
+        platform.strict = True
+
+    def tearDown(self):
+        platform.strict = False
+
+    def testSend(self):
+        platform.addAsset('r', 'dev-r', 'r', {'type': 'number'})
+        manifest.provision(None, Sensor('r'), [('r-count', 'count', '', {'type': 'integer'})])
+        platform.created.discard(('dev-r', 'r-count'))
+        publisher = Publisher(3600, 100000)
+        publisher.put(None, 'dev-r', 'r-count', 5)
+        publisher.flush()
+        self.assertEqual((publisher.publishedCount, publisher.errorCount), (1, 0))
+        self.assertEqual(platform.values[('dev-r', 'r-count')], 5)
+        self.assertIn(('dev-r', 'r-count'), platform.created)
+
+    def testUnknown(self):
+        publisher = Publisher(3600, 100000)
+        publisher.put(None, 'dev-u', 'u-count', 5)                      # not in the manifest: not created.
+        publisher.flush()
+        self.assertEqual((publisher.publishedCount, publisher.errorCount), (0, 1))
+
+
+class DefinitionTest(unittest.TestCase):
+
+    def register(self, functions):
+        return service.registerEventsForDef({"name": "d", "username": "test", "pwd": "test", "asset": "d", "groups": [
+            {"name": "day", "reset": "0:0:0:1:0:0", "calculate": [{"function": name} for name in functions]}]})
+
+    def testRedefine(self):
+        platform.addAsset('d', 'dev-d', 'd', {'type': 'number'})
+        self.register(['count', 'max'])
+        self.assertIn('d-day-max', manifest._store.load('d'))
+        self.register(['count'])
+        known = manifest._store.load('d')
+        self.assertIn('d-day-count', known)
+        self.assertNotIn('d-day-max', known)                            # created again when the function comes back.
+        service.removeDefinition('d')
+        self.assertIsNone(manifest._store.load('d'))
+
+
+if __name__ == '__main__':
+    unittest.main()
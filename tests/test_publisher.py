@@ -0,0 +1,92 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import time
+import unittest
+
+from fakes import platform
+from publisher import Publisher, Flusher
+
+
+class PublisherTest(unittest.TestCase):
+
+    def testCoalesce(self):
+        publisher = Publisher(3600, 1000)
+        for value in range(5):
+            publisher.put(None, 'dev', 'p-count', value)
+        self.assertEqual((publisher.depth, publisher.coalescedCount), (1, 4))
+        self.assertEqual(publisher.flush(), 1)
+        self.assertEqual(platform.values[('dev', 'p-count')], 4)        # only the last value is sent.
+
+    def testHold(self):
+        publisher = Publisher(0, 1000)                                  # normally sent immediately.
+        publisher.hold(time.time() + 3600)
+        publisher.put(None, 'dev', 'h-count', 1)
+        self.assertEqual(publisher.depth, 1)
+        self.assertFalse(publisher.isDue(time.time()))
+        self.assertTrue(publisher.isDue(time.time() + 3601))
+
+    def testHoldMaxChanges(self):
+        publisher = Publisher(0, 2)
+        publisher.hold(time.time() + 3600)
+        publisher.put(None, 'dev', 'm-count', 1)
+        publisher.put(None, 'dev', 'm-max', 1)                          # too many changes: sent, even when held.
+        self.assertEqual((publisher.depth, publisher.publishedCount), (0, 2))
+
+    def testHoldExpires(self):
+        publisher = Publisher(3600, 1000)
+        publisher.put(None, 'dev', 'e-count', 1)
+        self.assertFalse(publisher.isDue(time.time()))
+        publisher.hold(time.time() + 1)                                 # the values of a reset are sent at the end of the hold, not after the interval.
+        self.assertFalse(publisher.isDue(time.time()))
+        self.assertTrue(publisher.isDue(time.time() + 2))
+
+
+class FlusherTest(unittest.TestCase):
+
+    def testSpread(self):
+        publishers = [Publisher(0, 1000) for i in range(4)]
+        start = time.time()
+        Flusher(1).spread(publishers, 40)
+        for i, publisher in enumerate(publishers):
+            self.assertAlmostEqual(publisher._holdUntil, start + i * 10, delta=1)
+
+    def testMaxRate(self):
+        flusher = Flusher(0.05, maxRate=20)
+        publisher = Publisher(0, 1000)
+        publisher.hold(time.time() + 3600)
+        for i in range(10):
+            publisher.put(None, 'dev', 'r-{}'.format(i), i)
+        flusher.add(publisher)
+        flusher.spread([publisher], 0)
+        time.sleep(0.3)
+        flusher.stop()                                                  # sends the rest.
+        self.assertLess(publisher.flushCount, 10)
+        self.assertGreater(publisher.flushCount, 1)                     # not all at once.
+        self.assertEqual(publisher.publishedCount, 10)
+
+    def testSenders(self):
+        flusher = Flusher(0.05, senders=4)
+        publishers = [Publisher(0, 1000) for i in range(4)]
+        for i, publisher in enumerate(publishers):
+            publisher.hold(time.time() + 3600)
+            publisher.put(None, 'dev', 's-{}'.format(i), i)
+            flusher.add(publisher)
+        platform.latency = 0.3
+        try:
+            start = time.time()
+            flusher.spread(publishers, 0)
+            while sum(publisher.publishedCount for publisher in publishers) < 4 and time.time() - start < 5:
+                time.sleep(0.01)
+            self.assertLess(time.time() - start, 1.0)                   # the slow calls overlap: 1 after the other, they take 1.2 seconds.
+        finally:
+            platform.latency = 0
+            flusher.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+import fakes
+from aggregates import Histogram
+from rollup import Partial, RollupStore, Tier, AssetRollup
+
+
+def _partial(values):
+    result = Partial(Histogram(10, 0))
+    for value in values:
+        result.add(value)
+    return result
+
+
+class PartialTest(unittest.TestCase):
+
+    def testMerge(self):
+        result = Partial()
+        result.merge(_partial([5, 15]))
+        result.merge(_partial([-20, 40]))
+        whole = _partial([5, 15, -20, 40])
+        self.assertEqual((result.count, result.min, result.max), (4, -20, 40))
+        self.assertAlmostEqual(result.moments.variance, whole.moments.variance)
+        self.assertEqual(result.hist.toList(), whole.hist.toList())
+
+    def testMergeEmpty(self):
+        result = _partial([1, 2])
+        result.merge(Partial())
+        self.assertEqual((result.count, result.min, result.max), (2, 1, 2))
+
+    def testState(self):
+        partial = _partial([3, 33])
+        copy = Partial.fromState(partial.toState())
+        self.assertEqual((copy.count, copy.min, copy.max, copy.hist.toList()), (2, 3, 33, partial.hist.toList()))
+
+
+class CompactionTest(unittest.TestCase):
+    """
+    slots of 60 seconds that are kept for 1 hour, then merged into slots of 1 hour that are kept for 1 day.
+    """
+
+    now = 1499990400                                                    # midnight, so the slots of 1 hour start at the hour.
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = RollupStore(os.path.join(self.dir, 'rollup.db'))
+        self.tiers = [Tier(3600, resolution=60), Tier(86400, resolution=3600)]
+        rnd = random.Random(5)
+        self.values = {}                                                # start of the slot -> values
+        for minute in range(240):                                       # the last 4 hours.
+            start = self.now - 14400 + minute * 60
+            self.values[start] = [rnd.uniform(0, 100) for i in range(rnd.randint(0, 5))]
+        self.store.saveMany('asset', [(start, _partial(values)) for start, values in self.values.items() if values])
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def getValues(self, start, end):
+        return [value for slot, values in self.values.items() if start <= slot < end for value in values]
+
+    def assertPeriod(self, start, end):
+        values = self.getValues(start, end)
+        result = self.store.query('asset', start, end)
+        whole = _partial(values)
+        self.assertEqual((result.count, result.min, result.max), (len(values), min(values), max(values)))
+        self.assertAlmostEqual(result.moments.mean, whole.moments.mean, places=9)
+        self.assertAlmostEqual(result.moments.variance, whole.moments.variance, places=6)
+        self.assertEqual(result.hist.toList(), whole.hist.toList())
+
+    def testCompact(self):
+        slots = len([x for x in self.values.values() if x])
+        compacted = self.store.compact(self.tiers, self.now)
+        self.assertEqual(compacted, len([start for start, x in self.values.items() if x and start < self.now - 3600]))
+        self.assertLess(compacted, slots)
+        for start in (self.now - 14400, self.now - 7200):               # on the boundaries of the hours: exact.
+            self.assertPeriod(start, self.now)
+        self.assertPeriod(self.now - 1800, self.now)                    # the slots that were not compacted.
+
+    def testCompactTwice(self):
+        self.store.compact(self.tiers, self.now)
+        self.assertEqual(self.store.compact(self.tiers, self.now), 0)   # the same slots are not merged again.
+        self.assertPeriod(self.now - 14400, self.now)
+
+    def testCompactLater(self):
+        self.store.compact(self.tiers, self.now)
+        self.store.saveMany('asset', [(self.now + 60, _partial([1000]))])
+        self.values[self.now + 60] = [1000]
+        self.store.compact(self.tiers, self.now + 7200)                 # the other minute slots go to the hours, also the new one.
+        self.assertPeriod(self.now - 14400, self.now + 3600)
+
+    def testRemoveOld(self):
+        self.store.compact(self.tiers, self.now + 86400 - 5400)         # the first 3 hours are older than the retention of the last tier.
+        self.assertEqual(self.store.query('asset', 0, None).count, len(self.getValues(self.now - 3600, self.now)))
+
+
+class AssetRollupTest(unittest.TestCase):
+    """
+    slots of 60 seconds, the open slot is only stored when it ends or on a tick.
+    """
+
+    def setUp(self):
+        self.now = 60 * (int(time.time()) // 60) - 600                  # late values are only accepted within the retention.
+        self.dir = tempfile.mkdtemp()
+        self.store = RollupStore(os.path.join(self.dir, 'rollup.db'))
+        self.rollup = AssetRollup('asset', self.store, [Tier(3600, resolution=60)])
+        self.saved = []
+        saveMany = self.store.saveMany
+        def record(asset, slots):
+            self.saved.append([start for start, partial in slots])
+            saveMany(asset, slots)
+        self.store.saveMany = record
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def testOpenSlotNotStored(self):
+        for second in range(10):
+            self.rollup.add(second, self.now + second)
+        self.assertEqual(self.saved, [])
+        self.rollup.add(10, self.now + 60)                              # the first slot ends: stored once.
+        self.assertEqual(self.saved, [[self.now]])
+        self.assertEqual(self.store.load('asset', 0, self.now).count, 10)
+
+    def testTick(self):
+        self.rollup.add(1, self.now)
+        self.rollup.closeEnded(self.now + 30)                           # still open, but stored.
+        self.assertEqual(self.store.load('asset', 0, self.now).count, 1)
+        self.rollup.closeEnded(self.now + 40)                           # nothing changed.
+        self.rollup.add(2, self.now + 50)
+        self.rollup.closeEnded(self.now + 60)                           # ended and stored.
+        self.assertEqual(self.saved, [[self.now], [self.now]])
+        self.assertEqual(self.store.load('asset', 0, self.now).count, 2)
+
+    def testLateValue(self):
+        self.rollup.add(1, self.now)
+        self.rollup.add(2, self.now + 60)
+        self.rollup.add(3, self.now + 10)                               # the slot has ended: stored right away.
+        self.assertEqual(self.store.load('asset', 0, self.now).count, 2)
+
+    def testFlush(self):
+        self.rollup.add(1, self.now)
+        self.rollup.flush()
+        copy = AssetRollup('asset', self.store, [Tier(3600, resolution=60)])
+        copy.add(2, self.now + 1)                                       # continues with the stored open slot.
+        copy.flush()
+        self.assertEqual(self.store.load('asset', 0, self.now).count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
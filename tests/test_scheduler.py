@@ -0,0 +1,148 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import os
+import time
+import shutil
+import datetime
+import tempfile
+import unittest
+
+from dateutil import tz
+
+import fakes
+import settings
+from scheduler import Period, Scheduler
+from statestore import StateStore
+
+
+Brussels = tz.gettz('Europe/Brussels')
+
+
+def _local(*args):
+    return datetime.datetime(*args, tzinfo=Brussels)
+
+
+class PeriodTest(unittest.TestCase):
+
+    def testMonthEnd(self):
+        period = Period('0:1:0:0:0:0', _local(2017, 1, 31))
+        self.assertEqual(period.next(_local(2017, 2, 1)), _local(2017, 2, 28))
+        self.assertEqual(period.next(_local(2017, 2, 28)), _local(2017, 3, 31))    # back to the end of the month, no drift.
+        self.assertEqual(period.previous(_local(2017, 4, 15)), _local(2017, 3, 31))
+
+    def testDailyOverDst(self):
+        period = Period('0:0:0:1:0:0', _local(2017, 3, 20))
+        start = period.next(_local(2017, 3, 25, 12))
+        end = period.next(start)
+        self.assertEqual(end, _local(2017, 3, 27))                      # still at midnight.
+        self.assertEqual((end.astimezone(tz.tzutc()) - start.astimezone(tz.tzutc())).total_seconds(), 23 * 3600)   # the clock went forward.
+
+    def testHourlyOverDst(self):
+        period = Period('0:0:0:0:1:0', _local(2017, 10, 1))
+        boundary = _local(2017, 10, 29)
+        count = 0
+        while boundary < _local(2017, 10, 30):
+            boundary = period.next(boundary)
+            count += 1
+        self.assertEqual(count, 25)                                     # the hour that occurs twice when the clock goes back, is reset twice.
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, Period, '0:0:0:0:0:0')
+
+
+class _Group(object):
+    """
+    the part of a statistical group that the scheduler uses.
+    """
+
+    def __init__(self, key, resetEvery, publisher=None):
+        self.key = key
+        self.resetEvery = resetEvery
+        self.startDate = None
+        self.publisher = publisher
+        self.tenant = None
+        self.resets = 0
+
+    def getStateKey(self):
+        return self.key
+
+    def reset(self):
+        self.resets += 1
+        return self.key, '{}'
+
+
+class _Publisher(object):
+    """
+    fails the first time that the scheduler holds it.
+    """
+    depth = 0
+
+    def __init__(self):
+        self.failed = False
+
+    def hold(self, until):
+        if not self.failed:
+            self.failed = True
+            raise ValueError("broken")
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = StateStore(os.path.join(self.dir, 'schedule.db'), 'schedule')
+        self.scheduler = Scheduler(self.store)
+        self.now = datetime.datetime.now(tz.tzutc())
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def waitForBatch(self):
+        """
+        the groups are reset before the batch is done, wait until the scheduler is ready with it.
+        """
+        end = time.time() + 5
+        while not self.scheduler.batchCount and time.time() < end:
+            time.sleep(0.01)
+        return self.scheduler.batchCount > 0
+
+    def testCatchUp(self):
+        group = _Group('a/day', '0:0:0:1:0:0')
+        period = Period('0:0:0:1:0:0')
+        last = period.previous(self.now)
+        self.store.save('a/day', (last - datetime.timedelta(days=3)).isoformat())   # 3 periods were missed while the service was down.
+        self.scheduler.add(group)
+        self.assertTrue(self.waitForBatch())
+        self.assertEqual(group.resets, 1)                               # the missed periods are collapsed into 1 reset.
+        self.assertEqual(self.scheduler.catchUpCount, 1)
+        self.assertEqual(self.store.load('a/day'), last.isoformat())
+        self.assertEqual(self.scheduler._entries['a/day'].due, period.next(self.now))
+
+    def testFirstTime(self):
+        self.scheduler.add(_Group('b/day', '0:0:0:1:0:0'))
+        self.assertEqual(self.store.load('b/day'), Period('0:0:0:1:0:0').previous(self.now).isoformat())
+        self.assertEqual(self.scheduler.metrics()['resets'], 0)
+
+    def testRetry(self):
+        delay = settings.ResetRetryDelay
+        settings.ResetRetryDelay = 0.1
+        try:
+            group = _Group('c/day', '0:0:0:1:0:0', _Publisher())
+            last = Period('0:0:0:1:0:0').previous(self.now)
+            self.store.save('c/day', (last - datetime.timedelta(days=1)).isoformat())
+            self.scheduler.add(group)
+            self.assertTrue(self.waitForBatch())                        # the batch failed, the thread kept running and tried again.
+            self.assertEqual(group.resets, 1)
+            self.assertTrue(self.scheduler._thread.is_alive())
+        finally:
+            settings.ResetRetryDelay = delay
+
+
+if __name__ == '__main__':
+    unittest.main()
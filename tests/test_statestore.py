@@ -0,0 +1,116 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from aggregates import Moments
+from statestore import StateStore, encode
+
+
+class _Group(object):
+    """
+    the part of a statistical group that the store uses for the write-behind.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.encoded = 0
+
+    def encodeState(self):
+        self.encoded += 1
+        return encode(self.state)
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state', 'test.db')         # the directory is created when the database is opened.
+        self.store = StateStore(self.path, flushInterval=3600)
+
+    def tearDown(self):
+        self.store.stop()
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def reopen(self):
+        self.store.close()
+        return StateStore(self.path)
+
+    def testRoundTrip(self):
+        moments = Moments()
+        for value in [1, 2, 6]:
+            moments.update(value)
+        self.store.save('a/day', {'count': 3, 'avg': moments, 'dist': [0, 1]})
+        state = self.reopen().load('a/day')
+        self.assertEqual((state['count'], state['dist']), (3, [0, 1]))
+        self.assertEqual(Moments.fromState(state['avg']).mean, 3)      # objects are stored with their toState.
+        self.assertIsNone(self.store.load('b/day'))
+
+    def testSaveMany(self):
+        self.store.saveMany([('a/day', {'count': 1}), ('b/day', {'count': 2})])
+        self.store.saveMany([('a/day', encode({'count': 5}))], encoded=True)
+        self.assertEqual(self.store.load('a/day'), {'count': 5})
+        self.assertEqual(self.store.load('b/day'), {'count': 2})
+
+    def testDelete(self):
+        self.store.save('a/day', {'count': 1})
+        self.store.delete('a/day')
+        self.assertIsNone(self.store.load('a/day'))
+
+    def testTables(self):
+        other = StateStore(self.path, table='other')
+        self.store.save('a/day', {'count': 1})
+        other.save('a/day', {'count': 2})
+        self.assertEqual(self.store.load('a/day'), {'count': 1})
+        other.close()
+
+    def testWriteBehind(self):
+        group = _Group({'count': 1})
+        for count in range(1, 4):
+            group.state['count'] = count
+            self.store.markDirty('a/day', group)
+        self.assertIsNone(self.store.load('a/day'))                     # nothing is written until the flush.
+        self.assertEqual(self.store.flush(), 1)
+        self.assertEqual(group.encoded, 1)                              # the last state, written once.
+        self.assertEqual(self.store.load('a/day'), {'count': 3})
+        self.assertEqual(self.store.flush(), 0)
+
+    def testStop(self):
+        self.store.markDirty('a/day', _Group({'count': 7}))
+        self.store.stop()
+        self.assertEqual(self.reopen().load('a/day'), {'count': 7})
+
+    def testMaxDirty(self):
+        store = StateStore(self.path, flushInterval=3600, maxDirty=2)
+        done = threading.Event()
+        flush = store.flush
+        store.flush = lambda: done.set() if flush() else None
+        store.markDirty('a/day', _Group({'count': 1}))
+        store.markDirty('b/day', _Group({'count': 2}))                  # wakes the background thread, long before the interval.
+        self.assertTrue(done.wait(5))
+        self.assertEqual(store.load('b/day'), {'count': 2})
+        store.stop()
+        store.close()
+
+    def testEncodeFails(self):
+        class Broken(object):
+            def encodeState(self):
+                raise ValueError("broken")
+        self.store.markDirty('a/day', Broken())
+        self.store.markDirty('b/day', _Group({'count': 2}))
+        self.assertEqual(self.store.flush(), 1)                         # the other states are still written.
+        self.assertEqual(self.store.load('b/day'), {'count': 2})
+        self.assertEqual(self.store.errorCount, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
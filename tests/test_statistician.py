@@ -0,0 +1,96 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import json
+import random
+import unittest
+
+from fakes import platform
+import rules
+import service
+from statestore import encode
+
+
+Functions = [{"function": "count"}, {"function": "min"}, {"function": "max"}, {"function": "avg"}, {"function": "std"},
+             {"function": "dist", "bucketsize": 5}, {"function": "distprocent", "bucketsize": 5},
+             {"function": "distsumtime", "bucketsize": 5}, {"function": "delta"}, {"function": "percentile", "percentiles": [50, 90]}]
+
+
+def _register(assetId):
+    platform.addAsset(assetId, 'dev', assetId, {'type': 'number'})
+    definition = {"name": assetId, "username": "test", "pwd": "test", "asset": assetId,
+                  "groups": [{"name": "day", "reset": "0:0:0:1:0:0", "calculate": Functions}]}
+    return service.registerEventsForDef(definition)
+
+
+def _state(stats):
+    return json.loads(encode(stats.groups[0].state))
+
+
+def _published(stats, assetId):
+    """
+    :return: the values that wait in the publisher, by the name of the output without the asset name.
+    """
+    result = {}
+    for (device, name), (connection, value) in stats.publisher._pending.items():
+        result[name[len(assetId):]] = value() if callable(value) else value
+    return result
+
+
+def tearDownModule():
+    service.stop()                                                      # stops the background threads of the publishers and the state store.
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(6)
+        self.values = [(rnd.randint(0, 100), '2017-07-14T10:{:02d}:{:02d}.{:03d}Z'.format(i // 60, i % 60, rnd.randint(0, 999)))
+                       for i in range(300)]
+
+    def testSameAsSequential(self):
+        sequential = _register('seq')
+        for value, valueAt in self.values:
+            rules.calculateValue('seq', value, valueAt)
+        batch = _register('batch')
+        shuffled = list(self.values)
+        random.Random(7).shuffle(shuffled)                              # sorted on their timestamp before they are calculated.
+        self.assertTrue(rules.calculateBatch('batch', shuffled))
+        self.assertEqual(_state(batch), _state(sequential))
+        self.assertEqual(_published(batch, 'batch'), _published(sequential, 'seq'))
+
+    def testBatches(self):
+        sequential = _register('seq2')
+        for value, valueAt in self.values:
+            rules.calculateValue('seq2', value, valueAt)
+        batch = _register('batch2')
+        for start in range(0, len(self.values), 70):                    # the values of the previous batches are continued.
+            rules.calculateBatch('batch2', self.values[start:start + 70])
+        self.assertEqual(_state(batch), _state(sequential))
+
+    def testUnknownAsset(self):
+        self.assertFalse(rules.calculateBatch('unknown', self.values))
+
+
+class PercentileTest(unittest.TestCase):
+
+    def testReset(self):
+        platform.addAsset('pct', 'dev', 'pct', {'type': 'number'})
+        stats = service.registerEventsForDef({"name": "pct", "username": "test", "pwd": "test", "asset": "pct", "groups": [
+            {"name": "day", "reset": "0:0:0:1:0:0", "calculate": [{"function": "percentile", "percentiles": [50]}]}]})
+        for i in range(11):
+            rules.calculateValue('pct', i, '2017-07-14T10:00:{:02d}Z'.format(i))
+        stats.groups[0].reset()
+        published = _published(stats, 'pct')
+        self.assertEqual(list(published.keys()), ['-day-p50History'])  # the estimate of the period that ended isn't sent, nor an empty value.
+        self.assertAlmostEqual(published['-day-p50History'], 5, delta=0.05)
+        rules.calculateValue('pct', 100, '2017-07-15T00:00:01Z')       # the first value of the new period.
+        self.assertAlmostEqual(_published(stats, 'pct')['-day-p50'], 100, delta=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
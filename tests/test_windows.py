@@ -0,0 +1,86 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import random
+import unittest
+
+import fakes
+from windows import SlidingWindow
+
+
+class SlidingWindowTest(unittest.TestCase):
+    """
+    a window of 60 seconds in panes of 10 seconds: a value expires when the pane that it is in, is no longer one of
+    the last 6 panes.
+    """
+
+    def setUp(self):
+        self.window = SlidingWindow(60, 10, accuracy=0.01, maxBuckets=512)
+
+    def assertWindow(self, values):
+        mean = sum(values) / float(len(values))
+        self.assertEqual(self.window.count, len(values))
+        self.assertAlmostEqual(self.window.moments.mean, mean, places=9)
+        self.assertAlmostEqual(self.window.moments.variance, sum((x - mean) ** 2 for x in values) / len(values), places=6)
+        self.assertEqual(self.window.min, min(values))
+        self.assertEqual(self.window.max, max(values))
+
+    def testPaneExpiry(self):
+        for second in range(60):
+            self.window.add(second, 1000 + second)
+        self.assertWindow(list(range(60)))
+        self.window.add(100, 1060)                                      # the pane 1000..1009 expires.
+        self.assertWindow(list(range(10, 60)) + [100])
+        self.window.add(101, 1075)                                      # and 1010..1019.
+        self.assertWindow(list(range(20, 60)) + [100, 101])
+
+    def testExpireWithoutValue(self):
+        self.window.add(5, 1000)
+        self.window.add(7, 1030)
+        self.window.expire(1065)                                        # moving the window is enough.
+        self.assertWindow([7])
+        self.window.expire(1100)
+        self.assertEqual(self.window.count, 0)
+        self.assertIsNone(self.window.min)
+        self.assertIsNone(self.window.max)
+        self.assertIsNone(self.window.quantile(0.5))
+
+    def testMinMaxExpire(self):
+        for timestamp, value in [(1000, 1), (1010, 50), (1020, 3), (1030, 40), (1040, 5)]:
+            self.window.add(value, timestamp)
+        self.window.expire(1065)                                        # the min (1) goes, the max stays.
+        self.assertEqual((self.window.min, self.window.max), (3, 50))
+        self.window.expire(1075)
+        self.assertEqual((self.window.min, self.window.max), (3, 40))
+
+    def testTooOld(self):
+        self.window.add(1, 1100)
+        self.assertFalse(self.window.add(2, 1045))                      # the window holds the panes 1050..1109.
+        self.assertTrue(self.window.add(3, 1055))                       # late, but still in the window.
+        self.assertWindow([1, 3])
+
+    def testQuantile(self):
+        rnd = random.Random(4)
+        values = [(1000 + i * 0.1, rnd.uniform(1, 1000)) for i in range(1200)]
+        for timestamp, value in values:
+            self.window.add(value, timestamp)
+        inWindow = sorted(value for timestamp, value in values if timestamp >= 1060)
+        exact = inWindow[int(0.5 * (len(inWindow) - 1))]
+        self.assertLessEqual(abs(self.window.quantile(0.5) - exact), 0.01 * exact)
+
+    def testState(self):
+        for second in range(0, 90, 3):
+            self.window.add(second * 2, 1000 + second)
+        copy = SlidingWindow.fromState(self.window.toState())
+        self.assertEqual((copy.count, copy.min, copy.max), (self.window.count, self.window.min, self.window.max))
+        copy.add(0, 1100)
+        self.window.add(0, 1100)
+        self.assertEqual((copy.count, copy.min, copy.max), (self.window.count, self.window.min, self.window.max))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import time
+import heapq
+import random
+import logging
+import threading
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+from att_event_engine.timer import Timer
+
+import settings
+from metrics import metrics
+
+
+def isTimerServiceAvailable(timeout=None):
+    """
+    checks if the timer service can be reached: any http response means that it is up.
+    :param timeout: max nr of seconds to wait for the service.
+    :return: True if the service responded.
+    """
+    try:
+        client = httplib.HTTPConnection(Timer.TimerEndPoint, timeout=timeout or settings.TimerProbeTimeout)
+        try:
+            client.request('GET', '/')
+            return client.getresponse().status < 500
+        finally:
+            client.close()
+    except Exception as e:
+        logging.info("timer service not available: {}".format(e))
+        return False
+
+
+class _Registration(object):
+    """
+    a timer that still needs to be set.
+    """
+    def __init__(self, timer, getDelay, tenant):
+        self.timer = timer
+        self.getDelay = getDelay
+        self.tenant = tenant
+        self.attempts = 0
+        self.lastError = None
+
+
+class TimerRegistrar(object):
+    """
+    sets the timers of the statistical groups from a background thread, so that a slow or unavailable timer service
+    doesn't block the registration of the definitions or the processing of the events. Failed attempts are retried
+    with an exponential backoff (with jitter, so that all the timers don't retry at the same moment), until the
+    max nr of attempts has been reached. The timers that could not be set are kept in a list for the status report.
+    """
+
+    def __init__(self, retryDelay, maxRetryDelay, maxAttempts):
+        """
+        create the object
+        :param retryDelay: nr of seconds to wait before the first retry, doubled for every next retry.
+        :param maxRetryDelay: max nr of seconds between 2 attempts.
+        :param maxAttempts: nr of attempts after which a timer is considered failed.
+        """
+        self._retryDelay = retryDelay
+        self._maxRetryDelay = maxRetryDelay
+        self._maxAttempts = maxAttempts
+        self._queue = []                                                # heap of (time of next attempt, seq nr, registration)
+        self._seq = 0
+        self._pending = {}                                              # timer id -> registration, so a timer is only set once, with the latest delay.
+        self._failed = {}                                               # timer id -> registration
+        self._condition = threading.Condition()
+        self._thread = None
+        self.registeredCount = 0
+        self.retryCount = 0
+
+    def add(self, timer, getDelay, tenant=None):
+        """
+        queues a timer to be set as soon as possible.
+        :param timer: the Timer object.
+        :param getDelay: callable that returns the nr of seconds after which the timer has to go off. It is called at
+        every attempt, so that a retry still goes off at the correct time.
+        :param tenant: the username of the definition, used as label of the metrics.
+        :return: None
+        """
+        registration = _Registration(timer, getDelay, tenant)
+        with self._condition:
+            self._failed.pop(timer.id, None)
+            self._pending[timer.id] = registration
+            self._push(time.time(), registration)
+            self._condition.notify()
+        if not self._thread:
+            self.start()
+
+    def remove(self, timers):
+        """
+        removes the timers from the queue, for instance when the definition has been replaced.
+        :param timers: a list of Timer objects.
+        :return: None
+        """
+        with self._condition:
+            for timer in timers:
+                registration = self._pending.get(timer.id)
+                if registration and registration.timer is timer:
+                    del self._pending[timer.id]
+                registration = self._failed.get(timer.id)
+                if registration and registration.timer is timer:
+                    del self._failed[timer.id]
+
+    def _push(self, due, registration):
+        self._seq += 1
+        heapq.heappush(self._queue, (due, self._seq, registration))
+
+    def getRetryDelay(self, attempts):
+        """
+        :param attempts: the nr of attempts that have failed so far.
+        :return: nr of seconds to wait before the next attempt.
+        """
+        delay = min(self._maxRetryDelay, self._retryDelay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2.0, delay)
+
+    def start(self):
+        with self._condition:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name="timers")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _next(self):
+        """
+        waits until a timer needs to be set.
+        :return: the registration
+        """
+        with self._condition:
+            while True:
+                while self._queue and self._pending.get(self._queue[0][2].timer.id) is not self._queue[0][2]:
+                    heapq.heappop(self._queue)                          # removed, or replaced by a newer registration.
+                if self._queue:
+                    wait = self._queue[0][0] - time.time()
+                    if wait <= 0:
+                        return heapq.heappop(self._queue)[2]
+                else:
+                    wait = None
+                self._condition.wait(wait)
+
+    def _run(self):
+        while True:
+            registration = self._next()
+            start = time.time()
+            try:
+                success = registration.timer.set(registration.getDelay())
+                error = None if success else "timer service refused the timer"
+            except Exception as e:
+                success = False
+                error = str(e)
+            metrics.observe('platform', time.time() - start, not success, call='timer', tenant=registration.tenant)
+            with self._condition:
+                if self._pending.get(registration.timer.id) is not registration:
+                    continue                                            # removed or replaced while it was being set.
+                registration.attempts += 1
+                if success:
+                    del self._pending[registration.timer.id]
+                    self.registeredCount += 1
+                elif registration.attempts >= self._maxAttempts:
+                    del self._pending[registration.timer.id]
+                    registration.lastError = error
+                    self._failed[registration.timer.id] = registration
+                    logging.error("failed to set timer {} after {} attempts: {}".format(registration.timer.id, registration.attempts, error))
+                else:
+                    registration.lastError = error
+                    self.retryCount += 1
+                    self._push(time.time() + self.getRetryDelay(registration.attempts), registration)
+
+    def metrics(self):
+        """
+        :return: a dict with the nr of timers that are waiting to be set, that were set and the timers that failed.
+        """
+        with self._condition:
+            return {'pending': len(self._pending), 'registered': self.registeredCount, 'retries': self.retryCount,
+                    'failed': [{'timer': key, 'attempts': x.attempts, 'error': x.lastError} for key, x in self._failed.items()]}
+
+
+registrar = TimerRegistrar(settings.TimerRetryDelay, settings.TimerMaxRetryDelay, settings.TimerMaxAttempts)
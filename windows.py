@@ -0,0 +1,370 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+import re
+import time
+import math
+import bisect
+import logging
+import calendar
+import threading
+from collections import deque
+
+import dateutil.parser
+
+from statistician import Statistician
+from statestore import store
+from aggregates import Moments, QuantileSketch
+import settings
+
+try:
+    basestring
+except NameError:                                                       # python 3 (used by the asyncio server)
+    basestring = str
+
+
+def getDuration(value):
+    """
+    converts the length of a window into seconds.
+    :param value: a nr of seconds or a string in the form 'year:month:week:day:hour:minute', like the reset of a group.
+    Years and months are not allowed: a window needs a fixed length.
+    :return: nr of seconds
+    """
+    if not isinstance(value, basestring):
+        return float(value)
+    values = [int(x) for x in value.split(':')]
+    if len(values) != 6:
+        raise ValueError("window should be in the form 'year:month:week:day:hour:minute': {}".format(value))
+    if values[0] or values[1]:
+        raise ValueError("a window can't be expressed in years or months: {}".format(value))
+    return float(((values[2] * 7 + values[3]) * 24 + values[4]) * 3600 + values[5] * 60)
+
+
+_isoFormat = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(\.\d+)?(Z|([+-])(\d\d):?(\d\d))?$')
+
+
+def getTime(valueAt):
+    """
+    :param valueAt: the timestamp of a value: iso formatted string, nr of seconds since the epoch or None (= now).
+    :return: nr of seconds since the epoch.
+    """
+    if valueAt is None:
+        return time.time()
+    if not isinstance(valueAt, basestring):
+        return float(valueAt)
+    match = _isoFormat.match(valueAt)
+    if match:                                                           # the format of the platform, without the cost of dateutil (this is done for every event).
+        parts = match.groups()
+        result = float(calendar.timegm(tuple(int(x) for x in parts[:6])))
+        if parts[6]:
+            result += float(parts[6])
+        if parts[8]:
+            offset = int(parts[9]) * 3600 + int(parts[10]) * 60
+            result -= offset if parts[8] == '+' else -offset
+        return result
+    moment = dateutil.parser.parse(valueAt)                             # without time zone: utc, like the platform.
+    return calendar.timegm(moment.utctimetuple()) + moment.microsecond / 1000000.0
+
+
+class _Pane(object):
+    """
+    the summary of the values in 1 slice of the window.
+    """
+    __slots__ = ('index', 'moments', 'min', 'max', 'sketch')
+
+    def __init__(self, index, sketch=None):
+        self.index = index
+        self.moments = Moments()
+        self.min = None
+        self.max = None
+        self.sketch = sketch
+
+    def add(self, value):
+        self.moments.update(value)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.sketch:
+            self.sketch.add(value)
+
+
+class SlidingWindow(object):
+    """
+    the count, mean, variance, min, max and quantiles of the values of the last 'size' seconds. The window is divided
+    in panes of 'resolution' seconds, every pane keeps a summary of it's values, so the memory is bounded by
+    size / resolution and not by the nr of values. When the window moves, the panes that fall out of it are removed:
+    - count, mean and variance are kept for the whole window: the moments of a pane are added when it's values arrive and
+      removed when it expires.
+    - min and max are kept in monotonic queues (at most 1 entry per pane), the front holds the result.
+    - the quantiles are calculated from the sketches of the panes, only when they are asked for.
+    Every pane is added and removed once, so moving the window is O(1) amortized. The window moves with the
+    timestamps of the values, values that are older than the window are ignored.
+    """
+
+    def __init__(self, size, resolution, accuracy=None, maxBuckets=None):
+        """
+        create the object
+        :param size: the length of the window in seconds.
+        :param resolution: the length of a pane in seconds, values expire per pane.
+        :param accuracy: relative accuracy of the quantiles, None when no quantiles are needed.
+        :param maxBuckets: max nr of buckets of the quantile sketch of a pane.
+        """
+        self.size = size
+        self.resolution = resolution
+        self.accuracy = accuracy
+        self.maxBuckets = maxBuckets
+        self._paneCount = int(math.ceil(size / float(resolution)))
+        self._panes = deque()                                           # the panes with values, oldest first.
+        self._mins = deque()                                            # (pane index, value), increasing values.
+        self._maxs = deque()                                            # (pane index, value), decreasing values.
+        self.moments = Moments()
+        self.last = None                                                # index of the newest pane.
+        self._lock = threading.Lock()                                   # quantiles can be calculated from the publisher thread.
+
+    def _getIndex(self, timestamp):
+        return int(math.floor(timestamp / self.resolution))
+
+    @staticmethod
+    def _push(queue, index, value, isMin):
+        while queue and (queue[-1][1] >= value if isMin else queue[-1][1] <= value):
+            queue.pop()
+        if queue and queue[-1][0] == index:
+            return                                                      # the pane already has a better value, that expires at the same time.
+        queue.append((index, value))
+
+    def _rebuild(self):
+        self._mins.clear()
+        self._maxs.clear()
+        for pane in self._panes:
+            self._push(self._mins, pane.index, pane.min, True)
+            self._push(self._maxs, pane.index, pane.max, False)
+
+    def _newPane(self, index):
+        return _Pane(index, QuantileSketch(self.accuracy, self.maxBuckets) if self.accuracy else None)
+
+    def _getPane(self, index):
+        if self._panes and self._panes[-1].index == index:
+            return self._panes[-1]
+        if not self._panes or self._panes[-1].index < index:
+            self._panes.append(self._newPane(index))
+            return self._panes[-1]
+        panes = list(self._panes)                                       # a late value for an older pane: rare.
+        pos = bisect.bisect_left([pane.index for pane in panes], index)
+        if pos < len(panes) and panes[pos].index == index:
+            return panes[pos]
+        panes.insert(pos, self._newPane(index))
+        self._panes = deque(panes)
+        return panes[pos]
+
+    def expire(self, timestamp):
+        """
+        moves the window so that it ends at the timestamp, the panes that fall out of it are removed.
+        :param timestamp: nr of seconds since the epoch.
+        :return: None
+        """
+        index = self._getIndex(timestamp)
+        if self.last is not None and index <= self.last:
+            return
+        self.last = index
+        first = index - self._paneCount + 1
+        while self._panes and self._panes[0].index < first:
+            self.moments.remove(self._panes.popleft().moments)
+        if not self._panes:
+            self.moments = Moments()                                    # start again from 0, so rounding errors don't accumulate.
+        while self._mins and self._mins[0][0] < first:
+            self._mins.popleft()
+        while self._maxs and self._maxs[0][0] < first:
+            self._maxs.popleft()
+
+    def add(self, value, timestamp):
+        """
+        adds a value.
+        :param value: the value (a number)
+        :param timestamp: nr of seconds since the epoch.
+        :return: False if the value is older than the window and was ignored.
+        """
+        with self._lock:
+            self.expire(timestamp)
+            index = self._getIndex(timestamp)
+            if index <= self.last - self._paneCount:
+                return False
+            pane = self._getPane(index)
+            pane.add(value)
+            self.moments.update(value)
+            if index == self.last:
+                self._push(self._mins, index, value, True)
+                self._push(self._maxs, index, value, False)
+            else:
+                self._rebuild()
+            return True
+
+    @property
+    def count(self):
+        return self.moments.count
+
+    @property
+    def min(self):
+        return self._mins[0][1] if self._mins else None
+
+    @property
+    def max(self):
+        return self._maxs[0][1] if self._maxs else None
+
+    def quantile(self, q):
+        """
+        :param q: the quantile, between 0 and 1
+        :return: the estimate of the quantile of the values in the window, None if there are no values.
+        """
+        sketch = QuantileSketch(self.accuracy, self.maxBuckets)
+        with self._lock:
+            for pane in self._panes:
+                sketch.merge(pane.sketch)
+        return sketch.quantile(q)
+
+    def toState(self):
+        """
+        :return: a json serializable representation, to store in the state store.
+        """
+        return {'size': self.size, 'resolution': self.resolution, 'accuracy': self.accuracy, 'maxBuckets': self.maxBuckets,
+                'last': self.last,
+                'panes': [[pane.index, pane.moments.toState(), pane.min, pane.max, pane.sketch.toState() if pane.sketch else None] for pane in self._panes]}
+
+    @staticmethod
+    def fromState(value):
+        """
+        create an object from the value that was returned by toState.
+        :param value: a dict
+        :return: a SlidingWindow object
+        """
+        result = SlidingWindow(value['size'], value['resolution'], value['accuracy'], value['maxBuckets'])
+        result.last = value['last']
+        for index, moments, low, high, sketch in value['panes']:
+            pane = _Pane(index, QuantileSketch.fromState(sketch) if sketch else None)
+            pane.moments = Moments.fromState(moments)
+            pane.min, pane.max = low, high
+            result._panes.append(pane)
+            result.moments.merge(pane.moments)
+        result._rebuild()
+        return result
+
+
+def _toNumber(value):
+    return int(value) if isinstance(value, bool) else value
+
+
+class WindowStatistician(Statistician):
+    """
+    a group that calculates it's functions over a sliding window ("avg over the last 15 minutes") instead of over a
+    period that is reset. The results are updated with every value, from the state of the window, without reading
+    anything from the platform. Supported functions: count, min, max, avg, std and percentile.
+    """
+
+    __slots__ = ('windowSize', 'resolution', '_percentile')
+    supported = ['count', 'min', 'max', 'avg', 'std', 'percentile']
+
+    def __init__(self, name, functions, window, resolution, asset, publisher=None, tenant=None):
+        """
+        create object
+        :param functions: a list of 'function' objects, the functions that can't be calculated over a window are ignored.
+        :param window: the length of the window: a nr of seconds or 'year:month:week:day:hour:minute'
+        :param resolution: the length of a pane, same format. None = the window divided in settings.WindowPanes panes.
+        :param asset: an Asset object or id string that this statistician should calculate values for.
+        :param publisher: the Publisher object that sends the results to the platform.
+        :param tenant: the username of the definition, used as label of the metrics.
+        """
+        for function in functions:
+            if function['function'] not in self.supported:
+                logging.warning("function '{}' can't be calculated over a window, ignored in group '{}'".format(function['function'], name))
+        Statistician.__init__(self, name, [x for x in functions if x['function'] in self.supported], None, None, asset, publisher, tenant)
+        self.windowSize = getDuration(window)
+        self.resolution = getDuration(resolution) if resolution else self.windowSize / settings.WindowPanes
+        if self.windowSize <= 0 or self.resolution <= 0:
+            raise ValueError("the window and resolution of group '{}' should be larger then 0".format(name))
+        if self.windowSize / self.resolution > settings.WindowMaxPanes:
+            raise ValueError("the window of group '{}' has more then {} panes, use a larger resolution".format(name, settings.WindowMaxPanes))
+        percentile = [x for x in self._pipeline if x.name == 'percentile']
+        self._percentile = percentile[0] if percentile else None
+
+    def _loadState(self):
+        return store.load(self.getStateKey()) or {}                     # the values of the window can't be rebuilt from the platform.
+
+    def _getWindow(self):
+        window = self.state.get('window')
+        if isinstance(window, SlidingWindow):
+            return window
+        if window and window['size'] == self.windowSize and window['resolution'] == self.resolution:
+            window = SlidingWindow.fromState(window)
+        else:                                                           # new, or the window of the definition has changed.
+            params = self._percentile.params if self._percentile else {}
+            window = SlidingWindow(self.windowSize, self.resolution,
+                                   params.get('accuracy', settings.PercentileAccuracy) if self._percentile else None,
+                                   params.get('max buckets', settings.PercentileMaxBuckets))
+        self.state['window'] = window
+        return window
+
+    def _publishAll(self, window):
+        for function in self._pipeline:
+            if function.name == 'count':
+                self.publish('count', window.count)
+            elif function.name == 'min':
+                self.publish('min', window.min)
+            elif function.name == 'max':
+                self.publish('max', window.max)
+            elif function.name == 'avg':
+                self.publish('avg', window.moments.mean)
+            elif function.name == 'std':
+                self.publish('std', window.moments.std)
+            elif function.name == 'percentile':
+                for percentile in function.percentiles:
+                    self.publish(function.getOutputName(percentile), lambda q=percentile / 100.0: window.quantile(q))  # only calculated when the value is sent.
+
+    def calculate(self, asset):
+        """
+        adds the new value to the window and publishes the results.
+        :param asset: the asset with the new value that arrived.
+        :return: None
+        """
+        with self._lock:
+            window = self._getWindow()
+            if window.add(_toNumber(asset.value), getTime(asset.value_at)):
+                self._publishAll(window)
+            self.state['last'] = asset.value
+            self._saveState()
+
+    def correct(self, asset):
+        """
+        adds a late value to the window, the last value of the asset is not changed.
+        :param asset: the asset with the late value.
+        :return: None
+        """
+        with self._lock:
+            window = self._getWindow()
+            if window.add(_toNumber(asset.value), getTime(asset.value_at)):
+                self._publishAll(window)
+            self._saveState()
+
+    def calculate_batch(self, readings):
+        """
+        adds a list of values to the window and publishes the results once.
+        :param readings: a list of Reading objects, sorted on their time.
+        :return: None
+        """
+        if not readings:
+            return
+        with self._lock:
+            window = self._getWindow()
+            added = False
+            for reading in readings:
+                added = window.add(_toNumber(reading.value), reading.time) or added
+            if added:
+                self._publishAll(window)
+            self.state['last'] = readings[-1].value
+            self._saveState()
+
+    def _reset(self):
+        pass                                                            # a window is never reset, the values expire.
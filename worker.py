@@ -0,0 +1,104 @@
+__author__ = 'Jan Bogaerts'
+__copyright__ = "Copyright 2016, AllThingsTalk"
+__credits__ = []
+__maintainer__ = "Jan Bogaerts"
+__email__ = "jb@allthingstalk.com"
+__status__ = "Prototype"  # "Development", or "Production"
+
+# a worker process of the sharded engine (see shards.py). It is started by the main process with the arguments:
+# index, nr of shards, host and port of the main process. The worker receives the definitions of the assets that it
+# owns and their values, calculates the statistics and does the resets of the groups.
+
+import os
+import sys
+import logging
+import binascii
+from multiprocessing.connection import Client
+
+import settings
+from shards import ShardKeyVar, getShardPath
+if __name__ == '__main__':
+    settings.StateStore = getShardPath(settings.StateStore, int(sys.argv[1]))  # every worker has it's own database. Set before the stores are created by the imports below.
+from registry import definitions
+from publisher import flusher
+from statestore import store
+from rollup import rollups
+from provisioning import manifest
+import connections
+import rules
+from ingest import ingest
+
+
+def define(definition):
+    """
+    creates or replaces the statistics object of the definition and creates the assets of the new groups, nothing is
+    done if the definition didn't change.
+    :param definition: a json dict
+    :return: None
+    """
+    with definitions.getLock(definition['asset']):
+        _define(definition)
+
+
+def _define(definition):
+    if definitions.get(definition['asset']) == definition and definitions.getStats(definition['asset']):
+        return
+    connection = connections.events.get(definition['username'], definition['pwd'], definition.get('api'))
+    stats = rules.AssetStats(definition, connection, previous=definitions.getStats(definition['asset']))
+    provisioning = connections.provisioning.get(definition['username'], definition['pwd'], definition.get('api'))
+    for group in stats.added:
+        group.createAssets(provisioning)                                # the main process only forwards the values.
+    stats.takeOver()
+    definitions.set(definition, stats)
+    stats.schedule()
+
+
+def run(index, count, host, port):
+    """
+    connects to the main process and processes it's messages until it asks to stop.
+    :return: None
+    """
+    authkey = binascii.unhexlify(os.environ[ShardKeyVar])
+    connection = Client((host, port), authkey=authkey)
+    connection.send(index)
+    logging.info("shard worker {} of {} started".format(index, count))
+    if settings.IngestWorkers:
+        ingest.start(rules.calculateValue, rules.calculateValues)
+    processed = 0
+    while True:
+        message = connection.recv()
+        processed += 1
+        try:
+            if message[0] == 'event':
+                if ingest.running:
+                    ingest.put(message[1], message[2], message[3])
+                else:
+                    rules.calculateValue(message[1], message[2], message[3])
+            elif message[0] == 'values':
+                if ingest.running:
+                    ingest.putBatch(message[1], message[2])             # behind the values of the asset that are still waiting.
+                else:
+                    rules.calculateValues(message[1], message[2])
+            elif message[0] == 'define':
+                define(message[1])
+            elif message[0] == 'remove':
+                definitions.remove(message[1])
+                manifest.forget(message[1])
+            elif message[0] == 'stop':
+                break
+        except:
+            logging.exception("shard worker {} failed to process: {}".format(index, message[:2]))
+        if processed >= settings.ShardAckInterval or not connection.poll():
+            connection.send(('processed', processed))                   # so the main process knows what was lost when this worker stops.
+            processed = 0
+    if ingest.running:
+        ingest.drain(settings.ShardStopTimeout)
+    flusher.stop()
+    rollups.flushAll()
+    store.stop()
+    connection.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)-8s - shard " + sys.argv[1] + " - %(message)s")
+    run(int(sys.argv[1]), int(sys.argv[2]), sys.argv[3], int(sys.argv[4]))